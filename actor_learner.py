@@ -0,0 +1,184 @@
+import copy
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from Queue import Empty, Full
+
+# asynchronous acting for the mlp scripts. actor processes step their own VecGridWorld with a local copy of the
+# policy and push stacked transitions through a queue (as torch tensors, which torch.multiprocessing moves through
+# shared memory), the learner drains the queue into its replay between updates and publishes its weights into a
+# shared copy that the actors reload every refresh_interval steps
+
+
+def linear_decay(n, n_decay, low=0.1, high=0.9):
+	# epsilon_greedy_linear_decay of the scripts, n counted in finished episodes like there
+	if n <= n_decay:
+		return ((low-high)/n_decay)*n + high
+	return low
+
+def greedy_q(policy, policy_type, s, phase):
+	if policy_type == 0:
+		return policy.act(s)
+	elif policy_type == 1:
+		return policy.act(np.concatenate((s, phase[:,None]), axis=1))
+	elif policy_type == 2:
+		return policy.act(s, phase)
+
+def to_tensor(x):
+	# float32 for floats, uint8 for bools (no bool tensors), ints as they are
+	if x.dtype == np.bool_:
+		return torch.from_numpy(x.astype(np.uint8))
+	if x.dtype == np.float64:
+		return torch.from_numpy(x.astype(np.float32))
+	return torch.from_numpy(x)
+
+def actor(rank, make_env, policy, shared, lock, version, n_episodes, queue, stop, policy_type, history, refresh_interval, push_steps, n_decay, seed):
+	torch.set_num_threads(1)
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+	env = make_env()
+	n = env.n_envs
+	policy.inference(True)
+	local_version = -1
+	# exit without waiting for the queued batches to be flushed, stop() throws them away
+	queue.cancel_join_thread()
+
+	frames = np.repeat(env.states()[:,None,:], history, axis=1) # (n, history, frame), oldest first
+	total_rewards = np.zeros(n)
+	lengths = np.zeros(n, dtype=int)
+	batch = []
+	finished = []
+	steps = 0
+	while not stop.is_set():
+		if steps % refresh_interval == 0:
+			with lock:
+				policy.load_state_dict(shared.state_dict())
+				local_version = version.value
+			policy.reset()
+
+		s = frames.reshape(n, -1)
+		phase = env.phase()
+		eps = linear_decay(n_episodes.value, n_decay)
+		a = np.argmax(greedy_q(policy, policy_type, s, phase), axis=1)
+		explore = np.random.uniform(size=n) < eps
+		a[explore] = np.random.randint(0, high=5, size=np.sum(explore))
+
+		states_prime, rewards, terminals, phases_prime, dones = env.step(a)
+		frames_prime = np.concatenate((frames[:,1:], states_prime[:,None,:]), axis=1)
+		batch.append((s, a, rewards, frames_prime.reshape(n, -1), phase, phases_prime, terminals))
+
+		# envs that are done have been reset by the env, restart their history from the new state
+		frames = frames_prime.copy()
+		frames[dones] = env.states()[dones][:,None,:]
+		total_rewards += rewards
+		lengths += 1
+		finished.extend(zip(total_rewards[dones].tolist(), lengths[dones].tolist()))
+		total_rewards[dones] = 0
+		lengths[dones] = 0
+		steps += 1
+
+		if len(batch) == push_steps:
+			tensors = [to_tensor(np.concatenate(x)) for x in zip(*batch)]
+			# blocks while the queue is full, the actors can not run ahead of the learner by more than queue_size pushes
+			while not stop.is_set():
+				try:
+					queue.put((rank, local_version, tensors, finished), timeout=0.1)
+					break
+				except Full:
+					pass
+			batch = []
+			finished = []
+
+
+class ActorLearner():
+	# n_actors processes each stepping the VecGridWorld built by make_env (e.g. a functools.partial of
+	# varying_transition_env, it must set max_episode_length). the learner calls drain(M) before every update and
+	# publish(policy, n_episodes) every few updates. counters: queue depth, and staleness as the number of publishes
+	# between the policy version a batch was acted with and the version current when it is drained. total reward and
+	# length of the episodes the actors finish are collected in episodes
+	def __init__(self, policy, make_env, policy_type, n_actors=2, history=3, refresh_interval=50, push_steps=8, queue_size=64, n_decay=25000, seed=0):
+		self.shared = copy.deepcopy(policy)
+		self.shared.share_memory()
+		self.lock = mp.Lock()
+		self.version = mp.Value('i', 0)
+		self.n_episodes = mp.Value('i', 0) # finished episodes as of the last publish, drives the actors' epsilon
+		self.queue = mp.Queue(maxsize=queue_size)
+		self.stop_event = mp.Event()
+		self.processes = []
+		for rank in range(n_actors):
+			args = (rank, make_env, copy.deepcopy(policy), self.shared, self.lock, self.version, self.n_episodes, self.queue, self.stop_event, policy_type, history, refresh_interval, push_steps, n_decay, seed + rank)
+			self.processes.append(mp.Process(target=actor, args=args))
+
+		self.n_batches = 0
+		self.n_transitions = 0
+		self.staleness_sum = 0
+		self.staleness_max = 0
+		self.depth_sum = 0
+		self.n_drains = 0
+		self.episodes = []
+
+	def start(self):
+		for p in self.processes:
+			p.daemon = True
+			p.start()
+
+	def publish(self, policy, n_episodes):
+		shared = self.shared.state_dict()
+		with self.lock:
+			for key, value in policy.state_dict().items():
+				shared[key].copy_(value)
+			self.version.value += 1
+		self.n_episodes.value = n_episodes
+
+	def queue_depth(self):
+		try:
+			return self.queue.qsize()
+		except NotImplementedError: # not available on some platforms
+			return -1
+
+	def drain(self, M, max_batches=None):
+		# moves every queued batch (at most max_batches) into the replay M, returns the number of batches added
+		self.depth_sum += self.queue_depth()
+		self.n_drains += 1
+		added = 0
+		while max_batches is None or added < max_batches:
+			try:
+				rank, batch_version, tensors, finished = self.queue.get_nowait()
+			except Empty:
+				break
+			states, actions, rewards, states_prime, phases, phases_prime, terminals = [x.numpy() for x in tensors]
+			M.add_batch(states, actions, rewards, states_prime, phases, phases_prime, terminals.astype(np.bool_))
+			staleness = self.version.value - batch_version
+			self.staleness_sum += staleness
+			self.staleness_max = max(self.staleness_max, staleness)
+			self.n_batches += 1
+			self.n_transitions += len(actions)
+			self.episodes.extend(finished)
+			added += 1
+		return added
+
+	def pop_episodes(self):
+		# (total reward, length) of the episodes finished since the last call
+		episodes = self.episodes
+		self.episodes = []
+		return episodes
+
+	def info(self):
+		return {'version': self.version.value, 'batches': self.n_batches, 'transitions': self.n_transitions, 'queue_depth': self.queue_depth(), 'mean_queue_depth': self.depth_sum/float(max(self.n_drains, 1)), 'mean_staleness': self.staleness_sum/float(max(self.n_batches, 1)), 'max_staleness': self.staleness_max}
+
+	def reset_stats(self):
+		self.staleness_sum = 0
+		self.staleness_max = 0
+		self.depth_sum = 0
+		self.n_drains = 0
+
+	def stop(self, timeout=5.0):
+		# the actors exit without flushing the queue (cancel_join_thread). the batches left in it are not read: their
+		# tensors live in shared memory that can no longer be opened once the actor that sent them is gone
+		self.stop_event.set()
+		deadline = time.time() + timeout
+		for p in self.processes:
+			p.join(timeout=max(deadline - time.time(), 0.0))
+			if p.is_alive():
+				p.terminate()
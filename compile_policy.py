@@ -0,0 +1,70 @@
+import sys
+import numpy as np
+from vec_env import ACTION_DELTAS, varying_transition_env, varying_reward_env
+from exact_evaluate import encode, decode, policy_inputs, greedy_actions, successors
+from table_policy import TablePolicy, UNKNOWN, phase_key
+
+# compiles a trained MLP / PMLP checkpoint into a TablePolicy: every input the env can produce is enumerated, the
+# network is evaluated once on all of them in batches and its greedy actions are written into the table
+# usage: python compile_policy.py checkpoint policy_type output.npz transition prob
+#        python compile_policy.py checkpoint policy_type output.npz reward
+
+
+def reachable_rows(env, L, history):
+	# every state (rows as in exact_evaluate) reachable from any start cell under any actions. states past a goal are
+	# kept, batched rollouts (greedy_evaluate) keep stepping finished episodes
+	n_k = 4 if env.wind_w is not None else 1
+	starts = np.array([(0, 0, k) + tuple(cell)*history for k in range(n_k) for cell in env.start_cells.tolist()], dtype=np.int64)
+	visited = np.unique(encode(env, L, history, starts))
+	frontier = visited
+	while len(frontier) > 0:
+		rows = decode(env, L, history, frontier)
+		reached = []
+		for a in range(len(ACTION_DELTAS)):
+			for probs, rows_prime, rewards, terminals in successors(env, L, history, rows, np.full(len(rows), a, dtype=np.int64)):
+				reached.append(encode(env, L, history, rows_prime[probs > 0]))
+		frontier = np.setdiff1d(np.concatenate(reached), visited)
+		visited = np.union1d(visited, frontier)
+	return decode(env, L, history, visited)
+
+def compile_policy(policy, env, policy_type, history=3, batch_size=65536, max_period=10000):
+	L = env.time_period(max_period)
+	if L is None:
+		raise ValueError('Environment is not periodic in time, there is no finite state space')
+	rows = reachable_rows(env, L, history)
+	actions = np.concatenate([greedy_actions(policy, env, policy_type, rows[i:i+batch_size], history) for i in range(0, len(rows), batch_size)])
+
+	x = policy_inputs(env, rows, history)
+	phase = env.phase_at(rows[:,0], rows[:,2])
+	if policy_type == 1:
+		x = np.concatenate((x, phase[:,None]), axis=1)
+	phases = np.unique(phase_key(phase)) if policy_type != 0 else np.zeros(1)
+	dims = TablePolicy.dims(policy_type, history, env.width, env.height, env.obs_period, len(phases))
+	table = TablePolicy(np.full(dims, UNKNOWN, dtype=np.uint8), policy_type, history, env.width, env.height, env.obstacles, env.offsets, phases)
+
+	idx = table.index(x, phase)
+	if np.any(idx < 0):
+		raise ValueError('Some reachable inputs have no table entry')
+	table.table.reshape(-1)[idx] = actions
+	# states that only differ in what the network does not see (e.g. the wind phase for type 0) share an entry
+	if np.any(table.table.reshape(-1)[idx] != actions):
+		raise ValueError('Inputs sharing a table entry got different actions')
+	return table
+
+def main():
+	import torch
+	policy = torch.load(sys.argv[1])
+	policy.inference(True)
+	policy_type = int(sys.argv[2])
+	if sys.argv[4] == 'transition':
+		env = varying_transition_env(1, float(sys.argv[5]))
+	else:
+		env = varying_reward_env(1)
+
+	table = compile_policy(policy, env, policy_type)
+	table.save(sys.argv[3])
+	print 'Compiled', np.sum(table.table != UNKNOWN), 'inputs into', sys.argv[3]
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,58 @@
+import numpy as np
+import torch.nn as nn
+from multi_mlp import MultiMLP, MultiPMLP
+from phase_mlp import PMLP
+from inference import QNetwork
+
+
+class QEnsemble(QNetwork, nn.Module):
+	# n_heads q networks of the same MLP (phase=False) or PMLP (phase=True) shape, weights stacked as in MultiMLP /
+	# MultiPMLP. all heads see the same (batch, input_size) rows and run in one batched matmul per layer, a PMLP
+	# ensemble with one phase for all rows interpolates once per head. act() returns the mean over the heads so the
+	# ensemble drops in wherever a policy is acted with (greedy_evaluate, exact_evaluate), heads() and stats() give
+	# the per head q values and their mean and variance, e.g. for bootstrapped exploration or uncertainty estimates
+
+	def __init__(self, n_heads, input_size, output_size, hidden_size, n_layers=1, phase=False):
+		super(QEnsemble, self).__init__()
+		self.n_heads = n_heads
+		self.input_size = input_size
+		self.phase = phase
+		if phase:
+			self.net = MultiPMLP(n_heads, input_size, output_size, hidden_size, n_layers=n_layers)
+		else:
+			self.net = MultiMLP(n_heads, input_size, output_size, hidden_size, n_layers=n_layers)
+
+	@staticmethod
+	def from_models(models):
+		# ensemble of trained MLPs or PMLPs of the same shape, e.g. the checkpoints of several seeds
+		m = models[0]
+		ensemble = QEnsemble(len(models), m.input_size, m.output_size, m.hidden_size, n_layers=m.n_layers, phase=isinstance(m, PMLP))
+		for k, model in enumerate(models):
+			ensemble.net.set_model(k, model)
+		return ensemble
+
+	def forward(self, x, phase=None):
+		# (n_heads, batch, output_size) q values of every head for x (batch, input_size). phase a single phase or one
+		# per row
+		x = x.unsqueeze(0).expand(self.n_heads, x.size(0), x.size(1))
+		if not self.phase:
+			return self.net.forward(x)
+		if np.ndim(phase) > 0:
+			phase = np.tile(np.asarray(phase).reshape(1, -1), (self.n_heads, 1))
+		return self.net.forward(x, phase)
+
+	def heads(self, x, phase=None):
+		# (n_heads, batch, output_size) q values (numpy) for one observation or a batch of rows
+		return self.forward(self.as_variable(x), phase).data.cpu().numpy()
+
+	def stats(self, x, phase=None):
+		# per head q values with their mean and variance over the heads
+		q = self.heads(x, phase)
+		return q, q.mean(axis=0), q.var(axis=0)
+
+	def act(self, x, phase=None):
+		return self.heads(x, phase).mean(axis=0)
+
+	def head(self, k):
+		# head k as a plain MLP / PMLP
+		return self.net.model(k)
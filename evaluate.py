@@ -0,0 +1,47 @@
+import numpy as np
+
+
+def greedy_evaluate(policy, env, policy_type, recurrent=False, start=(0,5), history=3, max_steps=None):
+	# runs env.n_envs greedy episodes side by side from start, one batched policy forward per time step.
+	# policy_type as in the scripts: 0 - state only, 1 - phase as input, 2 - phase network, 3 - random (policy unused).
+	# recurrent policies (GRU, PGRU) see the current state only and keep one hidden state row per episode, the others
+	# get the last history states stacked. finished episodes keep stepping but are masked out of the totals.
+	# returns per episode total rewards and step counts
+	n = env.n_envs
+	env.auto_reset = False
+	env.reset(start=start)
+	if policy_type != 3 and recurrent:
+		batch_size = policy.batch_size
+		policy.batch_size = n
+	if policy_type != 3:
+		policy.reset()
+
+	frames = [env.states()]*history
+	total_rewards = np.zeros(n)
+	step_counts = np.zeros(n, dtype=int)
+	active = np.ones(n, dtype=np.bool_)
+	steps = 0
+	while np.any(active) and (max_steps is None or steps < max_steps):
+		phase = env.phase()
+		s = frames[-1] if recurrent else np.concatenate(frames, axis=1)
+		if policy_type == 0:
+			a = np.argmax(policy.act(s), axis=1)
+		elif policy_type == 1:
+			a = np.argmax(policy.act(np.concatenate((s, phase[:,None]), axis=1)), axis=1)
+		elif policy_type == 2:
+			a = np.argmax(policy.act(s, phase), axis=1)
+		elif policy_type == 3:
+			a = np.random.randint(0, high=5, size=n)
+
+		states_prime, rewards, terminals, _, _ = env.step(a)
+		total_rewards += rewards*active
+		step_counts += active
+		active &= ~terminals
+		frames = frames[1:] + [states_prime]
+		steps += 1
+
+	if policy_type != 3 and recurrent:
+		policy.batch_size = batch_size
+		policy.reset()
+
+	return total_rewards, step_counts
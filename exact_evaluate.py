@@ -0,0 +1,149 @@
+import sys
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from vec_env import ACTION_DELTAS, WIND_DELTAS
+
+# a state is a row [t % L, depth, wind phase, x_0, y_0, x_1, y_1, ...] with position 0 the current one and depth the
+# number of steps since the episode start capped at history-1 (older frames repeat the first one, like in the scripts)
+
+
+def dims(env, L, history):
+	return (L, history, 4) + (env.width, env.height)*history
+
+def encode(env, L, history, rows):
+	return np.ravel_multi_index(tuple(rows.T), dims(env, L, history))
+
+def decode(env, L, history, keys):
+	return np.stack(np.unravel_index(keys, dims(env, L, history)), axis=1)
+
+def policy_inputs(env, rows, history):
+	# stacked frames, oldest first, laid out as State.state
+	frames = []
+	for j in range(history - 1, -1, -1):
+		t = rows[:,0] - np.minimum(j, rows[:,1])
+		frames.append(np.concatenate((rows[:,3+2*j:5+2*j], env.obstacles_at(t).reshape(len(rows), -1)), axis=1))
+	return np.concatenate(frames, axis=1).astype(np.float64)
+
+def greedy_actions(policy, env, policy_type, rows, history):
+	# one batched forward for all rows
+	s = policy_inputs(env, rows, history)
+	phase = env.phase_at(rows[:,0], rows[:,2])
+	if policy_type == 0:
+		q = policy.act(s)
+	elif policy_type == 1:
+		q = policy.act(np.concatenate((s, phase[:,None]), axis=1))
+	elif policy_type == 2:
+		q = policy.act(s, phase)
+	return np.argmax(q, axis=1)
+
+def successors(env, L, history, rows, actions):
+	# (probabilities, next rows, rewards, terminals) for every outcome of taking actions in rows, probabilities can be 0
+	t = rows[:,0]
+	t_prime = t + 1
+	outcomes = []
+	winds = [(1.0, 0)] if env.wind_w is None else [(1 - env.wind_prob, 0), (env.wind_prob, 1)]
+	for p_wind, windy in winds:
+		if p_wind == 0:
+			continue
+		delta = ACTION_DELTAS[actions] + WIND_DELTAS[rows[:,2]]*windy
+		new_coordinates, stuck = env.move(rows[:,3:5], delta, env.obstacles_at(t_prime))
+		if np.any(stuck):
+			print 'There is an obstacle for every transition!!!'
+			sys.exit()
+
+		goal_1 = np.all(new_coordinates == env.goal_1_coordinates, axis=1)
+		goal_2 = np.all(new_coordinates == env.goal_2_coordinates, axis=1)
+		rewards = env.penalty*np.ones(len(rows))
+		rewards[goal_1] = env.goal_1_func(env.w1, t_prime[goal_1], env.p)
+		rewards[goal_2] = env.goal_2_func(env.w2, t_prime[goal_2], env.p)
+		terminals = goal_1 | goal_2
+
+		rows_prime = rows.copy()
+		rows_prime[:,0] = t_prime % L
+		rows_prime[:,1] = np.minimum(rows[:,1] + 1, history - 1)
+		rows_prime[:,3:5] = new_coordinates
+		rows_prime[:,5:] = rows[:,3:3+2*(history-1)]
+		if env.wind_w is None:
+			outcomes.append((p_wind*np.ones(len(rows)), rows_prime, rewards, terminals))
+			continue
+
+		# wind phase redrawn uniformly every wind_w steps
+		redraw = t_prime % env.wind_w == 0
+		for k in range(4):
+			rows_k = rows_prime.copy()
+			rows_k[redraw,2] = k
+			outcomes.append((p_wind*np.where(redraw, 0.25, 1.0 if k == 0 else 0.0), rows_k, rewards, terminals))
+
+	return outcomes
+
+def exact_evaluate(policy, env, policy_type, recurrent=False, start=(0,5), history=3, max_period=10000):
+	# expected total reward and expected step count of the greedy policy from start, computed exactly over the finite
+	# state space of env instead of by rollouts. the states reachable under the policy are enumerated breadth first,
+	# the policy is queried once per frontier in a single batched act, and the expected values solve (I - P) v = r.
+	# policy_type as in greedy_evaluate. returns expected total reward, expected step count and number of states
+	if recurrent:
+		raise ValueError('The hidden state of a recurrent policy is not a finite state, use greedy_evaluate')
+	L = env.time_period(max_period)
+	if L is None:
+		raise ValueError('Environment is not periodic in time, there is no finite state space')
+	if policy_type == 3:
+		history = 1 # the random policy does not look at the states
+
+	n_k = 4 if env.wind_w is not None else 1 # wind phase drawn at reset
+	start_rows = np.zeros((n_k, 3 + 2*history), dtype=np.int64)
+	start_rows[:,2] = np.arange(n_k)
+	start_rows[:,3:] = np.tile(start, history)
+	start_keys = encode(env, L, history, start_rows)
+
+	visited = np.unique(start_keys)
+	frontier = visited
+	src, dst, edge_p = [], [], []
+	reward_src, reward_val = [], []
+	terminal_src = []
+	while len(frontier) > 0:
+		rows = decode(env, L, history, frontier)
+		if policy_type == 3:
+			choices = [(0.2, np.full(len(rows), a, dtype=np.int64)) for a in range(len(ACTION_DELTAS))]
+		else:
+			choices = [(1.0, greedy_actions(policy, env, policy_type, rows, history))]
+
+		reached = []
+		for p_a, actions in choices:
+			for probs, rows_prime, rewards, terminals in successors(env, L, history, rows, actions):
+				probs = p_a*probs
+				keep = probs > 0
+				reward_src.append(frontier[keep])
+				reward_val.append(probs[keep]*rewards[keep])
+				terminal_src.append(frontier[keep & terminals])
+				keep &= ~terminals
+				src.append(frontier[keep])
+				dst.append(encode(env, L, history, rows_prime[keep]))
+				edge_p.append(probs[keep])
+				reached.append(dst[-1])
+
+		frontier = np.setdiff1d(np.concatenate(reached), visited)
+		visited = np.union1d(visited, frontier)
+
+	n = len(visited)
+	P = sp.csr_matrix((np.concatenate(edge_p), (np.searchsorted(visited, np.concatenate(src)), np.searchsorted(visited, np.concatenate(dst)))), shape=(n, n))
+	r = np.bincount(np.searchsorted(visited, np.concatenate(reward_src)), weights=np.concatenate(reward_val), minlength=n)
+	s0 = np.searchsorted(visited, start_keys)
+
+	# every reachable state has to be able to terminate, otherwise the expected step count is infinite
+	terminates = np.zeros(n, dtype=np.bool_)
+	terminates[np.searchsorted(visited, np.concatenate(terminal_src))] = True
+	while True:
+		terminates_new = terminates | (P.dot(terminates.astype(np.float64)) > 0)
+		if np.array_equal(terminates_new, terminates):
+			break
+		terminates = terminates_new
+	if not np.all(terminates):
+		print 'Policy never terminates from', np.sum(~terminates), 'of', n, 'reachable states'
+		return float('nan'), float('inf'), n
+
+	# one factorization for both right hand sides
+	lu = spla.splu((sp.identity(n, format='csr') - P).tocsc())
+	value = lu.solve(r)
+	length = lu.solve(np.ones(n))
+	return np.mean(value[s0]), np.mean(length[s0]), n
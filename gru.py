@@ -5,9 +5,10 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.nn.init as init
+from inference import QNetwork
 
 
-class GRU(nn.Module):
+class GRU(QNetwork, nn.Module):
 	def __init__(self, input_size, output_size, hidden_size, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0):
 		super(GRU, self).__init__()
 
@@ -46,8 +47,49 @@ class GRU(nn.Module):
 
 		return self.scale*o
 
+	def forward_sequence(self, x, resets=None, hidden=None):
+		# x - [T, B, input_size] variable. runs all T steps in one call with a hidden state local to the call, self.h1/h2
+		# are not touched. hidden - list of initial [B, hidden_size] states per layer (zeros if None), resets - [T, B]
+		# numpy mask, the hidden rows are set back to the initial state before the steps where it is set (window starts).
+		# returns [T, B, output_size] q values and the final hidden states
+		T, B = x.size(0), x.size(1)
+		if hidden is None:
+			hidden = [Variable(x.data.new(B, self.hidden_size).zero_(), requires_grad=False) for _ in range(self.n_layers)]
+		h = list(hidden)
+		h_init = list(hidden)
+		cells = [self.gru1, self.gru2] if self.n_layers == 2 else [self.gru1]
+		keep = None
+		if resets is not None:
+			keep = Variable(torch.from_numpy(1 - np.asarray(resets, dtype=np.float32)), requires_grad=False).type_as(x).unsqueeze(2)
+
+		outputs = []
+		for t in range(T):
+			inp = x[t]
+			for n in range(self.n_layers):
+				if keep is not None:
+					h[n] = h[n]*keep[t] + h_init[n]*(1 - keep[t])
+				h[n] = cells[n](inp, h[n])
+				inp = h[n]
+			outputs.append(inp)
+
+		# output layer once for all steps
+		o = self.h2o(torch.stack(outputs, 0).view(T*B, self.hidden_size))
+		if self.tanh_flag:
+			o = F.tanh(o)
+		return self.scale*o.view(T, B, self.output_size), h
+
+	def truncate(self):
+		# truncated bptt boundary, call after backward(): detaches the hidden state so the following steps start a new graph
+		self.h1 = Variable(self.h1.data)
+		if self.n_layers == 2:
+			self.h2 = Variable(self.h2.data)
+
+	def hidden_state(self):
+		# copy of the current hidden state as a [n_layers, batch_size, hidden_size] array, e.g. to store in replay
+		return np.stack([h.data.cpu().numpy() for h in ([self.h1, self.h2] if self.n_layers == 2 else [self.h1])], 0)
+
 	def reset(self):
-		self.h1 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=True).type(self.dtype)
+		self.h1 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=not self.inference_mode, volatile=self.inference_mode).type(self.dtype)
 		if self.n_layers == 2:
-			self.h2 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=True).type(self.dtype)
+			self.h2 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=not self.inference_mode, volatile=self.inference_mode).type(self.dtype)
 
@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+class QNetwork(object):
+	# acting / greedy evaluation for the q networks, mixed in before nn.Module. inference(True) switches to eval mode:
+	# act() builds no autograd graph, phase networks read their phase cache and recurrent networks reset() to hidden
+	# states without grad. attributes set after construction have class level defaults so checkpoints saved before
+	# they existed still load
+	inference_mode = False
+	input_buffer = None
+
+	def inference(self, flag=True):
+		self.inference_mode = flag
+		self.train(not flag)
+		return self
+
+	def input_shape(self):
+		# shape act() reshapes its rows to
+		return (-1, self.input_size)
+
+	def as_variable(self, x):
+		# x is copied into a reused input buffer and wrapped as a volatile variable so no graph is built
+		x = np.asarray(x, dtype=np.float32).reshape(self.input_shape())
+		if self.input_buffer is None or tuple(self.input_buffer.size()) != x.shape:
+			self.input_buffer = next(self.parameters()).data.new(*x.shape)
+		self.input_buffer.copy_(torch.from_numpy(x))
+		return Variable(self.input_buffer, volatile=True)
+
+	def weights_updated(self):
+		pass
+
+	def watch(self, optimizer):
+		# wraps optimizer.step so every step is followed by weights_updated(), returns the optimizer
+		step = optimizer.step
+		def watched_step(*args, **kwargs):
+			result = step(*args, **kwargs)
+			self.weights_updated()
+			return result
+		optimizer.step = watched_step
+		return optimizer
+
+	def q_values(self, x, phase):
+		return self.forward(x)
+
+	def act(self, x, phase=None):
+		# q values (numpy) for one observation or a batch of rows
+		return self.q_values(self.as_variable(x), phase).data.cpu().numpy()
+
+	def reset(self):
+		pass
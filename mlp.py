@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import torch.nn.init as init
+from inference import QNetwork
 
 
 def init_fanin(tensor):
@@ -12,7 +13,7 @@ def init_fanin(tensor):
 	v = 1.0 / np.sqrt(fanin)
 	init.uniform(tensor, -v, v)
 
-class MLP(nn.Module):
+class MLP(QNetwork, nn.Module):
 	def __init__(self, input_size, output_size, hidden_size, n_layers=1, scale=1.0, tanh_flag=0):
 		super(MLP, self).__init__()
 
@@ -49,6 +50,3 @@ class MLP(nn.Module):
 				o = self.h2o(h0)
 
 		return self.scale*o
-
-	def reset(self):
-		pass
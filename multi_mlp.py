@@ -0,0 +1,143 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+from mlp import MLP
+from phase_mlp import PMLP, spline_coefficients
+from inference import QNetwork
+
+# n_models independent networks of the same shape with their weights stacked along a leading model dimension, so K
+# seeds train in one process with batched matmuls. inputs are (n_models, batch, input_size). the loss has to be a sum
+# of per model losses, then the gradient of every model slice is its own one and elementwise optimizers like Adam
+# keep independent state per model. model(k) returns model k as a plain MLP / PMLP, e.g. for greedy_evaluate
+
+
+def init_uniform(tensor, v):
+	tensor.uniform_(-v, v)
+
+def stacked_linear(x, weight, bias):
+	# x (K, B, in). weight (K, out, in) and bias (K, out) shared by the rows of a model, or one per row, (K, B, out, in)
+	# and (K, B, out)
+	if weight.dim() == 4:
+		K, B = x.size(0), x.size(1)
+		return torch.bmm(weight.view(K*B, weight.size(2), weight.size(3)), x.contiguous().view(K*B, -1, 1)).view(K, B, -1) + bias
+	return torch.bmm(x, weight.transpose(1, 2)) + bias.unsqueeze(1)
+
+
+class MultiMLP(QNetwork, nn.Module):
+	# act() takes (K, B, input_size) rows and returns (K, B, output_size) q values
+	def __init__(self, n_models, input_size, output_size, hidden_size, n_layers=1):
+		super(MultiMLP, self).__init__()
+		self.n_models = n_models
+		self.input_size = input_size
+		self.output_size = output_size
+		self.hidden_size = hidden_size
+		self.n_layers = n_layers
+
+		# same initialization as MLP for every model
+		sizes = [input_size] + [hidden_size]*n_layers + [output_size]
+		for n in range(n_layers + 1):
+			weight = torch.zeros(n_models, sizes[n+1], sizes[n])
+			bias = torch.zeros(n_models, sizes[n+1])
+			v = 3e-3 if n == n_layers else 1.0/np.sqrt(sizes[n])
+			init_uniform(weight, v)
+			init_uniform(bias, v)
+			self.register_parameter('weight_' + str(n), nn.Parameter(weight))
+			self.register_parameter('bias_' + str(n), nn.Parameter(bias))
+
+	def layers(self):
+		return [(getattr(self, 'weight_' + str(n)), getattr(self, 'bias_' + str(n))) for n in range(self.n_layers + 1)]
+
+	def forward(self, x):
+		layers = self.layers()
+		h = x
+		for weight, bias in layers[:-1]:
+			h = F.relu(stacked_linear(h, weight, bias))
+		return stacked_linear(h, *layers[-1])
+
+	def input_shape(self):
+		return (self.n_models, -1, self.input_size)
+
+	def model(self, k):
+		mlp = MLP(self.input_size, self.output_size, self.hidden_size, n_layers=self.n_layers)
+		modules = [mlp.l1] + ([mlp.l2] if self.n_layers == 2 else []) + [mlp.h2o]
+		for module, (weight, bias) in zip(modules, self.layers()):
+			module.weight.data.copy_(weight.data[k])
+			module.bias.data.copy_(bias.data[k])
+		return mlp
+
+	def set_model(self, k, mlp):
+		# inverse of model(k)
+		modules = [mlp.l1] + ([mlp.l2] if self.n_layers == 2 else []) + [mlp.h2o]
+		for module, (weight, bias) in zip(modules, self.layers()):
+			weight.data[k].copy_(module.weight.data)
+			bias.data[k].copy_(module.bias.data)
+
+
+class MultiPMLP(QNetwork, nn.Module):
+	# phase networks, every weight stacked as (K, 4, ...) control points. phases are (K, B), one per row
+	def __init__(self, n_models, input_size, output_size, hidden_size, n_layers=1):
+		super(MultiPMLP, self).__init__()
+		self.n_models = n_models
+		self.input_size = input_size
+		self.output_size = output_size
+		self.hidden_size = hidden_size
+		self.n_layers = n_layers
+
+		# same initialization as PMLP for every model and control point
+		sizes = [input_size] + [hidden_size]*n_layers + [output_size]
+		for n in range(n_layers + 1):
+			weight = torch.zeros(n_models, 4, sizes[n+1], sizes[n])
+			bias = torch.zeros(n_models, 4, sizes[n+1])
+			v = 3e-3 if n == n_layers else 1.0/np.sqrt(sizes[n])
+			init_uniform(weight, v)
+			init_uniform(bias, v)
+			self.register_parameter('weight_' + str(n), nn.Parameter(weight))
+			self.register_parameter('bias_' + str(n), nn.Parameter(bias))
+
+	def control_points(self):
+		return [(getattr(self, 'weight_' + str(n)), getattr(self, 'bias_' + str(n))) for n in range(self.n_layers + 1)]
+
+	def interpolate(self, phases):
+		# (K, B, ...) weights of every layer at the phases, blended through autograd
+		phases = np.asarray(phases)
+		K, B = phases.shape
+		coef = Variable(torch.from_numpy(spline_coefficients(phases.reshape(-1)).reshape(K, B, 4)), requires_grad=False).type_as(self.weight_0)
+		layers = []
+		for weight, bias in self.control_points():
+			layers.append((torch.bmm(coef, weight.view(K, 4, -1)).view(*((K, B) + tuple(weight.size()[2:]))), torch.bmm(coef, bias)))
+		return layers
+
+	def forward(self, x, phases):
+		# phases (K, B), or a single phase for all rows: then one interpolation per model and the rows share the weights
+		if np.ndim(phases) == 0:
+			layers = [(weight[:,0], bias[:,0]) for weight, bias in self.interpolate(np.full((self.n_models, 1), float(phases)))]
+		else:
+			layers = self.interpolate(phases)
+		h = x
+		for weight, bias in layers[:-1]:
+			h = F.relu(stacked_linear(h, weight, bias))
+		return stacked_linear(h, *layers[-1])
+
+	def input_shape(self):
+		return (self.n_models, -1, self.input_size)
+
+	def q_values(self, x, phase):
+		if np.ndim(phase) > 0:
+			phase = np.asarray(phase).reshape(self.n_models, -1)
+		return self.forward(x, phase)
+
+	def model(self, k):
+		pmlp = PMLP(self.input_size, self.output_size, self.hidden_size, n_layers=self.n_layers)
+		layers = pmlp.control_hidden_list + [pmlp.control_h2o_list]
+		for controls, (weight, bias) in zip(layers, self.control_points()):
+			for c, module in enumerate(controls):
+				module.weight.data.copy_(weight.data[k,c])
+				module.bias.data.copy_(bias.data[k,c])
+		return pmlp
+
+	def set_model(self, k, pmlp):
+		for (weight, bias), (control_weight, control_bias) in zip(self.control_points(), pmlp.control_points()):
+			weight.data[k].copy_(control_weight.data)
+			bias.data[k].copy_(control_bias.data)
@@ -0,0 +1,177 @@
+import sys
+import copy
+import numpy as np
+from multi_mlp import MultiMLP, MultiPMLP
+from replay import ArrayReplay
+from vec_env import varying_transition_env, varying_reward_env
+from evaluate import greedy_evaluate
+import torch
+import torch.optim as optim
+from torch.autograd import Variable
+
+# trains n_seeds independent runs of varying_transition_mlp.py / varying_reward_mlp.py in one process: env k of a
+# VecGridWorld, replay k and slice k of the stacked networks belong to seed k. every episode all seeds act until
+# their own episode ends, then one batched update. per seed plot files are the plot file name + '_seed<k>'
+# usage: python multi_seed_mlp.py policy_type plotfile checkpoint_prefix prob n_seeds [transition|reward]
+
+# output locations, the sweep runner points them at a per job directory
+PLOT_DIR = '/mnt/sdb1/arjun/plotfiles/'
+CHECKPOINT_DIR = '/mnt/sdb1/arjun/checkpoints/'
+
+
+def linear_decay(n, n_episodes, low=0.1, high=0.9):
+	# epsilon of epsilon_greedy_linear_decay in the scripts
+	if n <= n_episodes:
+		return ((low-high)/n_episodes)*n + high
+	return low
+
+def policy_q(policy, policy_type, s, phase):
+	# (K, B, 5) q values for (K, B, state) inputs and (K, B) phases
+	if policy_type == 0:
+		return policy.act(s)
+	elif policy_type == 1:
+		return policy.act(np.concatenate((s, phase[:,:,None]), axis=2))
+	elif policy_type == 2:
+		return policy.act(s, phase)
+
+def run_episodes(env, policy, memories, policy_type, eps, history=3):
+	# one episode per env from random starts, transitions go to the replay of their env. policy None acts randomly.
+	# returns per env total reward and step count
+	n = env.n_envs
+	env.reset()
+	frames = [env.states()]*history
+	total_rewards = np.zeros(n)
+	step_counts = np.zeros(n, dtype=int)
+	active = np.ones(n, dtype=np.bool_)
+	while np.any(active):
+		s = np.concatenate(frames, axis=1)
+		phase = env.phase()
+		a = np.random.randint(0, high=5, size=n)
+		if policy is not None:
+			greedy = np.argmax(policy_q(policy, policy_type, s[:,None,:], phase[:,None])[:,0], axis=1)
+			a = np.where(np.random.uniform(size=n) > eps, greedy, a)
+
+		states_prime, rewards, terminals, phases_prime, dones = env.step(a)
+		s_prime = np.concatenate(frames[1:] + [states_prime], axis=1)
+		for k in np.nonzero(active)[0]:
+			memories[k].add(s[k], a[k], rewards[k], s_prime[k], phase[k], phases_prime[k], terminals[k])
+		total_rewards += rewards*active
+		step_counts += active
+		active &= ~dones
+		frames = frames[1:] + [states_prime]
+
+	return total_rewards, step_counts
+
+def learn(policy, target_net, memories, policy_type, batch_size, env_type='transition', gamma=1):
+	# one minibatch from every seed's replay, the loss is the sum over seeds of their mean squared errors. the target
+	# is the one of the script env_type stands in for
+	samples = [M.sample(batch_size) for M in memories]
+	inp = np.stack([M.inp_arr_from_samples(x, policy_type) for M, x in zip(memories, samples)])
+	tar = np.stack([M.tar_arr_from_samples(x, policy_type) for M, x in zip(memories, samples)])
+	if policy_type == 0 or policy_type == 1:
+		outputs = policy.forward(Variable(torch.from_numpy(inp).float(), requires_grad=False))
+		q_prime = target_net.forward(Variable(torch.from_numpy(tar).float(), volatile=True))
+	elif policy_type == 2:
+		outputs = policy.forward(Variable(torch.from_numpy(inp[:,:,:-1]).float(), requires_grad=False), inp[:,:,-1])
+		q_prime = target_net.forward(Variable(torch.from_numpy(tar[:,:,:-1]).float(), volatile=True), tar[:,:,-1])
+
+	# bellman backup on the taken actions, other actions keep the current estimate
+	q_target = outputs.data.clone()
+	actions = torch.from_numpy(np.stack([x.actions for x in samples])).long().unsqueeze(2)
+	rewards = torch.from_numpy(np.stack([x.rewards for x in samples])).float()
+	q_max = q_prime.data.max(2)[0].view(rewards.size())
+	if env_type == 'reward':
+		# as varying_reward_mlp.py: gamma on the reward too and no terminal mask
+		new_values = gamma*(rewards + q_max)
+	else:
+		not_terminal = torch.from_numpy(1 - np.stack([x.terminals for x in samples]).astype(np.float32))
+		new_values = rewards + gamma*q_max*not_terminal
+	q_target.scatter_(2, actions, new_values.unsqueeze(2))
+
+	targets = Variable(q_target, requires_grad=False)
+	loss = ((outputs - targets)**2).mean(2).mean(1).sum()
+	loss.backward()
+
+def main():
+	max_episode_length = 600
+	n_episodes = 50000
+	n_copy_after = 1000
+	burn_in = 1000
+	policy_type = int(sys.argv[1])
+	probab = float(sys.argv[4])
+	n_seeds = int(sys.argv[5])
+	env_type = sys.argv[6] if len(sys.argv) > 6 else 'transition'
+	batch_size = 32
+
+	if env_type == 'transition':
+		env = varying_transition_env(n_seeds, probab, max_episode_length=max_episode_length, auto_reset=False)
+	else:
+		env = varying_reward_env(n_seeds, max_episode_length=max_episode_length, auto_reset=False)
+	frame_size = env.states().shape[1]
+	memories = [ArrayReplay(max_memory_size=10000, state_size=frame_size*3) for k in range(n_seeds)]
+
+	if policy_type == 0: # mlp without phase
+		policy = MultiMLP(n_seeds, input_size=frame_size*3, output_size=5, hidden_size=16, n_layers=2)
+	elif policy_type == 1: # mlp with phase as additional input
+		policy = MultiMLP(n_seeds, input_size=frame_size*3+1, output_size=5, hidden_size=16, n_layers=2)
+	elif policy_type == 2:
+		policy = MultiPMLP(n_seeds, input_size=frame_size*3, output_size=5, hidden_size=16, n_layers=2)
+
+	target_net = copy.deepcopy(policy)
+	optimizer = optim.Adam(policy.parameters(), lr=0.0001)
+
+	#Burn in with random policy
+	for i in range(burn_in):
+		run_episodes(env, None, memories, policy_type, 1.0)
+	print 'Burn in completed'
+
+	files = []
+	for k in range(n_seeds):
+		filename = PLOT_DIR + sys.argv[2] + '_seed' + str(k)
+		print 'Writing to ' + filename
+		files.append(open(filename,'w'))
+
+	list_of_total_rewards = []
+	list_of_n_episodes = []
+	for i in range(n_episodes):
+		policy.inference(True)
+		total_rewards, step_counts = run_episodes(env, policy, memories, policy_type, linear_decay(i, 25000))
+		policy.inference(False)
+
+		list_of_total_rewards.append(total_rewards)
+		list_of_n_episodes.append(step_counts)
+		if i % 500 == 0 and i > 0:
+			print str(i) + ': Avg. Reward per seed: ' + str(np.mean(list_of_total_rewards[i-500:i], axis=0)) + ' Avg. Episode length per seed: ' + str(np.mean(list_of_n_episodes[i-500:i], axis=0))
+
+		# write to file for plotting
+		for f, total_reward, n_steps in zip(files, total_rewards, step_counts):
+			f.write(str(total_reward) + ' ' + str(n_steps) + '\n')
+
+		# save policy
+		if i % 1000 == 0 and i> 0:
+			checkpoint_name = CHECKPOINT_DIR + sys.argv[3] + '_' + str(i) + '.pth'
+			f_w = open(checkpoint_name, 'wb')
+			torch.save(policy,f_w)
+
+		optimizer.zero_grad()
+		learn(policy, target_net, memories, policy_type, batch_size, env_type=env_type)
+		optimizer.step()
+
+		# copy into target network
+		if i % n_copy_after == 0 and i > 0:
+			target_net = copy.deepcopy(policy)
+
+	# testing with greedy policy, every seed on its own
+	print 'Using greedy policy ...'
+	for k in range(n_seeds):
+		model = policy.model(k).inference(True)
+		if env_type == 'transition':
+			test_env = varying_transition_env(1000, probab, max_episode_length=max_episode_length)
+		else:
+			test_env = varying_reward_env(1000, max_episode_length=max_episode_length)
+		total_rewards, step_counts = greedy_evaluate(model, test_env, policy_type, max_steps=max_episode_length)
+		print 'Seed ' + str(k) + ': Avg. Reward: ' + str(np.mean(total_rewards)) + ' Avg. Episode length: ' + str(np.mean(step_counts))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import numpy as np
+from itertools import product
+from vec_env import ACTION_DELTAS, TABLE_CACHE_DIR
+from exact_evaluate import successors, exact_evaluate
+
+
+class ValueIterationOracle():
+	# optimal Q* of a VecGridWorld by vectorized value iteration over the markov state (t % L, wind phase, x, y),
+	# L = env.time_period(). the frame history of the mlp policies is not needed, Q* depends on the markov state only.
+	# results are saved under cache_dir keyed on the environment config, so every checkpoint of a run reuses them
+	def __init__(self, env, gamma=1.0, tol=1e-6, max_iterations=10000, cache_dir=TABLE_CACHE_DIR, max_period=10000):
+		self.env = env
+		self.gamma = gamma
+		self.L = env.time_period(max_period)
+		if self.L is None:
+			raise ValueError('Environment is not periodic in time, there is no finite state space')
+		self.n_k = 4 if env.wind_w is not None else 1
+		self.shape = (self.L, self.n_k, env.width, env.height)
+
+		path = None if cache_dir is None else os.path.join(cache_dir, 'oracle_' + self.key(tol) + '.npy')
+		if path is not None and os.path.exists(path):
+			self.q = np.load(path)
+		else:
+			self.q = self.value_iteration(tol, max_iterations)
+			if path is not None:
+				if not os.path.isdir(cache_dir):
+					os.makedirs(cache_dir)
+				np.save(path, self.q)
+		self.v = self.q.max(axis=-1)
+
+	def key(self, tol):
+		env = self.env
+		t = np.arange(0, self.L + 1)
+		goal_rewards = (env.goal_1_func(env.w1, t, env.p).tolist(), env.goal_2_func(env.w2, t, env.p).tolist())
+		config = (env.width, env.height, env.obstacles.tolist(), env.offsets.tolist(), env.wind_w, env.wind_prob, env.w1, env.w2, env.p, env.penalty, env.goal_1_coordinates.tolist(), env.goal_2_coordinates.tolist(), goal_rewards, self.L, self.gamma, tol)
+		return hashlib.md5(repr(config).encode('ascii')).hexdigest()
+
+	def index(self, rows):
+		# flat state index of [t % L, depth, wind phase, x, y] rows
+		return np.ravel_multi_index((rows[:,0], rows[:,2], rows[:,3], rows[:,4]), self.shape)
+
+	def value_iteration(self, tol, max_iterations):
+		rows = np.array([(t, 0, k, x, y) for t, k, x, y in product(*[range(d) for d in self.shape])])
+		n = len(rows)
+
+		# every outcome of every action as (action, probabilities, next state, reward, continue) arrays over the states
+		outcomes = []
+		for a in range(len(ACTION_DELTAS)):
+			for probs, rows_prime, rewards, terminals in successors(self.env, self.L, 1, rows, np.full(n, a, dtype=np.int64)):
+				outcomes.append((a, probs, self.index(rows_prime), rewards, ~terminals))
+
+		v = np.zeros(n)
+		for _ in range(max_iterations):
+			q = np.zeros((n, len(ACTION_DELTAS)))
+			for a, probs, idx, rewards, not_terminal in outcomes:
+				q[:,a] += probs*(rewards + self.gamma*not_terminal*v[idx])
+			v_new = q.max(axis=1)
+			if np.max(np.abs(v_new - v)) < tol:
+				break
+			v = v_new
+		else:
+			print 'Value iteration did not converge in', max_iterations, 'iterations'
+
+		return q.reshape(self.shape + (len(ACTION_DELTAS),))
+
+	def q_values(self, t, wind_phase, coordinates):
+		# (n, 5) optimal q values, t the episode timer, wind_phase the index k of phase k*pi/2 (ignored without wind)
+		k = wind_phase if self.n_k > 1 else np.zeros_like(t)
+		return self.q[np.asarray(t) % self.L, k, coordinates[:,0], coordinates[:,1]]
+
+	def optimal_actions(self, t, wind_phase, coordinates):
+		return np.argmax(self.q_values(t, wind_phase, coordinates), axis=1)
+
+	def action_regret(self, t, wind_phase, coordinates, actions):
+		# V* - Q*(s, a) of the taken actions, 0 for optimal ones
+		q = self.q_values(t, wind_phase, coordinates)
+		return q.max(axis=1) - q[np.arange(len(q)), actions]
+
+	def start_value(self, start=(0,5)):
+		# expected optimal total reward of an episode from start, averaged over the initial wind phase
+		return np.mean(self.v[0, :, start[0], start[1]])
+
+	def policy_regret(self, policy, policy_type, start=(0,5), history=3):
+		# V*(start) minus the exact expected total reward of a (non recurrent) greedy policy
+		return self.start_value(start) - exact_evaluate(policy, self.env, policy_type, start=start, history=history)[0]
@@ -0,0 +1,50 @@
+import math
+
+
+class PhaseCache():
+	# interpolated weight sets of a phase network keyed on phase (or on a phase bin for continuous phases).
+	# entries belong to one version of the weights: the network counts its weight changes (weights_updated) and a
+	# lookup with another version drops them, so a hit costs one dict lookup
+	def __init__(self, bins=None, max_entries=1024):
+		self.bins = bins # None - key on the exact phase, otherwise number of bins over [0, 2pi)
+		self.max_entries = max_entries
+		self.entries = {}
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, phase):
+		if self.bins is None:
+			return float(phase)
+		return int(round(((phase % (2*math.pi))/(2*math.pi))*self.bins)) % self.bins
+
+	def key_phase(self, key):
+		# phase the weights of an entry are computed at
+		if self.bins is None:
+			return key
+		return key*2*math.pi/self.bins
+
+	def lookup(self, phase, version, compute):
+		# version - weights version of the network, compute - function of a phase returning a dict of weights, called on
+		# a miss
+		if version != self.version:
+			self.entries = {}
+			self.version = version
+		key = self.key(phase)
+		if key in self.entries:
+			self.hits += 1
+			return self.entries[key]
+
+		self.misses += 1
+		if len(self.entries) >= self.max_entries:
+			self.entries = {}
+		self.entries[key] = compute(self.key_phase(key))
+		return self.entries[key]
+
+	def invalidate(self):
+		self.entries = {}
+		self.version = None
+
+	def info(self):
+		total = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'hit_rate': self.hits/float(total) if total > 0 else 0.0}
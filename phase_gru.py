@@ -5,13 +5,24 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.nn.init as init
+from phase_cache import PhaseCache
+from phase_mlp import PhaseNetwork, kn, spline_w, spline_coefficients, blend, linear, lowrank_linear, lowrank_factors
 
 
-def kn(p, n):
-	return int((math.floor((4*p)/(2*math.pi)) + n - 1) % 4)
+GRU_KEYS = ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']
 
-def spline_w(p):
-	return ((4*p)/(2*math.pi)) % 1
+def gru_gates(gi, gh, h):
+	# nn.GRUCell update from the input and hidden projections, (batch, 3*hidden_size) each
+	i_r, i_i, i_n = gi.chunk(3, 1)
+	h_r, h_i, h_n = gh.chunk(3, 1)
+	resetgate = F.sigmoid(i_r + h_r)
+	inputgate = F.sigmoid(i_i + h_i)
+	newgate = F.tanh(i_n + resetgate*h_n)
+	return newgate + inputgate*(h - newgate)
+
+def gru_cell(x, h, weight_ih, weight_hh, bias_ih, bias_hh):
+	# same update as nn.GRUCell, but with weights passed in
+	return gru_gates(linear(x, weight_ih, bias_ih), linear(h, weight_hh, bias_hh), h)
 	
 
 #class Alpha(object):
@@ -45,8 +56,8 @@ def spline_w(p):
 #		self._grad['weight'] = None
 #		self._grad['bias'] = None
 
-class PGRU(nn.Module):
-	def __init__(self, input_size, output_size, hidden_size, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0):
+class PGRU(PhaseNetwork, nn.Module):
+	def __init__(self, input_size, output_size, hidden_size, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0, stacked=False, cache=True, cache_bins=None):
 		super(PGRU, self).__init__()
 
 		self.input_size = input_size
@@ -57,6 +68,7 @@ class PGRU(nn.Module):
 		self.scale = scale
 		self.tanh_flag = tanh_flag
 		self.dtype = dtype
+		self.phase_cache = PhaseCache(bins=cache_bins) if cache else None # used for eval mode forwards, see cached_weights
 
 		self.control_gru_list = []
 		self.control_h2o_list = []
@@ -131,40 +143,146 @@ class PGRU(nn.Module):
 		if n_layers == 2:
 			self.h_1 = Variable(torch.zeros(batch_size, hidden_size), requires_grad=True).type(dtype)
 
+		if stacked:
+			self.stack_controls()
+
+	def stack_controls(self):
+		# replace the 4 control cells by a single (4, ...) parameter per weight. the spline blend then becomes part of the
+		# autograd graph and one backward() fills the control point gradients, no gru_list/update_control_gradients needed
+		for n in range(self.n_layers):
+			for key in GRU_KEYS:
+				self.register_parameter(key + '_' + str(n), nn.Parameter(torch.stack([gru._parameters[key].data for gru in self.control_gru_list[n]], 0)))
+		for key in ['weight', 'bias']:
+			self.register_parameter(key, nn.Parameter(torch.stack([h2o._parameters[key].data for h2o in self.control_h2o_list], 0)))
+
+		for name in list(self._modules.keys()):
+			del self._modules[name]
+		self.control_gru_list = []
+		self.control_h2o_list = []
+		self.stacked = True
+
+	def control_points(self):
+		# stacked (4, ...) control points: one [weight_ih, weight_hh, bias_ih, bias_hh] list per gru layer followed by h2o [weight, bias]
+		if self.stacked:
+			layers = [[getattr(self, key + '_' + str(n)) for key in GRU_KEYS] for n in range(self.n_layers)]
+			return layers + [[self.weight, self.bias]]
+
+		layers = [[torch.stack([gru._parameters[key] for gru in controls], 0) for key in GRU_KEYS] for controls in self.control_gru_list]
+		return layers + [[torch.stack([h2o._parameters[key] for h2o in self.control_h2o_list], 0) for key in ['weight', 'bias']]]
+
+	def interpolate(self, phases):
+		# same structure as control_points, every tensor with a leading len(phases) dimension
+		coef = Variable(torch.from_numpy(spline_coefficients(phases)), requires_grad=False).type(self.dtype)
+		return [[blend(coef, p) for p in layer] for layer in self.control_points()]
+
 	def forward(self,x,phase):
-		w = self.weight_from_phase(phase, self.control_gru_list, self.control_h2o_list)
-		grus = []
-		gru0 = nn.GRUCell(self.input_size, self.hidden_size)
-		grus.append(gru0)
-		h2o = nn.Linear(self.hidden_size, self.output_size)
-		if self.n_layers == 2:
-			gru1 = nn.GRUCell(self.hidden_size, self.hidden_size)
-			grus.append(gru1)
+		if not self.training:
+			# acting / evaluation - blend into the persistent weight buffers, nothing is recorded for update_control_gradients
+			if self.phase_cache is not None:
+				return self.step(x, self.layers_from_weights(self.phase_cache.lookup(phase, self.weights_version, self.cached_weights)))
+			return self.step(x, self.layers_from_weights(self.interpolate_into_buffers(phase)))
+
+		if self.stacked:
+			return self.step(x, [[p[0] for p in layer] for layer in self.interpolate([phase])])
+
+		# interpolated weights are leaf variables from the step buffers (no modules are built) so update_control_gradients
+		# can read their grads
+		w = self.step_weights(phase)
+		grus = [dict((key, w[key + '_' + str(n)]) for key in GRU_KEYS) for n in range(self.n_layers)]
+		h2o = {'weight': w['weight'], 'bias': w['bias']}
 
-		self.set_weight(w, grus, h2o)	
 		self.gru_list.append(grus)
 		self.h2o_list.append(h2o)
 		self.phase_list.append(phase)
 
-		self.h_0 = gru0(x, self.h_0)
+		return self.step(x, [[gru[key] for key in GRU_KEYS] for gru in grus] + [[h2o['weight'], h2o['bias']]])
+
+	def forward_batch(self, x, phases):
+		# one time step where every row of x (and of the hidden state) has its own phase, e.g. parallel evaluation episodes
+		return self.step(x, self.interpolate(phases))
+
+	def forward_sequence(self, x, phases, resets=None, hidden=None):
+		# x - [T, B, input_size] variable, phases - [T, B] numpy, one phase per step of every sequence. runs all T steps in
+		# one call with a hidden state local to the call, self.h_0/h_1 are not touched. hidden - list of initial
+		# [B, hidden_size] states per layer (zeros if None), resets - [T, B] numpy mask, the hidden rows are set back to the
+		# initial state before the steps where it is set. the weights of all T*B steps are interpolated through autograd,
+		# so backward() fills the control point gradients directly (no update_control_gradients).
+		# returns [T, B, output_size] q values and the final hidden states
+		T, B = x.size(0), x.size(1)
+		if hidden is None:
+			hidden = [Variable(x.data.new(B, self.hidden_size).zero_(), requires_grad=False) for _ in range(self.n_layers)]
+		h = list(hidden)
+		h_init = list(hidden)
+		layers = [[p.view(*((T, B) + tuple(p.size()[1:]))) for p in layer] for layer in self.interpolate(np.asarray(phases).reshape(-1))]
+		keep = None
+		if resets is not None:
+			keep = Variable(torch.from_numpy(1 - np.asarray(resets, dtype=np.float32)), requires_grad=False).type_as(x).unsqueeze(2)
+
+		outputs = []
+		for t in range(T):
+			inp = x[t]
+			for n in range(self.n_layers):
+				if keep is not None:
+					h[n] = h[n]*keep[t] + h_init[n]*(1 - keep[t])
+				h[n] = gru_cell(inp, h[n], *[p[t] for p in layers[n]])
+				inp = h[n]
+			outputs.append(inp)
+
+		# output layer once for all steps
+		weight, bias = layers[-1]
+		o = linear(torch.stack(outputs, 0).view(T*B, self.hidden_size), weight.contiguous().view(T*B, self.output_size, self.hidden_size), bias.contiguous().view(T*B, self.output_size))
+		if self.tanh_flag:
+			o = F.tanh(o)
+		return self.scale*o.view(T, B, self.output_size), h
+
+	def step(self, x, layers):
+		# one time step with the given per layer weights (see control_points for the layout)
+		self.h_0 = gru_cell(x, self.h_0, *layers[0])
+		h = self.h_0
 		if self.n_layers == 2:
-			self.h_1 = gru1(self.h_0, self.h_1)
-			if self.tanh_flag:
-				o = F.tanh(h2o(self.h_1))
-			else:
-				o = h2o(self.h_1)
-		else:
-			if self.tanh_flag:
-				o = F.tanh(h2o(self.h_0))
-			else:
-				o = h2o(self.h_0)
+			self.h_1 = gru_cell(self.h_0, self.h_1, *layers[1])
+			h = self.h_1
+
+		o = linear(h, *layers[-1])
+		if self.tanh_flag:
+			o = F.tanh(o)
 
 		return self.scale*o
 
+	def weight_keys(self):
+		# same naming as weight_from_phase
+		return [key + '_' + str(n) for n in range(self.n_layers) for key in GRU_KEYS] + ['weight', 'bias']
+
+	def layers_from_weights(self, w):
+		return [[w[key + '_' + str(n)] for key in GRU_KEYS] for n in range(self.n_layers)] + [[w['weight'], w['bias']]]
+
+	def control_tensors(self):
+		# (key, [4 control point tensors]) for every interpolated weight
+		if self.stacked:
+			return [(key, [getattr(self, key).data[k] for k in range(4)]) for key in self.weight_keys()]
+
+		controls = [(key + '_' + str(n), [gru._parameters[key].data for gru in self.control_gru_list[n]]) for n in range(self.n_layers) for key in GRU_KEYS]
+		return controls + [(key, [h2o._parameters[key].data for h2o in self.control_h2o_list]) for key in ['weight', 'bias']]
+
+	def truncate(self):
+		# truncated bptt boundary, call after backward(): folds the gradients of the stored steps into the control points,
+		# frees them and detaches the hidden state so the following steps start a new graph
+		self.update_control_gradients()
+		self.gru_list = []
+		self.h2o_list = []
+		self.phase_list = []
+		self.h_0 = Variable(self.h_0.data)
+		if self.n_layers == 2:
+			self.h_1 = Variable(self.h_1.data)
+
+	def hidden_state(self):
+		# copy of the current hidden state as a [n_layers, batch_size, hidden_size] array, e.g. to store in replay
+		return np.stack([h.data.cpu().numpy() for h in ([self.h_0, self.h_1] if self.n_layers == 2 else [self.h_0])], 0)
+
 	def reset(self):
-		self.h_0 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=True).type(self.dtype)
+		self.h_0 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=not self.inference_mode, volatile=self.inference_mode).type(self.dtype)
 		if self.n_layers == 2:
-			self.h_1 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=True).type(self.dtype)
+			self.h_1 = Variable(torch.zeros(self.batch_size, self.hidden_size), requires_grad=not self.inference_mode, volatile=self.inference_mode).type(self.dtype)
 		
 		self.gru_list = []
 		self.h2o_list = []
@@ -186,20 +304,6 @@ class PGRU(nn.Module):
 		return weight
 
 
-	def set_weight(self, w, grus, h2o):
-		count = 0
-		for gru in grus:
-			gru._parameters['weight_ih'].data = w['weight_ih_' + str(count)]
-			gru._parameters['weight_hh'].data = w['weight_hh_' + str(count)]
-			gru._parameters['bias_ih'].data = w['bias_ih_' + str(count)]
-			gru._parameters['bias_hh'].data = w['bias_hh_' + str(count)]
-			count += 1
-			gru.type(self.dtype)
-
-		h2o._parameters['weight'].data = w['weight']
-		h2o._parameters['bias'].data = w['bias']
-		h2o.type(self.dtype)
-
 	#def init_controls(self, list_of_gru, list_of_h2o, alpha):
 	#	for i in range(len(alpha)):
 	#		for j in range(len(list_of_gru)):
@@ -227,20 +331,20 @@ class PGRU(nn.Module):
 			w = spline_w(phase)
 			count = 0
 			for gru in grus:
-				for key in gru._parameters.keys():
-					self.control_gru_list[count][kn(phase,0)]._parameters[key].grad.data += gru._parameters[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
-					self.control_gru_list[count][kn(phase,1)]._parameters[key].grad.data += gru._parameters[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
-					self.control_gru_list[count][kn(phase,2)]._parameters[key].grad.data += gru._parameters[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
-					self.control_gru_list[count][kn(phase,3)]._parameters[key].grad.data += gru._parameters[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
+				for key in gru.keys():
+					self.control_gru_list[count][kn(phase,0)]._parameters[key].grad.data += gru[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
+					self.control_gru_list[count][kn(phase,1)]._parameters[key].grad.data += gru[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
+					self.control_gru_list[count][kn(phase,2)]._parameters[key].grad.data += gru[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
+					self.control_gru_list[count][kn(phase,3)]._parameters[key].grad.data += gru[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
 				count += 1
 
 		for h2o, phase in zip(self.h2o_list, self.phase_list):
 			w = spline_w(phase)
-			for key in h2o._parameters.keys():
-				self.control_h2o_list[kn(phase,0)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
-				self.control_h2o_list[kn(phase,1)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
-				self.control_h2o_list[kn(phase,2)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
-				self.control_h2o_list[kn(phase,3)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
+			for key in h2o.keys():
+				self.control_h2o_list[kn(phase,0)]._parameters[key].grad.data += h2o[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
+				self.control_h2o_list[kn(phase,1)]._parameters[key].grad.data += h2o[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
+				self.control_h2o_list[kn(phase,2)]._parameters[key].grad.data += h2o[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
+				self.control_h2o_list[kn(phase,3)]._parameters[key].grad.data += h2o[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
 
 
 		#for i in range(len(self.control_gru_list)):
@@ -251,3 +355,129 @@ class PGRU(nn.Module):
 		#for alpha, h2o in zip(self.alpha, self.control_h2o_list):
 		#	for key in h2o._parameters.keys():
 		#		h2o._parameters[key].grad.data += alpha._grad[key]
+
+
+class LowRankPGRU(PGRU):
+	# PGRU whose 4 control cells share one base weight per gru / h2o weight and differ by rank `rank` factors,
+	# W_k = weight + u_k v_k^T (see lowrank_linear), biases keep 4 full control points. every step applies the shared
+	# base matmul once and only blends the (batch, 4*rank) factor activations, forward_sequence projects the inputs of
+	# all steps in one matmul. everything goes through autograd, truncate() only detaches the hidden state.
+	# control_points() gives the equivalent full control points
+	def __init__(self, input_size, output_size, hidden_size, rank=2, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0):
+		nn.Module.__init__(self)
+
+		self.input_size = input_size
+		self.output_size = output_size
+		self.hidden_size = hidden_size
+		self.rank = rank
+		self.n_layers = n_layers
+		self.batch_size = batch_size
+		self.scale = scale
+		self.tanh_flag = tanh_flag
+		self.dtype = dtype
+
+		# same ranges as the PGRU layers: nn.GRUCell uses 1/sqrt(hidden_size), h2o the nn.Linear default 1/sqrt(in)
+		# (the +-3e-3 h2o init in PGRU is commented out). u starts at zero so all control points start at the base weight
+		for suffix, out_size, in_size in self.factor_shapes():
+			v = 1.0/np.sqrt(in_size if suffix == '' else hidden_size)
+			self.register_parameter('weight' + suffix, nn.Parameter(torch.zeros(out_size, in_size).type(dtype).uniform_(-v, v)))
+			self.register_parameter('bias' + suffix, nn.Parameter(torch.zeros(4, out_size).type(dtype).uniform_(-v, v)))
+			self.register_parameter('u' + suffix, nn.Parameter(torch.zeros(out_size, 4*rank).type(dtype)))
+			self.register_parameter('v' + suffix, nn.Parameter(torch.zeros(in_size, 4*rank).type(dtype).uniform_(-1.0/np.sqrt(in_size), 1.0/np.sqrt(in_size))))
+
+		self.gru_list = []
+		self.h2o_list = []
+		self.phase_list = []
+		self.reset()
+
+	@staticmethod
+	def from_pgru(pgru, rank):
+		# low rank approximation of a trained PGRU, exact for rank >= min(out, in) of every weight
+		model = LowRankPGRU(pgru.input_size, pgru.output_size, pgru.hidden_size, rank=rank, dtype=pgru.dtype, n_layers=pgru.n_layers, batch_size=pgru.batch_size, scale=pgru.scale, tanh_flag=pgru.tanh_flag)
+		controls = pgru.control_points()
+		pairs = [pair for w_ih, w_hh, b_ih, b_hh in controls[:-1] for pair in [(w_ih, b_ih), (w_hh, b_hh)]] + [tuple(controls[-1])]
+		for (weight, bias, u, v), (control_weight, control_bias) in zip(model.factor_layers(), pairs):
+			for p, f in zip([weight, u, v], lowrank_factors(control_weight.data.cpu().numpy(), rank)):
+				p.data.copy_(torch.from_numpy(f))
+			bias.data.copy_(control_bias.data)
+		return model
+
+	def factor_shapes(self):
+		# (name suffix, out, in) of every low rank weight: ih and hh of every gru layer, then h2o
+		shapes = []
+		for n in range(self.n_layers):
+			shapes.append(('_ih_' + str(n), 3*self.hidden_size, self.input_size if n == 0 else self.hidden_size))
+			shapes.append(('_hh_' + str(n), 3*self.hidden_size, self.hidden_size))
+		return shapes + [('', self.output_size, self.hidden_size)]
+
+	def factor_layers(self):
+		return [tuple(getattr(self, key + suffix) for key in ['weight', 'bias', 'u', 'v']) for suffix, _, _ in self.factor_shapes()]
+
+	def coefficients(self, phases):
+		return Variable(torch.from_numpy(spline_coefficients(phases)), requires_grad=False).type_as(self.weight)
+
+	def forward(self, x, phase):
+		return self.factor_step(x, self.coefficients([phase]))
+
+	def forward_batch(self, x, phases):
+		return self.factor_step(x, self.coefficients(phases))
+
+	def factor_step(self, x, coef):
+		# one time step at the phases of coef
+		layers = self.factor_layers()
+		self.h_0 = gru_gates(lowrank_linear(x, coef, *layers[0]), lowrank_linear(self.h_0, coef, *layers[1]), self.h_0)
+		h = self.h_0
+		if self.n_layers == 2:
+			self.h_1 = gru_gates(lowrank_linear(self.h_0, coef, *layers[2]), lowrank_linear(self.h_1, coef, *layers[3]), self.h_1)
+			h = self.h_1
+
+		o = lowrank_linear(h, coef, *layers[-1])
+		if self.tanh_flag:
+			o = F.tanh(o)
+
+		return self.scale*o
+
+	def forward_sequence(self, x, phases, resets=None, hidden=None):
+		# same as PGRU.forward_sequence
+		T, B = x.size(0), x.size(1)
+		if hidden is None:
+			hidden = [Variable(x.data.new(B, self.hidden_size).zero_(), requires_grad=False) for _ in range(self.n_layers)]
+		h = list(hidden)
+		h_init = list(hidden)
+		coef = self.coefficients(np.asarray(phases).reshape(-1))
+		coef_t = coef.view(T, B, 4)
+		layers = self.factor_layers()
+		keep = None
+		if resets is not None:
+			keep = Variable(torch.from_numpy(1 - np.asarray(resets, dtype=np.float32)), requires_grad=False).type_as(x).unsqueeze(2)
+
+		# input projection of the first layer for all steps at once
+		gi = lowrank_linear(x.contiguous().view(T*B, -1), coef, *layers[0]).view(T, B, -1)
+		outputs = []
+		for t in range(T):
+			inp = x[t]
+			for n in range(self.n_layers):
+				if keep is not None:
+					h[n] = h[n]*keep[t] + h_init[n]*(1 - keep[t])
+				gates = gi[t] if n == 0 else lowrank_linear(inp, coef_t[t], *layers[2*n])
+				h[n] = gru_gates(gates, lowrank_linear(h[n], coef_t[t], *layers[2*n + 1]), h[n])
+				inp = h[n]
+			outputs.append(inp)
+
+		o = lowrank_linear(torch.stack(outputs, 0).view(T*B, self.hidden_size), coef, *layers[-1])
+		if self.tanh_flag:
+			o = F.tanh(o)
+		return self.scale*o.view(T, B, self.output_size), h
+
+	def control_points(self):
+		# full (4, ...) control points W_k = weight + u_k v_k^T, same layout as PGRU.control_points
+		r = self.rank
+		points = []
+		for weight, bias, u, v in self.factor_layers():
+			delta = torch.stack([torch.mm(u[:,k*r:(k+1)*r], v[:,k*r:(k+1)*r].t()) for k in range(4)], 0)
+			points.append((weight.unsqueeze(0) + delta, bias))
+		layers = [[points[2*n][0], points[2*n + 1][0], points[2*n][1], points[2*n + 1][1]] for n in range(self.n_layers)]
+		return layers + [list(points[-1])]
+
+	def update_control_gradients(self):
+		pass
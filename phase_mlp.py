@@ -5,13 +5,70 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.nn.init as init
+from phase_cache import PhaseCache
+from inference import QNetwork
 
 def kn(p, n):
 	return int((math.floor((4*p)/(2*math.pi)) + n - 1) % 4)
 
 def spline_w(p):
 	return ((4*p)/(2*math.pi)) % 1
-	
+
+def spline_coefficients(phases):
+	# catmull-rom weight of each of the 4 control points for every phase in phases. returns (n, 4) array
+	phases = np.asarray(phases, dtype=np.float64).reshape(-1)
+	segment = np.floor((4*phases)/(2*math.pi))
+	w = ((4*phases)/(2*math.pi)) % 1
+	rows = np.arange(phases.shape[0])
+	coef = np.zeros((phases.shape[0], 4))
+	coef[rows, ((segment - 1) % 4).astype(int)] = -0.5*w + w*w - 0.5*w*w*w
+	coef[rows, ((segment + 0) % 4).astype(int)] = 1 - 2.5*w*w + 1.5*w*w*w
+	coef[rows, ((segment + 1) % 4).astype(int)] = 0.5*w + 2*w*w - 1.5*w*w*w
+	coef[rows, ((segment + 2) % 4).astype(int)] = -0.5*w*w + 0.5*w*w*w
+	return coef
+
+def blend(coef, control):
+	# (n, 4) spline coefficients x (4, ...) stacked control points -> (n, ...)
+	return torch.mm(coef, control.view(4, -1)).view(*((coef.size(0),) + tuple(control.size()[1:])))
+
+def linear(x, weight, bias):
+	# weight is either shared (out, in) or one (out, in) per row of x, i.e. (batch, out, in)
+	if weight.dim() == 3:
+		return torch.bmm(weight, x.unsqueeze(2)).squeeze(2) + bias
+	return F.linear(x, weight, bias)
+
+def blend_into(buffers, controls, phase):
+	# overwrite every buffers[key] variable in place with the blend of its 4 control point tensors at phase
+	coef = spline_coefficients([phase])[0]
+	for key, c in controls:
+		buf = buffers[key].data
+		buf.zero_()
+		for k in range(4):
+			if coef[k] != 0:
+				buf.add_(float(coef[k]), c[k])
+	return buffers
+
+def lowrank_linear(x, coef, weight, bias, u, v):
+	# layer with low rank control points W_k = weight + u_k v_k^T, applied at the phases of coef ((batch, 4) or (1, 4)
+	# spline coefficients) without forming the blended weights: x weight^T + ((x v) * coef) u^T + coef bias.
+	# weight (out, in), bias (4, out), u (out, 4*rank), v (in, 4*rank), columns k*rank:(k+1)*rank belong to control point k
+	rank = u.size(1)//4
+	z = torch.mm(x, v).view(-1, 4, rank)*coef.unsqueeze(2)
+	return F.linear(x, weight) + torch.mm(z.view(-1, 4*rank), u.t()) + torch.mm(coef, bias)
+
+def lowrank_factors(control, rank):
+	# base weight (mean of the 4 (out, in) control points) and u, v of the best rank approximation of every control
+	# point's difference to it, numpy
+	base = control.mean(0)
+	u = np.zeros((control.shape[1], 4*rank), dtype=control.dtype)
+	v = np.zeros((control.shape[2], 4*rank), dtype=control.dtype)
+	for k in range(4):
+		U, S, Vt = np.linalg.svd(control[k] - base, full_matrices=False)
+		r = min(rank, len(S))
+		u[:,k*rank:k*rank+r] = U[:,:r]*S[:r]
+		v[:,k*rank:k*rank+r] = Vt[:r].T
+	return base, u, v
+
 
 #class Alpha(object):
 #	def __init__(self, n_layers=1):
@@ -43,8 +100,73 @@ def init_fanin(tensor):
 	init.uniform(tensor, -v, v)
 
 
-class PMLP(nn.Module):
-	def __init__(self, input_size, output_size, hidden_size, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0):
+class PhaseNetwork(QNetwork):
+	# parts shared by PMLP and PGRU, which provide control_tensors(), phase_list and forward / forward_batch
+	stacked = False
+	weight_buffers = None
+	step_buffers = None
+	phase_cache = None
+	weights_version = 0
+
+	def weights_updated(self):
+		# the phase cache keeps its entries only while this version stays the same. bumped by load_state_dict and, for an
+		# optimizer passed through watch(), after every optimizer.step(). weights changed in place any other way need a
+		# call by hand
+		self.weights_version += 1
+
+	def load_state_dict(self, state_dict, *args, **kwargs):
+		result = super(PhaseNetwork, self).load_state_dict(state_dict, *args, **kwargs)
+		self.weights_updated()
+		return result
+
+	def interpolate_into_buffers(self, phase):
+		# blend the control points for one phase in place into persistent weight buffers, allocation free after the first call
+		controls = self.control_tensors()
+		if self.weight_buffers is None:
+			self.weight_buffers = dict((key, Variable(c[0].clone(), requires_grad=False)) for key, c in controls)
+
+		return blend_into(self.weight_buffers, controls, phase)
+
+	def step_weights(self, phase):
+		# leaf variables with the weights of the next training step, blended in place into a pool with one set of buffers
+		# per step. the pool is reused from the first step after reset() / truncate(), so once it covers the episode
+		# length training steps allocate no weights. update_control_gradients reads their grads
+		controls = self.control_tensors()
+		if self.step_buffers is None:
+			self.step_buffers = []
+		step = len(self.phase_list)
+		if step == len(self.step_buffers):
+			self.step_buffers.append(dict((key, Variable(c[0].clone(), requires_grad=True)) for key, c in controls))
+
+		w = blend_into(self.step_buffers[step], controls, phase)
+		for v in w.values():
+			if v.grad is not None:
+				v.grad.data.zero_()
+		return w
+
+	def __getstate__(self):
+		# the buffers are scratch space, keep them out of checkpoints and deep copies
+		state = dict(self.__dict__)
+		state['weight_buffers'] = None
+		state['step_buffers'] = None
+		return state
+
+	def cached_weights(self, phase):
+		# private copy of the blended weights for the phase cache
+		return dict((key, Variable(w.data.clone(), requires_grad=False)) for key, w in self.interpolate_into_buffers(phase).items())
+
+	def q_values(self, x, phase):
+		# rows with different phases go through forward_batch, a single phase shared by all rows through the (cached)
+		# eval weights
+		if np.ndim(phase) > 0:
+			phase = np.asarray(phase)
+		if np.ndim(phase) > 0 and np.any(phase != phase[0]):
+			return self.forward_batch(x, phase)
+		return self.forward(x, phase if np.ndim(phase) == 0 else float(phase[0]))
+
+
+class PMLP(PhaseNetwork, nn.Module):
+	def __init__(self, input_size, output_size, hidden_size, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0, stacked=False, cache=True, cache_bins=None):
 		super(PMLP, self).__init__()
 
 		self.input_size = input_size
@@ -55,6 +177,7 @@ class PMLP(nn.Module):
 		self.scale = scale # scale output of actor from [-1,1] to range of action space [-scale,scale]. set to 1 for critic
 		self.tanh_flag = tanh_flag # 1 for actor, 0 for critic (since critic range need not be restricted to [-1,1])
                 self.dtype = dtype
+		self.phase_cache = PhaseCache(bins=cache_bins) if cache else None # used for eval mode forwards, see cached_weights
 
 		#self.control_gru_list = []
 		self.control_hidden_list = []
@@ -150,33 +273,88 @@ class PMLP(nn.Module):
 		#if n_layers == 2:
 		#	self.h_1 = Variable(torch.zeros(batch_size, hidden_size), requires_grad=True)
 
+		if stacked:
+			self.stack_controls()
+
+	def stack_controls(self):
+		# replace the 4 control layers by a single (4, ...) parameter per weight. the spline blend then becomes part of the
+		# autograd graph and one backward() fills the control point gradients, no hidden_list/update_control_gradients needed
+		for n in range(self.n_layers):
+			for key in ['weight', 'bias']:
+				self.register_parameter(key + '_' + str(n), nn.Parameter(torch.stack([l._parameters[key].data for l in self.control_hidden_list[n]], 0)))
+		for key in ['weight', 'bias']:
+			self.register_parameter(key, nn.Parameter(torch.stack([h2o._parameters[key].data for h2o in self.control_h2o_list], 0)))
+
+		for name in list(self._modules.keys()):
+			del self._modules[name]
+		self.control_hidden_list = []
+		self.control_h2o_list = []
+		self.stacked = True
+
 	def forward(self,x,phase):
-		w = self.weight_from_phase(phase, self.control_hidden_list, self.control_h2o_list)
-		hiddens = []
-		l0 = nn.Linear(self.input_size, self.hidden_size).type(self.dtype)
-		hiddens.append(l0)
-		h2o = nn.Linear(self.hidden_size, self.output_size).type(self.dtype)
-		if self.n_layers == 2:
-			l1 = nn.Linear(self.hidden_size, self.hidden_size).type(self.dtype)
-			hiddens.append(l1)
-
-		self.set_weight(w, hiddens, h2o)
+		if not self.training:
+			# acting / evaluation - blend into the persistent weight buffers, nothing is recorded for update_control_gradients
+			if self.phase_cache is not None:
+				return self.apply_layers(x, self.layers_from_weights(self.phase_cache.lookup(phase, self.weights_version, self.cached_weights)))
+			return self.apply_layers(x, self.layers_from_weights(self.interpolate_into_buffers(phase)))
+
+		if self.stacked:
+			return self.apply_layers(x, [(weight[0], bias[0]) for weight, bias in self.interpolate([phase])])
+
+		# interpolated weights are leaf variables from the step buffers (no modules are built) so update_control_gradients
+		# can read their grads
+		w = self.step_weights(phase)
+		hiddens = [{'weight': w['weight_' + str(n)], 'bias': w['bias_' + str(n)]} for n in range(self.n_layers)]
+		h2o = {'weight': w['weight'], 'bias': w['bias']}
+
 		self.hidden_list.append(hiddens)
 		self.h2o_list.append(h2o)
 		self.phase_list.append(phase)
 
-		h_0 = F.relu(l0(x))
-		if self.n_layers == 2:
-			h_1 = F.relu(l1(h_0))
-			if self.tanh_flag:
-				o = F.tanh(h2o(h_1))
-			else:
-				o = h2o(h_1)
-		else:
-			if self.tanh_flag:
-				o = F.tanh(h2o(h_0))
-			else:
-				o = h2o(h_0)
+		return self.apply_layers(x, [(l['weight'], l['bias']) for l in hiddens] + [(h2o['weight'], h2o['bias'])])
+
+	def forward_batch(self, x, phases):
+		# x - (batch, input_size), phases - one phase per row of x. interpolation is done through autograd so gradients
+		# land directly on the control points and update_control_gradients is not needed for this path
+		return self.apply_layers(x, self.interpolate(phases))
+
+	def control_points(self):
+		# (weight, bias) stacked as (4, ...) for every hidden layer followed by h2o
+		if self.stacked:
+			layers = [(getattr(self, 'weight_' + str(n)), getattr(self, 'bias_' + str(n))) for n in range(self.n_layers)]
+			return layers + [(self.weight, self.bias)]
+
+		layers = [(torch.stack([l.weight for l in controls], 0), torch.stack([l.bias for l in controls], 0)) for controls in self.control_hidden_list]
+		return layers + [(torch.stack([h2o.weight for h2o in self.control_h2o_list], 0), torch.stack([h2o.bias for h2o in self.control_h2o_list], 0))]
+
+	def interpolate(self, phases):
+		# per phase (weight, bias) of every layer, each with a leading len(phases) dimension
+		coef = Variable(torch.from_numpy(spline_coefficients(phases)), requires_grad=False).type(self.dtype)
+		return [(blend(coef, weight), blend(coef, bias)) for weight, bias in self.control_points()]
+
+	def weight_keys(self):
+		# same naming as weight_from_phase
+		return [key + '_' + str(n) for n in range(self.n_layers) for key in ['weight', 'bias']] + ['weight', 'bias']
+
+	def layers_from_weights(self, w):
+		return [(w['weight_' + str(n)], w['bias_' + str(n)]) for n in range(self.n_layers)] + [(w['weight'], w['bias'])]
+
+	def control_tensors(self):
+		# (key, [4 control point tensors]) for every interpolated weight
+		if self.stacked:
+			return [(key, [getattr(self, key).data[k] for k in range(4)]) for key in self.weight_keys()]
+
+		controls = [(key + '_' + str(n), [l._parameters[key].data for l in self.control_hidden_list[n]]) for n in range(self.n_layers) for key in ['weight', 'bias']]
+		return controls + [(key, [h2o._parameters[key].data for h2o in self.control_h2o_list]) for key in ['weight', 'bias']]
+
+	def apply_layers(self, x, layers):
+		h = x
+		for weight, bias in layers[:-1]:
+			h = F.relu(linear(h, weight, bias))
+
+		o = linear(h, *layers[-1])
+		if self.tanh_flag:
+			o = F.tanh(o)
 
 		return self.scale*o
 
@@ -206,16 +384,6 @@ class PMLP(nn.Module):
 		return weight
 
 
-	def set_weight(self, w, hiddens, h2o):
-		count = 0
-		for l in hiddens:
-			l._parameters['weight'].data = w['weight_' + str(count)]
-			l._parameters['bias'].data = w['bias_' + str(count)]
-			count += 1
-
-		h2o._parameters['weight'].data = w['weight']
-		h2o._parameters['bias'].data = w['bias']
-
 	#def init_controls(self, list_of_hidden, list_of_h2o, alpha):
 	#	for i in range(len(alpha)):
 	#		for j in range(len(list_of_hidden)):
@@ -239,20 +407,20 @@ class PMLP(nn.Module):
 			w = spline_w(phase)
 			count = 0
 			for l in hiddens:
-				for key in l._parameters.keys():
-					self.control_hidden_list[count][kn(phase,0)]._parameters[key].grad.data += l._parameters[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
-					self.control_hidden_list[count][kn(phase,1)]._parameters[key].grad.data += l._parameters[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
-					self.control_hidden_list[count][kn(phase,2)]._parameters[key].grad.data += l._parameters[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
-					self.control_hidden_list[count][kn(phase,3)]._parameters[key].grad.data += l._parameters[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
+				for key in l.keys():
+					self.control_hidden_list[count][kn(phase,0)]._parameters[key].grad.data += l[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
+					self.control_hidden_list[count][kn(phase,1)]._parameters[key].grad.data += l[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
+					self.control_hidden_list[count][kn(phase,2)]._parameters[key].grad.data += l[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
+					self.control_hidden_list[count][kn(phase,3)]._parameters[key].grad.data += l[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
 				count += 1
 
 		for h2o, phase in zip(self.h2o_list, self.phase_list):
 			w = spline_w(phase)
-			for key in h2o._parameters.keys():
-				self.control_h2o_list[kn(phase,0)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
-				self.control_h2o_list[kn(phase,1)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
-				self.control_h2o_list[kn(phase,2)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
-				self.control_h2o_list[kn(phase,3)]._parameters[key].grad.data += h2o._parameters[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
+			for key in h2o.keys():
+				self.control_h2o_list[kn(phase,0)]._parameters[key].grad.data += h2o[key].grad.data * (-0.5*w + w*w - 0.5*w*w*w)
+				self.control_h2o_list[kn(phase,1)]._parameters[key].grad.data += h2o[key].grad.data * (1 - 2.5*w*w + 1.5*w*w*w)
+				self.control_h2o_list[kn(phase,2)]._parameters[key].grad.data += h2o[key].grad.data * (0.5*w + 2*w*w - 1.5*w*w*w)
+				self.control_h2o_list[kn(phase,3)]._parameters[key].grad.data += h2o[key].grad.data * (-0.5*w*w + 0.5*w*w*w)
 
 
 		#for i in range(len(self.control_hidden_list)):
@@ -263,3 +431,89 @@ class PMLP(nn.Module):
 		#for alpha, h2o in zip(self.alpha, self.control_h2o_list):
 		#	for key in h2o._parameters.keys():
 		#		h2o._parameters[key].grad.data += alpha._grad[key]
+
+
+class LowRankPMLP(PMLP):
+	# PMLP whose 4 control points of every layer share one base weight and differ by rank `rank` factors,
+	# W_k = weight + u_k v_k^T (see lowrank_linear), biases keep 4 full control points. the base matmul is shared by
+	# all phases and only the (batch, 4*rank) factor activations are blended, so per row phases cost no per row
+	# weights. a layer has out*in + 4*out + 4*rank*(out + in) parameters against 4*(out*in + out) in a PMLP: the
+	# biases and factors stay per control point, so the saving grows with the layer size (input 10, 2 x 16 hidden,
+	# rank 2: 1276 parameters against 2132, 2.4x an MLP; it only nears 1x an MLP once out and in are well above 8*rank).
+	# everything goes through autograd, update_control_gradients is not needed. control_points() gives the
+	# equivalent full control points, so act / interpolate / MultiPMLP.set_model work as for a PMLP
+	def __init__(self, input_size, output_size, hidden_size, rank=2, dtype=torch.FloatTensor, n_layers=1, batch_size=1, scale=1.0, tanh_flag=0):
+		nn.Module.__init__(self)
+
+		self.input_size = input_size
+		self.output_size = output_size
+		self.hidden_size = hidden_size
+		self.rank = rank
+		self.n_layers = n_layers
+		self.batch_size = batch_size
+		self.scale = scale
+		self.tanh_flag = tanh_flag
+		self.dtype = dtype
+
+		# same ranges as PMLP, u starts at zero so all control points start at the base weight
+		sizes = [input_size] + [hidden_size]*n_layers + [output_size]
+		for n, suffix in enumerate(self.suffixes()):
+			v = 3e-3 if n == n_layers else 1.0/np.sqrt(sizes[n])
+			self.register_parameter('weight' + suffix, nn.Parameter(torch.zeros(sizes[n+1], sizes[n]).type(dtype).uniform_(-v, v)))
+			self.register_parameter('bias' + suffix, nn.Parameter(torch.zeros(4, sizes[n+1]).type(dtype).uniform_(-v, v)))
+			self.register_parameter('u' + suffix, nn.Parameter(torch.zeros(sizes[n+1], 4*rank).type(dtype)))
+			self.register_parameter('v' + suffix, nn.Parameter(torch.zeros(sizes[n], 4*rank).type(dtype).uniform_(-1.0/np.sqrt(sizes[n]), 1.0/np.sqrt(sizes[n]))))
+
+		self.hidden_list = []
+		self.h2o_list = []
+		self.phase_list = []
+
+	@staticmethod
+	def from_pmlp(pmlp, rank):
+		# low rank approximation of a trained PMLP, exact for rank >= min(out, in) of every layer
+		model = LowRankPMLP(pmlp.input_size, pmlp.output_size, pmlp.hidden_size, rank=rank, dtype=pmlp.dtype, n_layers=pmlp.n_layers, batch_size=pmlp.batch_size, scale=pmlp.scale, tanh_flag=pmlp.tanh_flag)
+		for (weight, bias, u, v), (control_weight, control_bias) in zip(model.factor_layers(), pmlp.control_points()):
+			for p, f in zip([weight, u, v], lowrank_factors(control_weight.data.cpu().numpy(), rank)):
+				p.data.copy_(torch.from_numpy(f))
+			bias.data.copy_(control_bias.data)
+		return model
+
+	def suffixes(self):
+		# parameter name suffix of every layer, hidden layers then h2o as in the stacked PMLP
+		return ['_' + str(n) for n in range(self.n_layers)] + ['']
+
+	def factor_layers(self):
+		return [tuple(getattr(self, key + suffix) for key in ['weight', 'bias', 'u', 'v']) for suffix in self.suffixes()]
+
+	def coefficients(self, phases):
+		return Variable(torch.from_numpy(spline_coefficients(phases)), requires_grad=False).type_as(self.weight)
+
+	def forward(self, x, phase):
+		return self.apply_factors(x, self.coefficients([phase]))
+
+	def forward_batch(self, x, phases):
+		return self.apply_factors(x, self.coefficients(phases))
+
+	def apply_factors(self, x, coef):
+		layers = self.factor_layers()
+		h = x
+		for layer in layers[:-1]:
+			h = F.relu(lowrank_linear(h, coef, *layer))
+
+		o = lowrank_linear(h, coef, *layers[-1])
+		if self.tanh_flag:
+			o = F.tanh(o)
+
+		return self.scale*o
+
+	def control_points(self):
+		# full (4, ...) control points W_k = weight + u_k v_k^T, same layout as PMLP.control_points
+		r = self.rank
+		layers = []
+		for weight, bias, u, v in self.factor_layers():
+			delta = torch.stack([torch.mm(u[:,k*r:(k+1)*r], v[:,k*r:(k+1)*r].t()) for k in range(4)], 0)
+			layers.append((weight.unsqueeze(0) + delta, bias))
+		return layers
+
+	def update_control_gradients(self):
+		pass
@@ -0,0 +1,470 @@
+import numpy as np
+import torch
+from collections import namedtuple
+
+# a sampled minibatch, every field an array with one row per transition
+Transitions = namedtuple('Transitions', ['states', 'actions', 'rewards', 'states_prime', 'phases', 'phases_prime', 'terminals'])
+# sampled windows, every field a [T, batch, ...] tensor (boolean fields as uint8). mask marks real (non padding) steps,
+# loss_mask the real steps after the burn-in, resets the first real step of every column and slots the replay slot of
+# every step (-1 on padding). hidden is the [n_layers, batch, hidden_size] recurrent state recorded at the first real
+# step, None if not stored
+Sequences = namedtuple('Sequences', ['states', 'actions', 'rewards', 'states_prime', 'phases', 'phases_prime', 'terminals', 'mask', 'loss_mask', 'resets', 'slots', 'hidden'])
+
+
+class ArrayReplay():
+	# fixed capacity ring buffer of transitions kept in preallocated arrays. add is O(1) and overwrites the oldest
+	# transition once full, sample returns contiguous arrays ready for torch.from_numpy
+	def __init__(self, max_memory_size, state_size, target_cache=False, dtype=np.float32):
+		self.max_memory_size = max_memory_size
+		self.state_size = state_size
+		self.target_cache = TargetCache(max_memory_size) if target_cache else None
+		self.states = np.zeros((max_memory_size, state_size), dtype=dtype)
+		self.states_prime = np.zeros((max_memory_size, state_size), dtype=dtype)
+		self.actions = np.zeros(max_memory_size, dtype=np.int64)
+		self.rewards = np.zeros(max_memory_size, dtype=dtype)
+		self.phases = np.zeros(max_memory_size, dtype=dtype)
+		self.phases_prime = np.zeros(max_memory_size, dtype=dtype)
+		self.terminals = np.zeros(max_memory_size, dtype=np.bool_)
+		self.oldest = 0 # next slot to write
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def add(self, state, action, reward, state_prime, phase, phase_prime, terminal):
+		i = self.oldest
+		self.states[i] = state
+		self.actions[i] = action
+		self.rewards[i] = reward
+		self.states_prime[i] = state_prime
+		self.phases[i] = phase
+		self.phases_prime[i] = phase_prime
+		self.terminals[i] = terminal
+		self.oldest = (self.oldest + 1) % self.max_memory_size
+		self.size = min(self.size + 1, self.max_memory_size)
+		if self.target_cache is not None:
+			self.target_cache.invalidate([i])
+		return i
+
+	def add_batch(self, states, actions, rewards, states_prime, phases, phases_prime, terminals):
+		# one row per transition, e.g. a step of a VecGridWorld. returns the slots written
+		idx = (self.oldest + np.arange(len(actions))) % self.max_memory_size
+		self.states[idx] = states
+		self.actions[idx] = actions
+		self.rewards[idx] = rewards
+		self.states_prime[idx] = states_prime
+		self.phases[idx] = phases
+		self.phases_prime[idx] = phases_prime
+		self.terminals[idx] = terminals
+		self.oldest = (self.oldest + len(actions)) % self.max_memory_size
+		self.size = min(self.size + len(actions), self.max_memory_size)
+		if self.target_cache is not None:
+			self.target_cache.invalidate(idx)
+		return idx
+
+	def sample_idx(self, n):
+		return np.random.randint(0, high=self.size, size=(n,))
+
+	def sample(self, n):
+		return self.get(self.sample_idx(n))
+
+	def sample_weighted(self, n):
+		# sample, slots and importance sampling weights (all 1 for uniform sampling)
+		idx = self.sample_idx(n)
+		return self.get(idx), idx, np.ones(n, dtype=np.float32)
+
+	def update_priorities(self, idx, td_errors):
+		# uniform sampling, nothing to update
+		pass
+
+	def get(self, idx):
+		return Transitions(self.states[idx], self.actions[idx], self.rewards[idx], self.states_prime[idx], self.phases[idx], self.phases_prime[idx], self.terminals[idx])
+
+	def inp_arr_from_samples(self, samples, policy_type):
+		# network input for the states of a sample, phase appended as last column for policy types 1 and 2
+		if policy_type == 0:
+			return samples.states
+		return np.concatenate((samples.states, samples.phases[:,None]), axis=1)
+
+	def tar_arr_from_samples(self, samples, policy_type):
+		# same for the next states
+		if policy_type == 0:
+			return samples.states_prime
+		return np.concatenate((samples.states_prime, samples.phases_prime[:,None]), axis=1)
+
+
+class FrameStackReplay(ArrayReplay):
+	# stores every frame once, in episode order, and rebuilds the stacked input (history frames) and next input from
+	# slot indices at sample time. the first frame of an episode is repeated to fill the history, like the scripts do.
+	# an episode of L steps takes L+1 slots: start_episode writes the first frame, each add writes the next frame
+	def __init__(self, max_memory_size, frame_size, history=3, target_cache=False, dtype=np.float32):
+		self.max_memory_size = max_memory_size
+		self.frame_size = frame_size
+		self.target_cache = TargetCache(max_memory_size) if target_cache else None
+		self.history = history
+		self.state_size = frame_size*history
+		self.frames = np.zeros((max_memory_size, frame_size), dtype=dtype)
+		self.depth = np.zeros(max_memory_size, dtype=np.int64) # steps since episode start, capped at history-1
+		self.has_transition = np.zeros(max_memory_size, dtype=np.bool_) # an action was taken from this frame and its next frame is stored
+		self.actions = np.zeros(max_memory_size, dtype=np.int64)
+		self.rewards = np.zeros(max_memory_size, dtype=dtype)
+		self.phases = np.zeros(max_memory_size, dtype=dtype)
+		self.phases_prime = np.zeros(max_memory_size, dtype=dtype)
+		self.terminals = np.zeros(max_memory_size, dtype=np.bool_)
+		self.oldest = 0 # next slot to write
+		self.size = 0
+		self.last = None # slot of the current frame of the running episode
+
+	def write_frame(self, frame, depth):
+		i = self.oldest
+		self.frames[i] = frame
+		self.depth[i] = depth
+		self.has_transition[i] = False
+		self.oldest = (self.oldest + 1) % self.max_memory_size
+		self.size = min(self.size + 1, self.max_memory_size)
+		self.last = i
+		if self.target_cache is not None:
+			# the frames after a slot are only overwritten after the slot itself, so this drops every stale entry
+			self.target_cache.invalidate([i])
+		return i
+
+	def start_episode(self, frame):
+		return self.write_frame(frame, 0)
+
+	def add(self, action, reward, frame_prime, phase, phase_prime, terminal):
+		# transition from the current frame of the episode to frame_prime
+		i = self.last
+		self.actions[i] = action
+		self.rewards[i] = reward
+		self.phases[i] = phase
+		self.phases_prime[i] = phase_prime
+		self.terminals[i] = terminal
+		self.write_frame(frame_prime, min(self.depth[i] + 1, self.history - 1))
+		self.has_transition[i] = True
+		return i
+
+	def valid(self, idx):
+		# a transition is usable while its whole history is still in the buffer
+		if self.size < self.max_memory_size:
+			return self.has_transition[idx]
+		return self.has_transition[idx] & (((idx - self.oldest) % self.max_memory_size) >= self.depth[idx])
+
+	def sample_idx(self, n):
+		# rejection sampling, only the first frames of the oldest episode and the last frame of every episode are invalid
+		idx = np.random.randint(0, high=self.size, size=(n,))
+		invalid = ~self.valid(idx)
+		while np.any(invalid):
+			idx[invalid] = np.random.randint(0, high=self.size, size=(np.sum(invalid),))
+			invalid = ~self.valid(idx)
+		return idx
+
+	def stack(self, idx, depth):
+		# (n, history*frame_size) inputs ending at the frames in idx, oldest frame first
+		back = np.minimum(np.arange(self.history - 1, -1, -1)[None,:], depth[:,None])
+		return self.frames[(idx[:,None] - back) % self.max_memory_size].reshape(len(idx), -1)
+
+	def get(self, idx):
+		idx_prime = (idx + 1) % self.max_memory_size
+		states = self.stack(idx, self.depth[idx])
+		states_prime = self.stack(idx_prime, self.depth[idx_prime])
+		return Transitions(states, self.actions[idx], self.rewards[idx], states_prime, self.phases[idx], self.phases_prime[idx], self.terminals[idx])
+
+	def add_batch(self, actions, rewards, frames_prime, phases, phases_prime, terminals):
+		# consecutive transitions of the running episode, same as add for every row. returns the transition slots
+		n = len(actions)
+		idx = (self.last + np.arange(n)) % self.max_memory_size
+		frame_idx = (idx + 1) % self.max_memory_size
+		self.actions[idx] = actions
+		self.rewards[idx] = rewards
+		self.phases[idx] = phases
+		self.phases_prime[idx] = phases_prime
+		self.terminals[idx] = terminals
+		self.frames[frame_idx] = frames_prime
+		self.depth[frame_idx] = np.minimum(self.depth[self.last] + 1 + np.arange(n), self.history - 1)
+		self.has_transition[frame_idx] = False
+		self.has_transition[idx] = True
+		self.oldest = (frame_idx[-1] + 1) % self.max_memory_size
+		self.size = min(self.size + n, self.max_memory_size)
+		self.last = frame_idx[-1]
+		if self.target_cache is not None:
+			self.target_cache.invalidate(frame_idx)
+		return idx
+
+
+class SequenceReplay(ArrayReplay):
+	# transitions of the gru scripts stored flat, in episode order, with the episode id and step of every slot. samples
+	# fixed length windows of seq_len steps, each preceded by up to burn_in earlier steps of the same episode that only
+	# warm up the hidden state. columns are left padded where the burn-in would cross the episode start (or a slot that
+	# has been overwritten) and right padded where the window runs past the episode end. with hidden_shape
+	# (n_layers, hidden_size) the actor's recurrent state before every step is kept too, as float16, and windows start
+	# from it instead of from zeros
+	def __init__(self, max_memory_size, state_size, seq_len=20, burn_in=0, hidden_shape=None, dtype=np.float32):
+		ArrayReplay.__init__(self, max_memory_size, state_size, dtype=dtype)
+		self.seq_len = seq_len
+		self.burn_in = burn_in
+		self.hidden = None if hidden_shape is None else np.zeros((max_memory_size,) + tuple(hidden_shape), dtype=np.float16)
+		self.episode = np.full(max_memory_size, -1, dtype=np.int64)
+		self.step = np.zeros(max_memory_size, dtype=np.int64)
+		self.length = np.zeros(max_memory_size, dtype=np.int64) # steps stored so far of the slot's episode
+		self.n_episodes = 0
+		self.episode_step = 0
+
+	def start_episode(self):
+		self.n_episodes += 1
+		self.episode_step = 0
+
+	def add(self, state, action, reward, state_prime, phase, phase_prime, terminal, hidden=None):
+		# hidden - recurrent state the action was taken with, zeros if not given
+		i = ArrayReplay.add(self, state, action, reward, state_prime, phase, phase_prime, terminal)
+		if self.hidden is not None:
+			self.hidden[i] = 0 if hidden is None else hidden
+		self.episode[i] = self.n_episodes - 1
+		self.step[i] = self.episode_step
+		self.episode_step += 1
+		self.update_length(i)
+		return i
+
+	def add_batch(self, states, actions, rewards, states_prime, phases, phases_prime, terminals, hidden=None):
+		# consecutive steps of the running episode, e.g. a whole episode once it ended
+		idx = ArrayReplay.add_batch(self, states, actions, rewards, states_prime, phases, phases_prime, terminals)
+		if self.hidden is not None:
+			self.hidden[idx] = 0 if hidden is None else hidden
+		self.episode[idx] = self.n_episodes - 1
+		self.step[idx] = self.episode_step + np.arange(len(idx))
+		self.episode_step += len(idx)
+		self.update_length(idx[-1])
+		return idx
+
+	def update_length(self, last):
+		# the slots of the running episode are contiguous, ending at last
+		n = min(self.episode_step, self.max_memory_size)
+		self.length[(last - np.arange(n)) % self.max_memory_size] = self.episode_step
+
+	def window_slots(self, start):
+		# [burn_in + seq_len, n] slots around the sampled start slots and the mask of those still holding the same episode
+		offsets = np.arange(-self.burn_in, self.seq_len)
+		slots = (start[None,:] + offsets[:,None]) % self.max_memory_size
+		mask = (self.episode[slots] == self.episode[start][None,:]) & (self.step[slots] == self.step[start][None,:] + offsets[:,None])
+		return slots, mask
+
+	def sample_sequences(self, n, last_n=1.0):
+		# last_n - as in the scripts' create_targets, only steps in the last last_n fraction of their episode get loss
+		start = self.sample_idx(n)
+		slots, mask = self.window_slots(start)
+		loss_mask = mask & (np.arange(-self.burn_in, self.seq_len) >= 0)[:,None]
+		if last_n < 1.0:
+			loss_mask &= self.step[slots] >= (1 - last_n)*self.length[slots]
+		resets = mask.copy()
+		resets[1:] &= ~mask[:-1]
+
+		def gather(x):
+			m = mask.reshape(mask.shape + (1,)*(x.ndim - 1))
+			return np.where(m, x[slots], 0).astype(x.dtype)
+
+		def tensor(x):
+			return torch.from_numpy(np.ascontiguousarray(x.astype(np.uint8) if x.dtype == np.bool_ else x))
+
+		hidden = None
+		if self.hidden is not None:
+			first = slots[np.argmax(mask, axis=0), np.arange(n)]
+			hidden = tensor(self.hidden[first].astype(np.float32).transpose(1, 0, 2))
+
+		fields = [gather(self.states), gather(self.actions), gather(self.rewards), gather(self.states_prime), gather(self.phases), gather(self.phases_prime), gather(self.terminals), mask, loss_mask, resets, np.where(mask, slots, -1)]
+		return Sequences(*([tensor(x) for x in fields] + [hidden]))
+
+
+class TargetCache():
+	# max over actions of the target network q values at the next state of every replay slot, filled the first time a
+	# slot is sampled. the replay drops the entry of a slot when it is overwritten and invalidate() drops all of them,
+	# to be called whenever the policy is copied into the target network. one float per slot, bounded by the replay
+	def __init__(self, max_memory_size):
+		self.values = np.zeros(max_memory_size, dtype=np.float32)
+		self.stamps = np.full(max_memory_size, -1, dtype=np.int64)
+		self.generation = 0 # bumped by invalidate(), entries of older generations are stale
+		self.hits = 0
+		self.misses = 0
+
+	def lookup(self, idx):
+		# cached values of the slots in idx and the mask of those that are valid
+		hit = self.stamps[idx] == self.generation
+		self.hits += int(np.sum(hit))
+		self.misses += len(idx) - int(np.sum(hit))
+		return self.values[idx], hit
+
+	def store(self, idx, values):
+		self.values[idx] = values
+		self.stamps[idx] = self.generation
+
+	def invalidate(self, idx=None):
+		# idx None - every slot, e.g. after a target network copy
+		if idx is None:
+			self.generation += 1
+		else:
+			self.stamps[idx] = -1
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+
+	def info(self):
+		total = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'size': int(np.sum(self.stamps == self.generation)), 'hit_rate': self.hits/float(total) if total > 0 else 0.0}
+
+
+class SumTree():
+	# array sum-tree over capacity leaves: tree[1] is the total, node i has children 2i and 2i+1, leaf j is tree[size + j].
+	# updates and searches walk one level per step for a whole batch of indices
+	empty = 0.0
+
+	def __init__(self, capacity):
+		self.size = 1
+		while self.size < capacity:
+			self.size *= 2
+		self.tree = np.full(2*self.size, self.empty)
+
+	def combine(self, left, right):
+		return left + right
+
+	def total(self):
+		return self.tree[1]
+
+	def get(self, idx):
+		return self.tree[self.size + np.asarray(idx)]
+
+	def update(self, idx, priorities):
+		# O(log n) per index, parents are recomputed from their children so repeated indices are fine
+		node = self.size + np.asarray(idx)
+		self.tree[node] = priorities
+		node = np.unique(node // 2)
+		while node[0] >= 1:
+			self.tree[node] = self.combine(self.tree[2*node], self.tree[2*node + 1])
+			node = np.unique(node // 2)
+
+	def find(self, values):
+		# leaf whose cumulative priority interval contains each value in [0, total)
+		values = np.array(values, dtype=np.float64)
+		node = np.ones(len(values), dtype=np.int64)
+		while node[0] < self.size:
+			left = 2*node
+			right = values >= self.tree[left]
+			values -= self.tree[left]*right
+			node = left + right
+		return node - self.size
+
+
+class MinTree(SumTree):
+	# same layout with the minimum instead of the sum, tree[1] is the smallest leaf. empty leaves are inf
+	empty = np.inf
+
+	def combine(self, left, right):
+		return np.minimum(left, right)
+
+	def min(self):
+		return self.tree[1]
+
+
+class PrioritizedReplay():
+	# proportional prioritization (priority (|td error| + eps)^alpha) with stratified sampling, one draw from each of n
+	# equal slices of the total priority. new slots get the largest priority seen so they are replayed at least once
+	def init_priorities(self, capacity, alpha, beta, eps):
+		self.tree = SumTree(capacity)
+		self.min_tree = MinTree(capacity) # smallest sampleable priority, gives the largest weight of the buffer
+		self.alpha = alpha
+		self.beta_start = beta
+		self.beta = beta # importance sampling exponent, see anneal_beta
+		self.eps = eps
+		self.max_priority = 1.0
+
+	def anneal_beta(self, fraction):
+		# linear schedule from the initial beta to 1 (full bias correction) over the fraction of training done
+		self.beta = self.beta_start + min(max(fraction, 0.0), 1.0)*(1.0 - self.beta_start)
+
+	def draw(self, n):
+		u = (np.arange(n) + np.random.uniform(size=n))*(self.tree.total()/n)
+		return self.tree.find(np.minimum(u, self.tree.total()*(1 - 1e-12)))
+
+	def set_priorities(self, idx, priorities):
+		# priority 0 marks slots that can not be drawn, they are left out of the minimum
+		priorities = np.asarray(priorities, dtype=np.float64)
+		self.tree.update(idx, priorities)
+		self.min_tree.update(idx, np.where(priorities > 0, priorities, np.inf))
+
+	def weights(self, idx):
+		# importance sampling weights (N P(i))^-beta normalized by the largest weight over the whole buffer, the one of the
+		# smallest priority, so they stay comparable between batches (and are not all 1 for a single sample)
+		return ((self.tree.get(idx)/self.min_tree.min())**(-self.beta)).astype(np.float32)
+
+	def update_priorities(self, idx, td_errors):
+		priorities = (np.abs(np.asarray(td_errors, dtype=np.float64)) + self.eps)**self.alpha
+		self.set_priorities(idx, priorities)
+		self.max_priority = max(self.max_priority, np.max(priorities))
+
+
+class PrioritizedFrameStackReplay(FrameStackReplay, PrioritizedReplay):
+	# FrameStackReplay sampled by TD error. a frame has priority 0 until a transition from it is stored, so the last
+	# frame of every episode is never drawn
+	def __init__(self, max_memory_size, frame_size, history=3, alpha=0.6, beta=0.4, eps=1e-3, target_cache=False, dtype=np.float32):
+		FrameStackReplay.__init__(self, max_memory_size, frame_size, history=history, target_cache=target_cache, dtype=dtype)
+		self.init_priorities(max_memory_size, alpha, beta, eps)
+
+	def write_frame(self, frame, depth):
+		i = FrameStackReplay.write_frame(self, frame, depth)
+		self.set_priorities([i], [0.0])
+		return i
+
+	def add(self, action, reward, frame_prime, phase, phase_prime, terminal):
+		i = FrameStackReplay.add(self, action, reward, frame_prime, phase, phase_prime, terminal)
+		self.set_priorities([i], [self.max_priority])
+		return i
+
+	def sample_idx(self, n):
+		# redraw the few transitions whose history has been overwritten
+		idx = self.draw(n)
+		invalid = ~self.valid(idx)
+		while np.any(invalid):
+			idx[invalid] = self.draw(np.sum(invalid))
+			invalid = ~self.valid(idx)
+		return idx
+
+	def sample_weighted(self, n):
+		idx = self.sample_idx(n)
+		return self.get(idx), idx, self.weights(idx)
+
+	def add_batch(self, actions, rewards, frames_prime, phases, phases_prime, terminals):
+		idx = FrameStackReplay.add_batch(self, actions, rewards, frames_prime, phases, phases_prime, terminals)
+		self.set_priorities((idx + 1) % self.max_memory_size, np.zeros(len(idx)))
+		self.set_priorities(idx, np.full(len(idx), self.max_priority))
+		return idx
+
+	def update_priorities(self, idx, td_errors):
+		PrioritizedReplay.update_priorities(self, idx, td_errors)
+
+
+class PrioritizedEpisodeReplay(PrioritizedReplay):
+	# episode replay of the gru scripts (add overwrites the oldest episode once full) with one priority per episode,
+	# e.g. the mean |td error| over the steps that got targets
+	def __init__(self, max_memory_size=100, alpha=0.6, beta=0.4, eps=1e-3):
+		self.memory = []
+		self.oldest = 0
+		self.max_memory_size = max_memory_size
+		self.init_priorities(max_memory_size, alpha, beta, eps)
+
+	def __len__(self):
+		return len(self.memory)
+
+	def add(self, experience):
+		if len(self.memory) < self.max_memory_size:
+			i = len(self.memory)
+			self.memory.append(experience)
+		else:
+			i = self.oldest
+			self.memory[i] = experience
+			self.oldest = (self.oldest + 1) % self.max_memory_size
+		self.set_priorities([i], [self.max_priority])
+
+	def sample(self):
+		return self.memory[self.draw(1)[0]]
+
+	def sample_weighted(self, n):
+		idx = self.draw(n)
+		return [self.memory[i] for i in idx], idx, self.weights(idx)
@@ -12,6 +12,8 @@ from torch.autograd import Variable
 from itertools import product
 from PyQt4 import QtGui, QtCore
 from visualization import QTVisualizer, q_refresh
+from vec_env import varying_reward_env
+from evaluate import greedy_evaluate
 
 def create_obstacles(width, height):
 	return [(3,3),(6,3),(3,6),(6,6)] # 12 x 12
@@ -264,6 +266,7 @@ def main():
 
 	if policy_type != 3:
 		policy = torch.load(policy_checkpoint)
+		policy.inference(True)
 
 	if visualization_flag:
 		app = QtGui.QApplication(sys.argv)
@@ -272,6 +275,13 @@ def main():
 	# testing with greedy policy
 	print 'Using greedy policy ...'
 	start_loc = (0,5)
+	if not visualization_flag:
+		# same batched path as the transition scripts, one episode is enough as the rewards are deterministic
+		total_rewards, step_counts = greedy_evaluate(policy if policy_type != 3 else None, varying_reward_env(1), policy_type, recurrent=True, start=start_loc)
+		print 'Total reward', total_rewards[0]
+		print 'Number of steps', step_counts[0]
+		return
+
 	s = State(start_loc, obstacles)
 	R.reset()
 	total_reward = 0
@@ -282,18 +292,15 @@ def main():
 			q_refresh()
 		phase = R.phase()
 		if policy_type == 0:
-			x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(s.state)
+			a = Action(np.argmax(q))
 		elif policy_type == 1:
 			inp = np.concatenate((s.state,np.asarray([phase])))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(inp)
+			a = Action(np.argmax(q))
 		elif policy_type == 2:
-			x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x, phase)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(s.state, phase)
+			a = Action(np.argmax(q))
 		elif policy_type == 3:
 			a = Action(np.random.randint(0,high=5))
 		#a = Action(np.argmax(q.data.numpy()))
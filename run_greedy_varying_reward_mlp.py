@@ -3,15 +3,10 @@ import copy
 import math
 import random
 import numpy as np
-from phase_mlp_multilayer_new import PMLP
-from mlp import MLP
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.autograd import Variable
 from itertools import product
-from PyQt4 import QtGui, QtCore
-from visualization import QTVisualizer, q_refresh
+from table_policy import load_table_policy
+from vec_env import varying_reward_env
+from evaluate import greedy_evaluate
 
 def create_obstacles(width, height):
 	return [(3,3),(6,3),(3,6),(6,6)] # 12 x 12
@@ -32,6 +27,8 @@ def obstacle_movement(t):
 
 def create_targets(inp, memory, q_vals, target_net, gamma=1):
 	# memory: 0 - set of current_states 1: action index 2: reward 3: next state 4: phase 5: phase_prime
+	import torch
+	from torch.autograd import Variable
 	n_eps = len(memory)
 	action_space_size = target_net.output_size 
 	q_target = q_vals.data.clone()
@@ -275,15 +272,31 @@ def main():
 	M = ExperienceReplay(max_memory_size=10000)
 	
 	if policy_type != 3:
-		policy = torch.load(policy_checkpoint)
+		if policy_checkpoint.endswith('.npz'):
+			# table compiled by compile_policy.py, acts without running the network
+			policy = load_table_policy(policy_checkpoint)
+		else:
+			# torch (and the network modules, through unpickling) only for network checkpoints, tables run on numpy
+			import torch
+			policy = torch.load(policy_checkpoint)
+		policy.inference(True)
 
 	if visualization_flag:	
+		from PyQt4 import QtGui
+		from visualization import QTVisualizer, q_refresh
 		app = QtGui.QApplication(sys.argv)
 		visualizer = QTVisualizer('Varying rewards')
 
 	# testing with greedy policy
 	print 'Using greedy policy ...'
 	start_loc = (0,5)
+	if not visualization_flag:
+		# same batched path as the transition scripts, one episode is enough as the rewards are deterministic
+		total_rewards, step_counts = greedy_evaluate(policy if policy_type != 3 else None, varying_reward_env(1), policy_type, recurrent=False, start=start_loc)
+		print 'Total reward', total_rewards[0]
+		print 'Number of steps', step_counts[0]
+		return
+
 	s_2 = State(start_loc, obstacles)
 	s_1 = State(start_loc, obstacles)
 	s = State(start_loc, obstacles)
@@ -297,19 +310,16 @@ def main():
 		phase = R.phase()
 		if policy_type == 0:
 			inp = np.concatenate((s_2.state, s_1.state, s.state))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(inp)
+			a = Action(np.argmax(q))
 		elif policy_type == 1:
 			inp = np.concatenate((s_2.state, s_1.state, s.state, np.asarray([phase])))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(inp)
+			a = Action(np.argmax(q))
 		elif policy_type == 2:
 			inp = np.concatenate((s_2.state, s_1.state, s.state))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x, phase)
-			a = Action(np.argmax(q.data.numpy()))
+			q = policy.act(inp, phase)
+			a = Action(np.argmax(q))
 		elif policy_type == 3:
 			a = Action(np.random.randint(0,high=5))
 		
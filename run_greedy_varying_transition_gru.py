@@ -12,6 +12,8 @@ from torch.autograd import Variable
 from itertools import product
 from PyQt4 import QtGui, QtCore
 from visualization import QTVisualizer, q_refresh
+from vec_env import varying_transition_env
+from evaluate import greedy_evaluate
 
 dtype = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
@@ -304,6 +306,7 @@ def main():
 
 	if policy_type != 3:
 		policy = torch.load(policy_checkpoint)
+		policy.inference(True)
 	
 	if visualize_flag:
 		app = QtGui.QApplication(sys.argv)
@@ -312,6 +315,13 @@ def main():
 	# testing with greedy policy
 	print 'Using greedy policy ...'
 	start_loc = (0,5)
+	if not visualize_flag:
+		# all 1000 episodes side by side, one batched policy forward per time step
+		total_rewards, step_counts = greedy_evaluate(policy if policy_type != 3 else None, varying_transition_env(1000, probab), policy_type, recurrent=True, start=start_loc)
+		print 'Average total reward', np.mean(total_rewards)
+		print 'Average step count', np.mean(step_counts)
+		return
+
 	average_total_reward = 0
 	average_step_count = 0
 	for _ in range(1000):
@@ -328,18 +338,15 @@ def main():
 
 			phase = T.phase(R.t)
 			if policy_type == 0:
-				x = Variable(torch.from_numpy(s.state).type(dtype), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
-				a = Action(np.argmax(q.data.cpu().numpy()))
+				q = policy.act(s.state)
+				a = Action(np.argmax(q))
 			elif policy_type == 1:
 				inp = np.concatenate((s.state,np.asarray([phase])))
-				x = Variable(torch.from_numpy(inp).type(dtype), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
-				a = Action(np.argmax(q.data.cpu().numpy()))
+				q = policy.act(inp)
+				a = Action(np.argmax(q))
 			elif policy_type == 2:
-				x = Variable(torch.from_numpy(s.state).type(dtype), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x, phase)
-				a = Action(np.argmax(q.data.cpu().numpy()))
+				q = policy.act(s.state, phase)
+				a = Action(np.argmax(q))
 			elif policy_type == 3:
 				a = Action(np.random.randint(0,high=5))
 			t = R.t
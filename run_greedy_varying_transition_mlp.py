@@ -3,15 +3,10 @@ import copy
 import math
 import random
 import numpy as np
-from phase_mlp_multilayer_new import PMLP
-from mlp import MLP
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.autograd import Variable
 from itertools import product
-from PyQt4 import QtGui, QtCore
-from visualization import QTVisualizer, q_refresh
+from table_policy import load_table_policy
+from vec_env import varying_transition_env
+from evaluate import greedy_evaluate
 
 def create_obstacles(width, height):
 	return [(3,3),(6,3),(3,6),(6,6)] # 12 x 12
@@ -32,6 +27,8 @@ def obstacle_movement(t):
 
 def create_targets(inp, memory, q_vals, target_net, gamma=1):
 	# memory: 0 - set of current_states 1: action index 2: reward 3: next state 4: phase 5: phase_prime
+	import torch
+	from torch.autograd import Variable
 	n_eps = len(memory)
 	action_space_size = target_net.output_size 
 	q_target = q_vals.data.clone()
@@ -308,6 +305,7 @@ def main():
 	if policy_type != 3:
 		policy_checkpoint = sys.argv[2]
 	visualization_flag = False
+	exact_flag = False # expected values solved over the finite state space instead of 1000 rollouts
 
 	obstacles = create_obstacles(width,height)
 
@@ -316,15 +314,38 @@ def main():
 	M = ExperienceReplay(max_memory_size=10000)
 	
 	if policy_type != 3:
-		policy = torch.load(policy_checkpoint)
+		if policy_checkpoint.endswith('.npz'):
+			# table compiled by compile_policy.py, acts without running the network
+			policy = load_table_policy(policy_checkpoint)
+		else:
+			# torch (and the network modules, through unpickling) only for network checkpoints, tables run on numpy
+			import torch
+			policy = torch.load(policy_checkpoint)
+		policy.inference(True)
 
 	if visualization_flag:	
+		from PyQt4 import QtGui
+		from visualization import QTVisualizer, q_refresh
 		app = QtGui.QApplication(sys.argv)
 		visualizer = QTVisualizer('Varying transition dynamics')
 
 	# testing with greedy policy
 	print 'Using greedy policy ...'
 	start_loc = (0,5)
+	if exact_flag:
+		from exact_evaluate import exact_evaluate # needs scipy
+		expected_total_reward, expected_step_count, _ = exact_evaluate(policy if policy_type != 3 else None, varying_transition_env(1, probab), policy_type, start=start_loc)
+		print 'Expected total reward', expected_total_reward
+		print 'Expected step count', expected_step_count
+		return
+
+	if not visualization_flag:
+		# all 1000 episodes side by side, one batched policy forward per time step
+		total_rewards, step_counts = greedy_evaluate(policy if policy_type != 3 else None, varying_transition_env(1000, probab), policy_type, recurrent=False, start=start_loc)
+		print 'Average total reward', np.mean(total_rewards)
+		print 'Average step count', np.mean(step_counts)
+		return
+
 	average_total_reward = 0
 	average_step_count = 0
 	for _ in range(1000):
@@ -343,19 +364,16 @@ def main():
 			phase = T.phase(R.t)
 			if policy_type == 0:
 				inp = np.concatenate((s_2.state, s_1.state, s.state))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
-				a = Action(np.argmax(q.data.numpy()))
+				q = policy.act(inp)
+				a = Action(np.argmax(q))
 			elif policy_type == 1:
 				inp = np.concatenate((s_2.state, s_1.state, s.state, np.asarray([phase])))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
-				a = Action(np.argmax(q.data.numpy()))
+				q = policy.act(inp)
+				a = Action(np.argmax(q))
 			elif policy_type == 2:
 				inp = np.concatenate((s_2.state, s_1.state, s.state))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x, phase)
-				a = Action(np.argmax(q.data.numpy()))
+				q = policy.act(inp, phase)
+				a = Action(np.argmax(q))
 			elif policy_type == 3:
 				a = Action(np.random.randint(0,high=5))
 		
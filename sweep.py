@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import random
+import traceback
+import importlib
+import multiprocessing as mp
+from itertools import product
+
+# one torch thread per job, set before anything imports torch so the openmp pool of the workers is never larger
+os.environ['OMP_NUM_THREADS'] = '1'
+os.environ['MKL_NUM_THREADS'] = '1'
+
+# runs a grid of (script, policy_type, prob, seed) jobs of the varying_* scripts on a pool of one process per core,
+# each pinned to its core. every job writes its plot file, checkpoints and log under root/<job name>/, a job that
+# finished leaves a done file there and is skipped when the sweep is started again. failed or interrupted jobs are
+# rerun from scratch: the checkpoints they wrote only hold the policy (no optimizer, replay or episode count) and are
+# not resumed from, the rerun overwrites them
+# usage: python sweep.py root [n_workers]
+
+# script and whether it reads the wind probability (sys.argv[4])
+SCRIPTS = {'varying_transition_mlp': True, 'varying_transition_gru': True, 'varying_reward_mlp': False, 'varying_reward_gru': False}
+
+
+def available_cores():
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	return range(mp.cpu_count())
+
+def pin(core):
+	if hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, [core])
+	else:
+		os.system('taskset -p -c %d %d > /dev/null' % (core, os.getpid()))
+
+def init_worker(cores):
+	# every worker takes one core for its lifetime
+	pin(cores.get())
+	import torch
+	torch.set_num_threads(1)
+
+def expand(scripts, policy_types, probs, seeds):
+	jobs = []
+	for script in scripts:
+		for policy_type, prob, seed in product(policy_types, probs if SCRIPTS[script] else [None], seeds):
+			name = script + '_type' + str(policy_type) + ('' if prob is None else '_prob' + str(prob)) + '_seed' + str(seed)
+			jobs.append({'name': name, 'script': script, 'policy_type': policy_type, 'prob': prob, 'seed': seed})
+	return jobs
+
+def job_done(root, job):
+	return os.path.exists(os.path.join(root, job['name'], 'done'))
+
+def run_job(root, job):
+	# runs the script's main in this worker with the job's argv, seeds and output directories, always from the start.
+	# returns (name, True, seconds) or (name, False, traceback)
+	job_dir = os.path.join(root, job['name'])
+	checkpoint_dir = os.path.join(job_dir, 'checkpoints')
+	if not os.path.isdir(checkpoint_dir):
+		os.makedirs(checkpoint_dir)
+	for name in ('done', 'error'):
+		if os.path.exists(os.path.join(job_dir, name)):
+			os.remove(os.path.join(job_dir, name))
+
+	stdout, argv = sys.stdout, sys.argv
+	log = open(os.path.join(job_dir, 'log.txt'), 'w')
+	start = time.time()
+	try:
+		import numpy as np
+		import torch
+		random.seed(job['seed'])
+		np.random.seed(job['seed'])
+		torch.manual_seed(job['seed'])
+
+		module = importlib.import_module(job['script'])
+		module.PLOT_DIR = job_dir + os.sep
+		module.CHECKPOINT_DIR = checkpoint_dir + os.sep
+		sys.argv = [job['script'] + '.py', str(job['policy_type']), 'rewards.txt', 'policy']
+		if job['prob'] is not None:
+			sys.argv.append(str(job['prob']))
+		sys.stdout = log
+		module.main()
+	except (Exception, SystemExit): # the scripts call sys.exit on bad configurations, ctrl-c still stops the sweep
+		sys.stdout, sys.argv = stdout, argv
+		log.close()
+		error = traceback.format_exc()
+		f = open(os.path.join(job_dir, 'error'), 'w')
+		f.write(error)
+		f.close()
+		return job['name'], False, error
+
+	sys.stdout, sys.argv = stdout, argv
+	log.close()
+	f = open(os.path.join(job_dir, 'done'), 'w')
+	f.write(json.dumps(dict(job, seconds=time.time() - start)))
+	f.close()
+	return job['name'], True, time.time() - start
+
+def run_job_star(args):
+	return run_job(*args)
+
+def sweep(root, jobs, n_workers=None):
+	# runs the jobs that are not done yet, returns the names of the failed ones
+	cores = available_cores()
+	n_workers = len(cores) if n_workers is None else min(n_workers, len(cores))
+	todo = [job for job in jobs if not job_done(root, job)]
+	print 'Running', len(todo), 'of', len(jobs), 'jobs on', n_workers, 'cores'
+	if len(todo) == 0:
+		return []
+
+	core_queue = mp.Queue()
+	for core in cores[:n_workers]:
+		core_queue.put(core)
+	pool = mp.Pool(n_workers, initializer=init_worker, initargs=(core_queue,))
+	failed = []
+	for name, ok, result in pool.imap_unordered(run_job_star, [(root, job) for job in todo]):
+		if ok:
+			print 'Finished', name, 'in %.0f s' % result
+		else:
+			print 'Failed', name
+			print result
+			failed.append(name)
+	pool.close()
+	pool.join()
+	return failed
+
+def main():
+	root = sys.argv[1]
+	n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+	scripts = ['varying_transition_mlp', 'varying_transition_gru']
+	policy_types = [0, 1, 2]
+	probs = [0.1, 0.2, 0.3]
+	seeds = [0, 1, 2]
+
+	if not os.path.isdir(root):
+		os.makedirs(root)
+	jobs = expand(scripts, policy_types, probs, seeds)
+	f = open(os.path.join(root, 'jobs.json'), 'w')
+	f.write(json.dumps(jobs, indent=1))
+	f.close()
+
+	failed = sweep(root, jobs, n_workers)
+	if len(failed) > 0:
+		print len(failed), 'jobs failed, run the sweep again to retry them'
+
+
+if __name__ == '__main__':
+	main()
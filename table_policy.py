@@ -0,0 +1,103 @@
+import numpy as np
+
+# greedy policy of a compiled MLP / PMLP as a table of actions, numpy only (no torch needed to act).
+# the index of an input row is built from what the network sees: the obstacle step (t % obs_period) of the current
+# frame, the number of real earlier frames (depth, the first frame of an episode is repeated to fill the history),
+# the phase (types 1 and 2), the current cell and the per axis offsets between consecutive frames, which lie in
+# [-2, 2] (one action step plus one wind step)
+
+UNKNOWN = 255 # input that can not occur in the env the table was compiled for
+MAX_OFFSET = 2
+
+
+def phase_key(phase):
+	# env phases rounded to 6 digits. (w*t) % 2pi can land just below 2pi where (w*(t % L)) % 2pi gives 0
+	key = np.round(np.asarray(phase, dtype=np.float64), 6)
+	return np.where(key >= round(2*np.pi, 6), key - round(2*np.pi, 6), key)
+
+class TablePolicy():
+	def __init__(self, table, policy_type, history, width, height, obstacles, offsets, phases):
+		self.table = table # uint8 actions, shape dims()
+		self.policy_type = policy_type
+		self.history = history
+		self.width = width
+		self.height = height
+		self.obstacles = np.asarray(obstacles) # obstacle positions at obstacle step 0
+		self.offsets = np.asarray(offsets) # obstacle offset of every obstacle step
+		self.phases = np.asarray(phases) # sorted distinct phase_key values, [0] for type 0
+		self.frame_size = 2*(len(self.obstacles) + 1)
+
+		# obstacles move together, the offset of the first one from its step 0 position gives the obstacle step
+		self.steps = np.full((2*width + 1, 2*height + 1), -1, dtype=np.int64)
+		for step, (dx, dy) in enumerate(self.offsets.tolist()):
+			self.steps[dx + width, dy + height] = step
+		self.strides = np.cumprod((1,) + table.shape[::-1])[:-1][::-1]
+
+	@staticmethod
+	def dims(policy_type, history, width, height, n_obs_steps, n_phases):
+		return (n_obs_steps, history, n_phases if policy_type != 0 else 1, width, height) + (2*MAX_OFFSET + 1,)*(2*(history - 1))
+
+	def index(self, x, phase=None):
+		# flat table index of every row of x (stacked frames as fed to the network, phase as last column for type 1),
+		# -1 for rows that can not occur
+		x = np.asarray(x).reshape(-1, self.history*self.frame_size + (1 if self.policy_type == 1 else 0))
+		if self.policy_type == 1:
+			phase = x[:,-1]
+			x = x[:,:-1]
+		n = len(x)
+		frames = np.rint(x.reshape(n, self.history, self.frame_size)[:,:,:4]).astype(np.int64)
+		cells = frames[:,:,:2]
+		obstacle = frames[:,:,2:] # first obstacle of every frame
+
+		rel = np.clip(obstacle[:,-1] - self.obstacles[0] + (self.width, self.height), 0, (2*self.width, 2*self.height))
+		step = self.steps[rel[:,0], rel[:,1]]
+		valid = step >= 0
+
+		# obstacles move every step, so the real earlier frames are the trailing ones with different obstacles
+		depth = np.zeros(n, dtype=np.int64)
+		real = np.ones(n, dtype=np.bool_)
+		for j in range(self.history - 1, 0, -1):
+			real &= np.any(obstacle[:,j] != obstacle[:,j-1], axis=1)
+			depth += real
+
+		phase_idx = np.zeros(n, dtype=np.int64)
+		if self.policy_type != 0:
+			rounded = phase_key(np.asarray(phase).reshape(-1)*np.ones(n))
+			phase_idx = np.minimum(np.searchsorted(self.phases, rounded), len(self.phases) - 1)
+			valid &= self.phases[phase_idx] == rounded
+
+		offsets = (cells[:,1:] - cells[:,:-1] + MAX_OFFSET).reshape(n, -1)
+		valid &= np.all((offsets >= 0) & (offsets <= 2*MAX_OFFSET), axis=1)
+		valid &= (cells[:,-1,0] >= 0) & (cells[:,-1,0] < self.width) & (cells[:,-1,1] >= 0) & (cells[:,-1,1] < self.height)
+
+		coords = np.concatenate((np.stack((step, depth, phase_idx, cells[:,-1,0], cells[:,-1,1]), axis=1), offsets), axis=1)
+		return np.where(valid, coords.dot(self.strides), -1)
+
+	def actions(self, x, phase=None):
+		# greedy actions of the rows, one table read
+		idx = self.index(x, phase)
+		a = self.table.reshape(-1)[idx]
+		if np.any(idx < 0) or np.any(a == UNKNOWN):
+			raise ValueError('Input outside of the states the policy was compiled for')
+		return a.astype(np.int64)
+
+	def act(self, x, phase=None):
+		# one hot (batch, 5) stand in for the q values, so argmax(act()) gives the table action like for the networks
+		a = self.actions(x, phase)
+		q = np.zeros((len(a), 5), dtype=np.float32)
+		q[np.arange(len(a)), a] = 1
+		return q
+
+	def inference(self, flag=True):
+		return self
+
+	def reset(self):
+		pass
+
+	def save(self, path):
+		np.savez_compressed(path, table=self.table, policy_type=self.policy_type, history=self.history, width=self.width, height=self.height, obstacles=self.obstacles, offsets=self.offsets, phases=self.phases)
+
+
+def load_table_policy(path):
+	f = np.load(path)
+	return TablePolicy(f['table'], int(f['policy_type']), int(f['history']), int(f['width']), int(f['height']), f['obstacles'], f['offsets'], f['phases'])
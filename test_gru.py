@@ -0,0 +1,95 @@
+import copy
+import unittest
+import numpy as np
+import torch
+from torch.autograd import Variable
+from gru import GRU
+from phase_gru import PGRU
+
+T, B = 6, 4
+
+
+def step_loop(net, step, x, resets, hidden):
+	# forward_sequence done one forward per time step on the module's own hidden state, reset rows set back by hand
+	names = ['h1', 'h2'] if isinstance(net, GRU) else ['h_0', 'h_1']
+	for name, h in zip(names, hidden):
+		setattr(net, name, h)
+	outputs = []
+	for t in range(T):
+		keep = Variable(torch.from_numpy(1 - resets[t].astype(np.float32))).unsqueeze(1)
+		for name, h in zip(names, hidden):
+			setattr(net, name, getattr(net, name)*keep + h*(1 - keep))
+		outputs.append(step(x[t], t))
+	return torch.stack(outputs, 0), [getattr(net, name) for name in names]
+
+
+class SequenceTest(object):
+	def setUp(self):
+		torch.manual_seed(0)
+		rng = np.random.RandomState(0)
+		self.x = Variable(torch.from_numpy(rng.uniform(-1, 1, size=(T, B, 10)).astype(np.float32)))
+		self.phases = rng.uniform(0, 2*np.pi, size=(T, B))
+		self.resets = np.zeros((T, B), dtype=np.bool_)
+		self.resets[0] = True
+		self.resets[3, 1] = self.resets[2, 2] = True
+		self.hidden = [Variable(torch.from_numpy(rng.uniform(-1, 1, size=(B, 8)).astype(np.float32))) for _ in range(2)]
+
+	def check(self, hidden, resets):
+		q, h = self.sequence(self.net, hidden, resets)
+		q_loop, h_loop = step_loop(self.net, self.step, self.x, resets if resets is not None else np.zeros((T, B), dtype=np.bool_), hidden if hidden is not None else [Variable(torch.zeros(B, 8)) for _ in range(2)])
+		np.testing.assert_allclose(q.data.numpy(), q_loop.data.numpy(), rtol=1e-4, atol=1e-6)
+		for a, b in zip(h, h_loop):
+			np.testing.assert_allclose(a.data.numpy(), b.data.numpy(), rtol=1e-4, atol=1e-6)
+
+	def test_zero_hidden(self):
+		self.check(None, None)
+
+	def test_hidden_and_resets(self):
+		self.check(self.hidden, self.resets)
+
+	def test_gradients(self):
+		# same gradients for the parameters as the step loop
+		grads = []
+		for run in [lambda: self.sequence(self.net, self.hidden, self.resets)[0], lambda: step_loop(self.net, self.step, self.x, self.resets, self.hidden)[0]]:
+			self.net.zero_grad()
+			run().pow(2).sum().backward()
+			grads.append([p.grad.data.numpy().copy() for p in self.net.parameters()])
+		for a, b in zip(*grads):
+			np.testing.assert_allclose(a, b, rtol=1e-3, atol=1e-6)
+
+
+class GRUTest(SequenceTest, unittest.TestCase):
+	def setUp(self):
+		SequenceTest.setUp(self)
+		self.net = GRU(10, 5, 8, n_layers=2, batch_size=B)
+		self.sequence = lambda net, hidden, resets: net.forward_sequence(self.x, resets=resets, hidden=hidden)
+		self.step = lambda x, t: self.net.forward(x)
+
+
+class PGRUTest(SequenceTest, unittest.TestCase):
+	def setUp(self):
+		SequenceTest.setUp(self)
+		self.net = PGRU(10, 5, 8, n_layers=2, batch_size=B, stacked=True)
+		self.sequence = lambda net, hidden, resets: net.forward_sequence(self.x, self.phases, resets=resets, hidden=hidden)
+		self.step = lambda x, t: self.net.forward_batch(x, self.phases[t])
+
+	def test_act(self):
+		# eval path, one phase per time step shared by the batch, through the phase cache
+		phases = np.repeat(self.phases[:,:1], B, axis=1)
+		q = self.net.forward_sequence(self.x, phases)[0].data.numpy()
+		net = copy.deepcopy(self.net).inference(True)
+		net.reset()
+		for t in range(T):
+			np.testing.assert_allclose(net.act(self.x[t].data.numpy(), phases[t,0]), q[t], rtol=1e-4, atol=1e-6)
+
+
+class PGRUModulesTest(PGRUTest):
+	# control points kept as the 4 GRUCell / Linear modules
+	def setUp(self):
+		PGRUTest.setUp(self)
+		torch.manual_seed(0)
+		self.net = PGRU(10, 5, 8, n_layers=2, batch_size=B)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,83 @@
+import copy
+import unittest
+import numpy as np
+import torch
+from torch.autograd import Variable
+from phase_mlp import PMLP
+
+
+def reference(net, x, phase):
+	# q values of one row through the weights of weight_from_phase, the original per step path
+	w = net.weight_from_phase(phase, net.control_hidden_list, net.control_h2o_list)
+	h = x
+	for n in range(net.n_layers):
+		h = np.maximum(np.dot(h, w['weight_' + str(n)].numpy().T) + w['bias_' + str(n)].numpy(), 0)
+	return net.scale*(np.dot(h, w['weight'].numpy().T) + w['bias'].numpy())
+
+
+class PMLPTest(unittest.TestCase):
+	def setUp(self):
+		torch.manual_seed(0)
+		rng = np.random.RandomState(0)
+		self.net = PMLP(10, 5, 16, n_layers=2)
+		self.x = rng.uniform(-1, 1, size=(7, 10)).astype(np.float32)
+		# knots, both sides of a knot and the wrap around
+		self.phases = np.array([0.0, np.pi/2, np.pi/2 - 1e-3, 1.3, np.pi, 4.7, 2*np.pi - 1e-3])
+		self.expected = np.stack([reference(self.net, self.x[i], self.phases[i]) for i in range(len(self.x))], 0)
+
+	def test_forward_batch(self):
+		q = self.net.forward_batch(Variable(torch.from_numpy(self.x)), self.phases)
+		np.testing.assert_allclose(q.data.numpy(), self.expected, rtol=1e-4, atol=1e-5)
+
+	def test_forward_batch_stacked(self):
+		net = copy.deepcopy(self.net)
+		net.stack_controls()
+		q = net.forward_batch(Variable(torch.from_numpy(self.x)), self.phases)
+		np.testing.assert_allclose(q.data.numpy(), self.expected, rtol=1e-4, atol=1e-5)
+
+	def test_forward(self):
+		# training forward, one phase per call
+		for i in range(len(self.x)):
+			q = self.net.forward(Variable(torch.from_numpy(self.x[i:i+1])), self.phases[i])
+			np.testing.assert_allclose(q.data.numpy()[0], self.expected[i], rtol=1e-4, atol=1e-5)
+
+
+class PhaseCacheTest(unittest.TestCase):
+	def setUp(self):
+		torch.manual_seed(0)
+		self.net = PMLP(10, 5, 16, n_layers=2).inference(True)
+		self.x = np.random.RandomState(0).uniform(-1, 1, size=(3, 10)).astype(np.float32)
+		self.phases = [0.0, 1.3, 4.7]
+
+	def check_act(self, net, phase_of=lambda phase: phase):
+		for phase in self.phases:
+			for _ in range(2):
+				expected = np.stack([reference(net, row, phase_of(phase)) for row in self.x], 0)
+				np.testing.assert_allclose(net.act(self.x, phase), expected, rtol=1e-4, atol=1e-5)
+
+	def test_act(self):
+		self.check_act(self.net)
+		self.assertEqual(self.net.phase_cache.info()['misses'], len(self.phases))
+
+	def test_refresh_after_optimizer_step(self):
+		self.check_act(self.net)
+		optimizer = self.net.watch(torch.optim.SGD(self.net.parameters(), lr=0.1))
+		for p in self.net.parameters():
+			p.grad = Variable(torch.ones(p.size()))
+		optimizer.step()
+		self.check_act(self.net)
+
+	def test_refresh_after_load_state_dict(self):
+		self.check_act(self.net)
+		torch.manual_seed(1)
+		self.net.load_state_dict(PMLP(10, 5, 16, n_layers=2).state_dict())
+		self.check_act(self.net)
+
+	def test_bins(self):
+		# with bins the weights are the ones of the bin phase
+		net = PMLP(10, 5, 16, n_layers=2, cache_bins=16).inference(True)
+		self.check_act(net, lambda phase: net.phase_cache.key_phase(net.phase_cache.key(phase)))
+
+
+if __name__ == '__main__':
+	unittest.main()
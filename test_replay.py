@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+from replay import SumTree, MinTree, PrioritizedEpisodeReplay, FrameStackReplay
+
+
+class SumTreeTest(unittest.TestCase):
+	def test_total_and_min(self):
+		priorities = np.random.RandomState(0).uniform(0.1, 2.0, size=13)
+		tree, min_tree = SumTree(13), MinTree(13)
+		tree.update(np.arange(13), priorities)
+		min_tree.update(np.arange(13), priorities)
+		self.assertAlmostEqual(tree.total(), np.sum(priorities))
+		self.assertEqual(min_tree.min(), np.min(priorities))
+		min_tree.update([np.argmin(priorities)], [np.inf])
+		self.assertEqual(min_tree.min(), np.sort(priorities)[1])
+
+	def test_sampling_proportions(self):
+		priorities = np.array([1.0, 0.0, 3.0, 6.0, 0.5, 1.5])
+		tree = SumTree(len(priorities))
+		tree.update(np.arange(len(priorities)), priorities)
+		u = np.random.RandomState(1).uniform(size=200000)*tree.total()
+		counts = np.bincount(tree.find(u), minlength=len(priorities))
+		np.testing.assert_allclose(counts/float(len(u)), priorities/np.sum(priorities), atol=5e-3)
+		self.assertEqual(counts[1], 0)
+
+
+class PrioritizedReplayTest(unittest.TestCase):
+	def setUp(self):
+		np.random.seed(0)
+		self.M = PrioritizedEpisodeReplay(max_memory_size=4, alpha=1.0, beta=0.5, eps=0.0)
+		for i in range(4):
+			self.M.add(i)
+		self.M.update_priorities(np.arange(4), [1.0, 2.0, 4.0, 8.0])
+
+	def test_weights_normalized_by_buffer(self):
+		# (N P(i))^-beta over the largest weight in the buffer, the one of the smallest priority
+		p = np.array([1.0, 2.0, 4.0, 8.0])
+		expected = (4*p/p.sum())**-0.5/(4*p.min()/p.sum())**-0.5
+		np.testing.assert_allclose(self.M.weights(np.arange(4)), expected, rtol=1e-6)
+
+	def test_single_sample_is_corrected(self):
+		# a batch of one is weighted like in any other batch, not normalized to 1 by itself
+		drawn = []
+		for _ in range(50):
+			memory, idx, weights = self.M.sample_weighted(1)
+			self.assertEqual(memory[0], idx[0])
+			self.assertAlmostEqual(weights[0], self.M.tree.get(idx[0])**-0.5, places=6)
+			drawn.append(idx[0])
+			if idx[0] != 0:
+				self.assertLess(weights[0], 1.0)
+		self.assertTrue(np.any(np.array(drawn) != 0))
+
+	def test_anneal_beta(self):
+		self.M.anneal_beta(0.0)
+		self.assertEqual(self.M.beta, 0.5)
+		self.M.anneal_beta(0.5)
+		self.assertEqual(self.M.beta, 0.75)
+		self.M.anneal_beta(2.0)
+		self.assertEqual(self.M.beta, 1.0)
+
+
+class FrameStackReplayTest(unittest.TestCase):
+	def test_stacks_match_naive_rebuild(self):
+		# episodes of random length through a small buffer, so slots wrap around and old histories get overwritten.
+		# every valid transition must equal the one the scripts would have stored, stacks rebuilt from the episode frames
+		rng = np.random.RandomState(0)
+		M = FrameStackReplay(max_memory_size=23, frame_size=2, history=3)
+		expected = {}
+		for episode in range(40):
+			length = rng.randint(1, 9)
+			frames = rng.uniform(size=(length + 1, 2)).astype(np.float32)
+			stacks = [np.concatenate([frames[max(k - j, 0)] for j in range(2, -1, -1)]) for k in range(length + 1)]
+			actions, rewards, phases = rng.randint(0, 5, size=length), rng.uniform(size=length), rng.uniform(size=length + 1)
+			terminals = np.arange(length) == length - 1
+			expected.pop(M.start_episode(frames[0]), None)
+			if episode % 2:
+				slots = M.add_batch(actions, rewards, frames[1:], phases[:-1], phases[1:], terminals)
+			else:
+				slots = [M.add(actions[k], rewards[k], frames[k+1], phases[k], phases[k+1], terminals[k]) for k in range(length)]
+			for k, i in enumerate(slots):
+				# the next frame of slot i overwrites whatever transition was stored in slot i + 1
+				expected.pop((i + 1) % M.max_memory_size, None)
+				expected[i] = (stacks[k], actions[k], rewards[k], stacks[k+1], phases[k], phases[k+1], terminals[k])
+
+			valid = np.nonzero(M.valid(np.arange(M.size)))[0]
+			self.assertTrue(set(valid) <= set(expected.keys()))
+			for i in valid:
+				for x, y in zip(M.get(np.array([i])), expected[i]):
+					np.testing.assert_allclose(x[0], y, rtol=1e-6)
+			self.assertTrue(set(M.sample_idx(50)) <= set(valid))
+
+
+if __name__ == '__main__':
+	unittest.main()
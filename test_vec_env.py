@@ -0,0 +1,42 @@
+import math
+import unittest
+import numpy as np
+from itertools import product
+from vec_env import varying_transition_env, WIND_DELTAS
+from varying_transition_mlp import TransitionFunction, State, Action, obstacle_movement
+
+
+class TransitionTableTest(unittest.TestCase):
+	def setUp(self):
+		self.env = varying_transition_env(1, 0.1, tables=True, table_cache_dir=None)
+
+	def script_transition(self, coordinates, t, action, wind):
+		# next cell of the scripts' TransitionFunction from the obstacles at time t, wind 0 - none, k+1 - pushed along
+		# wind phase k (prob 1)
+		T = TransitionFunction(self.env.width, self.env.height, obstacle_movement, 4, prob=0.0 if wind == 0 else 1.0)
+		T.phase = lambda t: (wind - 1 if wind > 0 else 0)*math.pi/2
+		obstacles = [tuple(int(c) for c in o) for o in self.env.obstacles_at(np.array([t]))[0]]
+		return T(State(coordinates, obstacles), Action(action), t).coordinates
+
+	def test_table_matches_transition_function(self):
+		for t, x, y, a, w in product(range(self.env.obs_period), range(self.env.width), range(self.env.height), range(5), range(len(WIND_DELTAS) + 1)):
+			cell = self.env.table[t, x, y, a, w]
+			if cell >= 0:
+				# -1 where every move is blocked, the scripts exit there
+				self.assertEqual((cell // self.env.height, cell % self.env.height), self.script_transition((x, y), t, a, w))
+
+	def test_step_with_and_without_tables(self):
+		# same random stream, so the same trajectories
+		actions = np.random.RandomState(0).randint(0, high=5, size=(200, 64))
+		runs = []
+		for tables in [False, True]:
+			np.random.seed(1)
+			env = varying_transition_env(64, 0.3, tables=tables, table_cache_dir=None, max_episode_length=30)
+			runs.append([env.step(a) for a in actions])
+		for a, b in zip(*runs):
+			for x, y in zip(a, b):
+				np.testing.assert_array_equal(x, y)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -3,14 +3,19 @@ import copy
 import math
 import random
 import numpy as np
-from phase_gru import PGRU
+from phase_gru import PGRU, LowRankPGRU
 from gru import GRU
+from replay import PrioritizedEpisodeReplay, SequenceReplay
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
 from itertools import product
 
+# output locations, the sweep runner points them at a per job directory
+PLOT_DIR = '/mnt/sdb1/arjun/plotfiles/'
+CHECKPOINT_DIR = '/mnt/sdb1/arjun/checkpoints/'
+
 def create_obstacles(width, height):
 	return [(3,3),(6,3),(3,6),(6,6)] # 12 x 12
 
@@ -28,35 +33,109 @@ def obstacle_movement(t):
 	elif t % 6 == 5:
 		return (-1, 0) # move left
 
-def create_targets(memory, q_vals, target_net, policy_type, gamma=1, last_n=0.5):
+def create_targets(memory, q_vals, target_net, policy_type, gamma=1, last_n=0.5, start=0, n_total=None):
 	# memory: 0 - current_state 1: action index 2: reward 3: next state
+	# start, n_total - position of memory in its episode and the episode length when memory is a truncated bptt window.
+	# the target net (in inference mode, see main) carries its hidden state, detached, from one window to the next and
+	# is reset after the last one
 	n_eps = len(memory)
+	if n_total is None:
+		n_total = n_eps
 	action_space_size = target_net.output_size 
 	q_target = torch.zeros((n_eps, action_space_size))
+	td_errors = [] # of the steps that get targets, used as replay priority
 	
 	for i in range(n_eps):
-		if i < (1-last_n)*n_eps:
+		if start + i < (1-last_n)*n_total:
 			q_target[i,:] = q_vals[i][0,:].data.clone()
 		else:
 			phase_prime = memory[i][5]
 			if policy_type == 0:
-				s_prime = Variable(torch.from_numpy(np.array(memory[i][3].state)).float(), requires_grad=False).unsqueeze(0)
+				s_prime = Variable(torch.from_numpy(np.array(memory[i][3].state)).float(), volatile=True).unsqueeze(0)
 				q_prime = target_net.forward(s_prime)
 			elif policy_type == 1:
 				inp = np.concatenate((np.array(memory[i][3].state), np.asarray([phase_prime])))
-				s_prime = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
+				s_prime = Variable(torch.from_numpy(inp).float(), volatile=True).unsqueeze(0)
 				q_prime = target_net.forward(s_prime)
 			elif policy_type == 2:
-				s_prime = Variable(torch.from_numpy(np.array(memory[i][3].state)).float(), requires_grad=False).unsqueeze(0)
+				s_prime = Variable(torch.from_numpy(np.array(memory[i][3].state)).float(), volatile=True).unsqueeze(0)
 				q_prime = target_net.forward(s_prime, phase_prime)
 
 
 			q_target[i,:] = q_vals[i][0,:].data.clone()
 			q_target[i, memory[i][1]] = memory[i][2] + gamma*q_prime.data[0,np.argmax(q_prime.data.numpy())]*(1-float(memory[i][6]))
+			td_errors.append(q_target[i, memory[i][1]] - q_vals[i].data[0, memory[i][1]])
 			#q_target[i, memory[i][1]] = memory[i][2] + gamma*q_prime.data[0,np.argmax(q_prime.data.numpy())]
 
-	target_net.reset()
-	return q_target
+	if start + n_eps >= n_total:
+		target_net.reset()
+	else:
+		target_net.truncate()
+	return q_target, np.array(td_errors)
+
+
+def sequence_loss(policy, target_net, seq, policy_type, burn_in=0, gamma=1):
+	# td loss over a [T, B] batch of replayed windows (replay.SequenceReplay), the first burn_in rows of every window
+	# only warm up the hidden state: the policy runs them separately and the state is detached before the trained
+	# rows, so no gradient flows into the burn-in. padding steps and the steps loss_mask leaves out (see the last_n of
+	# sample_sequences) get zero error. the target net runs over the next states of the same windows, as
+	# create_targets does over an episode
+	states, states_prime = seq.states, seq.states_prime
+	if policy_type == 1:
+		states = torch.cat((states, seq.phases.unsqueeze(2)), 2)
+		states_prime = torch.cat((states_prime, seq.phases_prime.unsqueeze(2)), 2)
+	x = Variable(states.float(), requires_grad=False)
+	x_prime = Variable(states_prime.float(), requires_grad=False)
+	# recorded actor state (if stored) for both nets, the burn-in refreshes it
+	hidden = None
+	if seq.hidden is not None:
+		hidden = [Variable(h.float(), requires_grad=False) for h in seq.hidden]
+	resets = seq.resets.numpy()
+	phases, phases_prime = seq.phases.numpy(), seq.phases_prime.numpy()
+
+	def run(net, x, rows, hidden):
+		if policy_type == 2:
+			return net.forward_sequence(x[rows], phases[rows], resets=resets[rows], hidden=hidden)
+		return net.forward_sequence(x[rows], resets=resets[rows], hidden=hidden)
+
+	trained = slice(burn_in, x.size(0))
+	if burn_in > 0:
+		_, h = run(policy, x, slice(0, burn_in), hidden)
+		# columns whose episode only starts after the burn-in are reset to the initial state, not to the burn-in output
+		fresh = Variable(torch.from_numpy(resets[trained].any(0).astype(np.float32)), requires_grad=False).float().unsqueeze(1)
+		h_init = hidden if hidden is not None else [Variable(h_n.data.new(h_n.size()).zero_(), requires_grad=False) for h_n in h]
+		h = [Variable(h_n.data, requires_grad=False)*(1 - fresh) + h_0*fresh for h_n, h_0 in zip(h, h_init)]
+	else:
+		h = hidden
+	q, _ = run(policy, x, trained, h)
+	if policy_type == 2:
+		q_prime, _ = target_net.forward_sequence(x_prime, phases_prime, resets=resets, hidden=hidden)
+	else:
+		q_prime, _ = target_net.forward_sequence(x_prime, resets=resets, hidden=hidden)
+	q_prime = q_prime[trained]
+
+	actions = seq.actions[burn_in:].unsqueeze(2)
+	if q.is_cuda:
+		actions = actions.cuda()
+	q_taken = q.gather(2, Variable(actions, requires_grad=False)).squeeze(2)
+	rewards = Variable(seq.rewards[burn_in:].float(), requires_grad=False)
+	not_terminal = Variable((1 - seq.terminals[burn_in:]).float(), requires_grad=False)
+	loss_mask = Variable(seq.loss_mask[burn_in:].float(), requires_grad=False)
+	targets = rewards + gamma*q_prime.max(2)[0].detach()*not_terminal
+	error = (q_taken - targets)*loss_mask
+	# same scale as the MSELoss of the whole episode updates: over all real steps and actions, the steps without a
+	# target count with zero error
+	return torch.sum(error*error)/(max(float(seq.mask[burn_in:].float().sum()), 1.0)*q.size(2))
+
+def add_episode(M, episode_experience):
+	if isinstance(M, SequenceReplay):
+		M.start_episode()
+		columns = list(zip(*episode_experience))
+		# columns[7] - hidden states recorded while acting, missing for the random burn in episodes
+		hidden = np.array(columns[7]) if len(columns) > 7 and columns[7][0] is not None else None
+		M.add_batch(np.array([e.state for e in columns[0]]), np.array(columns[1]), np.array(columns[2]), np.array([e.state for e in columns[3]]), np.array(columns[4]), np.array(columns[5]), np.array(columns[6]), hidden=hidden)
+	else:
+		M.add(episode_experience)
 
 
 def goal_1_reward_func(w,t,p):
@@ -214,7 +293,7 @@ class ExperienceReplay():
 			self.memory.append(experience)
 			self.oldest = 0
 		else:
-			self.memory.insert(self.oldest, experience)
+			self.memory[self.oldest] = experience
 			self.oldest = (self.oldest + 1) % self.max_memory_size
 
 	def sample(self):
@@ -252,6 +331,15 @@ def main():
 	burn_in = 100
 	batch_size = 1
 	n_backprop = 0.5 # last n_backprop % of time steps will be used for the loss.
+	prioritized_flag = False # sample episodes by td error instead of uniformly
+	sequence_flag = False # train on a batch of replayed fixed length windows per update instead of one whole episode, with the same n_backprop rule
+	n_sequences = 32
+	seq_len = 20
+	seq_burn_in = 10 # steps before every window that only warm up the hidden state, no gradient flows through them
+	tbptt_window = 0 # truncated bptt window in steps for the whole episode updates, 0 - backpropagate through the whole episode
+	stored_state_flag = False # start windows from the hidden state recorded while acting (float16) instead of zeros
+	stacked_flag = False # policy_type 2 keeps its control points as (4, ...) parameters, the spline blend runs through autograd
+	low_rank = 0 # > 0 - policy_type 2 uses LowRankPGRU, control cells share a base weight and differ by factors of this rank
 	policy_type = int(sys.argv[1])
 
 	obstacles = create_obstacles(width,height)
@@ -262,8 +350,6 @@ def main():
 	s = State(start_loc,obstacles)
 	T = TransitionFunction(width,height,obstacle_movement)
 	R = RewardFunction(penalty=-1,goal_1_coordinates=(11,0),goal_1_func=goal_1_reward_func,goal_2_coordinates=(11,11),goal_2_func=goal_2_reward_func, w1=math.pi/4, w2=math.pi/8)
-	M = ExperienceReplay(max_memory_size=1000)
-	
 	if policy_type == 0: # rnn without phase
 		policy = GRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1)
 		target_net = GRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1)
@@ -271,16 +357,29 @@ def main():
 		policy = GRU(input_size=s.state.shape[0]+1, output_size=5, hidden_size=8, n_layers=2, batch_size=1)
 		target_net = GRU(input_size=s.state.shape[0]+1, output_size=5, hidden_size=8, n_layers=2, batch_size=1)
 	elif policy_type == 2: # phase rnn
-		policy = PGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1)
-		target_net = PGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1)
+		policy = PGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1, stacked=stacked_flag)
+		target_net = PGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, n_layers=2, batch_size=1, stacked=stacked_flag)
+		if low_rank > 0:
+			policy = LowRankPGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, rank=low_rank, n_layers=2, batch_size=1)
+			target_net = LowRankPGRU(input_size=s.state.shape[0], output_size=5, hidden_size=8, rank=low_rank, n_layers=2, batch_size=1)
+
+	if sequence_flag:
+		M = SequenceReplay(max_memory_size=100000, state_size=s.state.shape[0], seq_len=seq_len, burn_in=seq_burn_in, hidden_shape=(policy.n_layers, policy.hidden_size) if stored_state_flag else None)
+	elif prioritized_flag:
+		M = PrioritizedEpisodeReplay(max_memory_size=1000)
+	else:
+		M = ExperienceReplay(max_memory_size=1000)
 
 
 	#target_net = copy.deepcopy(policy)
-	for p, p_t in zip(policy.parameters(), target_net.parameters()):
-		p_t.data.copy_(p.data)
+	target_net.load_state_dict(policy.state_dict())
+	# the target net is never trained: in inference mode its steps record nothing (phase nets read the phase cache) and
+	# reset() gives it a volatile hidden state, so create_targets builds no graph across the windows
+	target_net.inference(True)
+	target_net.reset()
 
 	criterion = nn.MSELoss()
-	optimizer = optim.Adam(policy.parameters(), lr=0.0001)
+	optimizer = policy.watch(optim.Adam(policy.parameters(), lr=0.0001)) # keeps the phase cache in step with the weights
 
 	list_of_total_rewards = []
 	list_of_n_episodes = []
@@ -305,51 +404,52 @@ def main():
 				break
 			s = s_prime
 
-		M.add(episode_experience)
+		add_episode(M, episode_experience)
 		R.reset()
 		start_loc = sample_start(set_diff)
 		s = State(start_loc,obstacles)
 
 	print 'Burn in completed'
 
-	filename = '/mnt/sdb1/arjun/plotfiles/' + sys.argv[2]
+	filename = PLOT_DIR + sys.argv[2]
 	print 'Writing to ' + filename
 	f = open(filename,'w')
 
 	for i in range(n_episodes):
+		if prioritized_flag and not sequence_flag:
+			M.anneal_beta(i/float(n_episodes))
 		total_reward = 0
 		episode_experience = []
 		# zero gradients
 		optimizer.zero_grad()
+		policy.inference(True) # acting only, switched back before the update
 		for j in range(max_episode_length):
 			phase = R.phase()
+			hidden = policy.hidden_state()[:,0] if stored_state_flag else None # state the action is taken with
 			if policy_type == 0:
-				x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
+				q = policy.act(s.state)
 			elif policy_type == 1:
 				inp = np.concatenate((s.state,np.asarray([phase])))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
+				q = policy.act(inp)
 			elif policy_type == 2:
-				x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x, phase)
+				q = policy.act(s.state, phase)
 
 
-			a = Action(epsilon_greedy_linear_decay(q.data.numpy(), 25000, i))
+			a = Action(epsilon_greedy_linear_decay(q, 25000, i))
 			#a = Action(epsilon_greedy(q.data.numpy(), 0.1))
 			t = R.t
 			s_prime = T(s,a,t)
 			reward = R(s,a,s_prime)
 			total_reward += reward
 			phase_prime = R.phase()
-			episode_experience.append((s,a.delta,reward,s_prime,phase,phase_prime,R.terminal))
+			episode_experience.append((s,a.delta,reward,s_prime,phase,phase_prime,R.terminal,hidden))
 			if R.terminal == True:
 				#print 'Reached goal state!'
 				break
 			#q_vals.append(q)
 			s = s_prime
 
-		M.add(episode_experience)
+		add_episode(M, episode_experience)
 		#print 'Episode lasted for %d steps.' % (j+1)
 		#print 'Total reward collected: ', total_reward
 		list_of_total_rewards.append(total_reward)
@@ -360,52 +460,75 @@ def main():
 		# write to file for plotting
 		f.write(str(total_reward) + ' ' + str(j+1) + '\n')
 
+		policy.inference(False)
 		policy.reset()
 
 		# save policy
 		if i % 1000 == 0 and i> 0:
-			checkpoint_name = '/mnt/sdb1/arjun/checkpoints/' + sys.argv[3] + '_' + str(i) + '.pth'
+			checkpoint_name = CHECKPOINT_DIR + sys.argv[3] + '_' + str(i) + '.pth'
 			f_w = open(checkpoint_name, 'wb')
 			torch.save(policy,f_w)
 
-		# forward pass through memory samples
-		for _ in range(batch_size):
-			memory = M.sample()
-			q_vals = []
-			for j in range(len(memory)):
-				s = memory[j][0]
-				phase = memory[j][4]
-				if policy_type == 0:
-					x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-					q = policy.forward(x)
-				elif policy_type == 1:
-					inp = np.concatenate((s.state,np.asarray([phase])))
-					x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-					q = policy.forward(x)
-				elif policy_type == 2:
-					x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-					q = policy.forward(x, phase)
-
-
-				q_vals.append(q)
-
-			# backward pass
-			targets = Variable(create_targets(memory, q_vals, target_net, policy_type, gamma=1, last_n=n_backprop), requires_grad=False)
-			outputs = torch.stack(q_vals,0).squeeze(1)
-			loss = criterion(outputs, targets)
-			loss.backward(retain_variables=False)
-
-			# phase gru step
-			if policy_type == 2:
-				policy.update_control_gradients()
-
-			# reset reward and policy hidden state
-			policy.reset()
-			R.reset()
-
-		# divide gradients by batch size
-		for p in policy.parameters():
-			p.grad.data /= batch_size
+		if sequence_flag:
+			# a batch of windows in one forward_sequence, gradients land directly on the (control point) parameters
+			loss = sequence_loss(policy, target_net, M.sample_sequences(n_sequences, last_n=n_backprop), policy_type, burn_in=seq_burn_in, gamma=1)
+			loss.backward()
+		else:
+			# forward pass through memory samples
+			for _ in range(batch_size):
+				if prioritized_flag:
+					episodes, idx, weights = M.sample_weighted(1)
+					memory = episodes[0]
+				else:
+					memory = M.sample()
+				# truncated bptt: the episode goes through in windows of tbptt_window steps (one window if 0). after every window's
+				# backward, policy.truncate() folds the phase gru gradients, frees the stored steps and detaches the hidden state
+				window = tbptt_window if tbptt_window > 0 else len(memory)
+				td_errors = []
+				for start in range(0, len(memory), window):
+					q_vals = []
+					for j in range(start, min(start + window, len(memory))):
+						s = memory[j][0]
+						phase = memory[j][4]
+						if policy_type == 0:
+							x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
+							q = policy.forward(x)
+						elif policy_type == 1:
+							inp = np.concatenate((s.state,np.asarray([phase])))
+							x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
+							q = policy.forward(x)
+						elif policy_type == 2:
+							x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
+							q = policy.forward(x, phase)
+
+
+						q_vals.append(q)
+
+					# backward pass
+					q_target, window_td_errors = create_targets(memory[start:start + window], q_vals, target_net, policy_type, gamma=1, last_n=n_backprop, start=start, n_total=len(memory))
+					td_errors.extend(window_td_errors)
+					targets = Variable(q_target, requires_grad=False)
+					outputs = torch.stack(q_vals,0).squeeze(1)
+					# mse over the whole episode, split over the windows
+					loss = criterion(outputs, targets)*(len(q_vals)/float(len(memory)))
+					if prioritized_flag:
+						loss = float(weights[0])*loss
+					loss.backward(retain_variables=False)
+
+					# phase gru step, then cut the graph
+					policy.truncate()
+
+				if prioritized_flag:
+					# one importance sampling weight per episode, priority from the mean td error of its trained steps
+					M.update_priorities(idx, [np.mean(np.abs(td_errors))])
+
+				# reset reward and policy hidden state
+				policy.reset()
+				R.reset()
+
+			# divide gradients by batch size
+			for p in policy.parameters():
+				p.grad.data /= batch_size
 
 		# clip gradients here ...
 		nn.utils.clip_grad_norm(policy.parameters(), 5.0)
@@ -423,12 +546,12 @@ def main():
 		# copy into target network
 		if i % n_copy_after == 0 and i > 0:
 			#target_net = copy.deepcopy(policy)
-			for p, p_t in zip(policy.parameters(), target_net.parameters()):
-				p_t.data.copy_(p.data)
+			target_net.load_state_dict(policy.state_dict())
 
 
 	# testing with greedy policy
 	print 'Using greedy policy ...'
+	policy.inference(True)
 	start_loc = (0,5)
 	s = State(start_loc, obstacles)
 	R.reset()
@@ -437,17 +560,14 @@ def main():
 	while R.terminal == False:
 		phase = R.phase()
 		if policy_type == 0:
-			x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
+			q = policy.act(s.state)
 		elif policy_type == 1:
 			inp = np.concatenate((s.state,np.asarray([phase])))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
+			q = policy.act(inp)
 		elif policy_type == 2:
-			x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x, phase)
+			q = policy.act(s.state, phase)
 
-		a = Action(np.argmax(q.data.numpy()))
+		a = Action(np.argmax(q))
 		t = R.t
 		s_prime = T(s,a,t)
 		reward = R(s,a,s_prime)
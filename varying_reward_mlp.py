@@ -2,16 +2,24 @@ import sys
 import copy
 import math
 import random
+import time
 import numpy as np
-from phase_mlp_multilayer_new import PMLP
-from lstm import LSTM
+from functools import partial
+from phase_mlp import PMLP, LowRankPMLP
 from mlp import MLP
+from replay import ArrayReplay, FrameStackReplay, PrioritizedFrameStackReplay
+from actor_learner import ActorLearner
+from vec_env import varying_reward_env
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
 from itertools import product
 
+# output locations, the sweep runner points them at a per job directory
+PLOT_DIR = 'plotfiles/'
+CHECKPOINT_DIR = 'checkpoints/'
+
 def create_obstacles(width, height):
 	#return [(4,6),(9,6),(14,6),(4,12),(9,12),(14,12)] # 19 x 19
 	#return [(3,5),(7,5),(11,5),(3,10),(7,10),(11,10)] # 17 x 17
@@ -33,27 +41,70 @@ def obstacle_movement(t):
 	elif t % 6 == 5:
 		return (-1, 0) # move left
 
-def create_targets(inp, memory, q_vals, target_net, policy_type, gamma=1):
-	# memory: 0 - set of current_states 1: action index 2: reward 3: next state 4: phase 5: phase_prime
-	n_eps = len(memory)
-	action_space_size = target_net.output_size 
+def create_targets(inp, memory, q_vals, target_net, policy_type, gamma=1, idx=None, cache=None):
+	# memory: Transitions sampled from the replay, inp: next state inputs as built by M.tar_arr_from_samples.
+	# with a TargetCache (and the replay slots idx of the sample) only the slots missing from it go through target_net
+	q_max = np.zeros(len(inp), dtype=np.float32)
+	miss = np.ones(len(inp), dtype=np.bool_)
+	if cache is not None:
+		q_max, hit = cache.lookup(idx)
+		miss = ~hit
+	if np.any(miss):
+		if policy_type == 0 or policy_type == 1:
+			x = Variable(torch.from_numpy(inp[miss]).float(), requires_grad=False)
+			q_prime = target_net.forward(x)
+		elif policy_type == 2:
+			x = Variable(torch.from_numpy(inp[miss][:,:-1]).float(), requires_grad=False)
+			q_prime = target_net.forward_batch(x,inp[miss][:,-1])
+		q_max[miss] = q_prime.data.max(1)[0].view(-1).cpu().numpy()
+		if cache is not None:
+			cache.store(idx[miss], q_max[miss])
+
+	# bellman backup on the taken actions for the whole batch, other actions keep the current estimate
 	q_target = q_vals.data.clone()
-	
+	actions = torch.from_numpy(memory.actions).long().view(-1,1)
+	rewards = torch.from_numpy(memory.rewards).float()
+	q_max = torch.from_numpy(q_max)
+	new_values = gamma*(rewards + q_max)
+	q_target.scatter_(1, actions, new_values.view(-1,1))
+	# td errors of the taken actions, used as replay priorities
+	td_errors = (new_values - q_vals.data.gather(1, actions).view(-1)).cpu().numpy()
+
+	target_net.reset()
+	return q_target, td_errors
+
+def weighted_mse(outputs, targets, weights):
+	# mean squared error with one importance sampling weight per row, equal to nn.MSELoss for weights of 1
+	w = Variable(torch.from_numpy(weights).type_as(outputs.data).view(-1,1), requires_grad=False)
+	return torch.mean(w*(outputs - targets)**2)
+
+def learn(policy, target_net, M, policy_type, batch_size):
+	# forward pass, targets and backward pass on one replay minibatch, the optimizer step is left to the caller
+	memory, idx, weights = M.sample_weighted(batch_size)
+	inp = M.inp_arr_from_samples(memory, policy_type)
+	tar = M.tar_arr_from_samples(memory, policy_type)
 	if policy_type == 0 or policy_type == 1:
 		x = Variable(torch.from_numpy(inp).float(), requires_grad=False)
-		q_prime = target_net.forward(x)
-	elif policy_type == 2:
-		phase = inp[-1]
-		x = Variable(torch.from_numpy(inp[:-1]).float(), requires_grad=False).unsqueeze(0)
-		q_prime = target_net.forward(x,phase)
+		outputs = policy.forward(x)
+
+		# backward pass
+		q_target, td_errors = create_targets(tar, memory, outputs, target_net, policy_type, gamma=1, idx=idx, cache=M.target_cache)
+		targets = Variable(q_target, requires_grad=False)
+		#outputs = torch.stack(q_vals,0).squeeze(1)
+		loss = weighted_mse(outputs, targets, weights)
+		loss.backward(retain_variables=False)
 
-	max_action_idx = np.argmax(q_prime.data.numpy(), axis=1)
+	elif policy_type == 2:
+		x = Variable(torch.from_numpy(inp[:,:-1]).float(), requires_grad=False)
+		outputs = policy.forward_batch(x, inp[:,-1])
 
-	for i in range(n_eps):
-		q_target[i, memory[i][1]] = gamma*(memory[i][2] + q_prime.data[i,max_action_idx[i]])
+		# backward pass
+		q_target, td_errors = create_targets(tar, memory, outputs, target_net, policy_type, gamma=1, idx=idx, cache=M.target_cache)
+		targets = Variable(q_target, requires_grad=False)
+		loss = weighted_mse(outputs, targets, weights)
+		loss.backward(retain_variables=False)
 
-	target_net.reset()
-	return q_target
+	M.update_priorities(idx, td_errors)
 
 
 def goal_1_reward_func(w,t,p):
@@ -198,53 +249,6 @@ class TransitionFunction():
 
 
 
-class ExperienceReplay():
-	def __init__(self, max_memory_size = 100):
-		self.memory = []
-		self.oldest = -1
-		self.max_memory_size = max_memory_size
-	
-	def add(self, experience):
-		if len(self.memory) < self.max_memory_size: 
-			self.memory.append(experience)
-			self.oldest = 0
-		else:
-			self.memory.insert(self.oldest, experience)
-			self.oldest = (self.oldest + 1) % self.max_memory_size
-
-	def sample(self,n):
-		idx = np.random.randint(0, high=len(self.memory),size=(n,))
-		return [self.memory[i] for i in idx]
-
-	def inp_arr_from_samples(self, sample_list, policy_type):
-		state_len = 3*len(sample_list[0][0][0].state)
-		if policy_type == 0:
-			inp_arr = np.zeros((len(sample_list),state_len))
-		elif policy_type == 1 or policy_type == 2:
-			inp_arr = np.zeros((len(sample_list),state_len+1))
-		for i in range(len(sample_list)):
-			if policy_type == 0:
-				inp_arr[i,:] = np.concatenate((sample_list[i][0][0].state, sample_list[i][0][1].state, sample_list[i][0][2].state))
-			elif policy_type == 1 or policy_type == 2:
-				inp_arr[i,:] = np.concatenate((sample_list[i][0][0].state, sample_list[i][0][1].state, sample_list[i][0][2].state,  np.array([sample_list[i][4]])))
-
-		return inp_arr
-
-	def tar_arr_from_samples(self, sample_list, policy_type):
-		state_len = 3*len(sample_list[0][0][0].state)
-		if policy_type == 0:
-			tar_arr = np.zeros((len(sample_list),state_len))
-		elif policy_type == 1 or policy_type == 2:
-			tar_arr = np.zeros((len(sample_list),state_len+1))
-		for i in range(len(sample_list)):
-			if policy_type == 0:
-				tar_arr[i,:] = np.concatenate((sample_list[i][0][1].state, sample_list[i][0][2].state, sample_list[i][3].state))
-			elif policy_type == 1 or policy_type == 2:
-				tar_arr[i,:] = np.concatenate((sample_list[i][0][1].state, sample_list[i][0][2].state, sample_list[i][3].state,  np.array([sample_list[i][5]])))
-
-		return tar_arr
-
-
 def epsilon_greedy_linear_decay(action_vector, n_episodes, n, low=0.1, high=0.9):
 	if n <= n_episodes:
 		eps = ((low-high)/n_episodes)*n + high
@@ -265,6 +269,44 @@ def epsilon_greedy(action_vector, eps):
 def sample_start(set_diff):
 	return random.choice(set_diff)
 
+def greedy_test(policy, policy_type, T, R, obstacles):
+	print 'Using greedy policy ...'
+	policy.inference(True)
+	start_loc = (0,5)
+	s_2 = State(start_loc, obstacles)
+	s_1 = State(start_loc, obstacles)
+	s = State(start_loc, obstacles)
+	R.reset()
+	total_reward = 0
+	step_count = 0
+	while R.terminal == False:
+		phase = R.phase()
+		if policy_type == 0:
+			inp = np.concatenate((s_2.state, s_1.state, s.state))
+			q = policy.act(inp)
+		elif policy_type == 1:
+			inp = np.concatenate((s_2.state, s_1.state, s.state, np.asarray([phase])))
+			q = policy.act(inp)
+		elif policy_type == 2:
+			inp = np.concatenate((s_2.state, s_1.state, s.state))
+			q = policy.act(inp, phase)
+
+		a = Action(np.argmax(q))
+		t = R.t
+		s_prime = T(s,a,t)
+		reward = R(s,a,s_prime)
+		total_reward += reward
+		step_count += 1
+		if step_count >= 1000:
+			print 'Episode length limit exceeded in greedy!'
+			break
+		s_2 = s_1 # states are never modified in place, no need to copy
+		s_1 = s
+		s = s_prime
+
+	print 'Total reward', total_reward
+	print 'Number of steps', step_count
+
 def main():
 	height = width = 12
 	max_episode_length = 600
@@ -273,6 +315,16 @@ def main():
 	burn_in = 1000
 	policy_type = int(sys.argv[1])
 	batch_size = 32
+	prioritized_flag = False # sample transitions by td error instead of uniformly
+	target_cache_flag = True # reuse the target network values of replay slots until the next target copy
+	async_flag = False # act in separate processes and update continuously, one update per loop instead of per episode
+	n_actors = 4
+	envs_per_actor = 16
+	refresh_after = 50 # actor steps between policy reloads
+	publish_after = 10 # updates between policy publishes to the actors
+	async_burn_in = 5000 # transitions in the replay before the first update
+	stacked_flag = False # policy_type 2 keeps its control points as (4, ...) parameters, the spline blend runs through autograd
+	low_rank = 0 # > 0 - policy_type 2 uses LowRankPMLP, control points share a base weight and differ by factors of this rank
 
 	obstacles = create_obstacles(width,height)
 
@@ -282,27 +334,87 @@ def main():
 	s = State(start_loc,obstacles)
 	T = TransitionFunction(width,height,obstacle_movement)
 	R = RewardFunction(penalty=-1,goal_1_coordinates=(11,0),goal_1_func=goal_1_reward_func,goal_2_coordinates=(11,11),goal_2_func=goal_2_reward_func, w1=math.pi/8, w2=math.pi/8)
-	M = ExperienceReplay(max_memory_size=10000)
+	if prioritized_flag:
+		M = PrioritizedFrameStackReplay(max_memory_size=10000, frame_size=s.state.shape[0], target_cache=target_cache_flag)
+	else:
+		M = FrameStackReplay(max_memory_size=10000, frame_size=s.state.shape[0], target_cache=target_cache_flag)
 	
 	if policy_type == 0: # mlp without phase
 		policy = MLP(input_size=s.state.shape[0]*3, output_size=5, hidden_size=16, n_layers=2)
 	elif policy_type == 1: # mlp with phase as additional input
 		policy = MLP(input_size=s.state.shape[0]*3+1, output_size=5, hidden_size=16, n_layers=2)
 	elif policy_type == 2:
-		policy = PMLP(input_size=s.state.shape[0]*3, output_size=5, hidden_size=16, n_layers=2)
+		policy = PMLP(input_size=s.state.shape[0]*3, output_size=5, hidden_size=16, n_layers=2, stacked=stacked_flag)
+	if policy_type == 2 and low_rank > 0:
+		policy = LowRankPMLP(input_size=s.state.shape[0]*3, output_size=5, hidden_size=16, rank=low_rank, n_layers=2)
 
 	target_net = copy.deepcopy(policy)
 	criterion = nn.MSELoss()
-	optimizer = optim.Adam(policy.parameters(), lr=0.0001)
+	optimizer = policy.watch(optim.Adam(policy.parameters(), lr=0.0001)) # keeps the phase cache in step with the weights
 
 	list_of_total_rewards = []
 	list_of_n_episodes = []
 
+	if async_flag:
+		# stacked transitions come from the actors, uniform replay only
+		M = ArrayReplay(max_memory_size=10000, state_size=s.state.shape[0]*3, target_cache=target_cache_flag)
+		learner = ActorLearner(policy, partial(varying_reward_env, envs_per_actor, max_episode_length=max_episode_length), policy_type, n_actors=n_actors, refresh_interval=refresh_after)
+		learner.start()
+		filename = PLOT_DIR + sys.argv[2]
+		print 'Writing to ' + filename
+		f = open(filename,'w')
+		while len(M) < async_burn_in:
+			learner.drain(M)
+			time.sleep(0.01)
+		print 'Burn in completed'
+
+		last_copy = 0 # finished episodes at the last target copy
+		# here n_episodes is the number of learner updates, the actors finish episodes at their own pace
+		for i in range(n_episodes):
+			learner.drain(M)
+			for total_reward, n_steps in learner.pop_episodes():
+				list_of_total_rewards.append(total_reward)
+				list_of_n_episodes.append(n_steps)
+				f.write(str(total_reward) + ' ' + str(n_steps) + '\n')
+			if i % 500 == 0 and i > 0:
+				info = learner.info()
+				print str(i) + ': Avg. Reward: ' + str(np.mean(list_of_total_rewards[-500:])) + ' Avg. Episode length: ' + str(np.mean(list_of_n_episodes[-500:])) + ' Transitions: ' + str(info['transitions'])
+				print 'Queue depth: ' + str(info['mean_queue_depth']) + ' Staleness: ' + str(info['mean_staleness']) + ' (max ' + str(info['max_staleness']) + ')'
+				learner.reset_stats()
+				if M.target_cache is not None:
+					print 'Target cache hit rate: ' + str(M.target_cache.info()['hit_rate'])
+					M.target_cache.reset_stats()
+
+			# save policy
+			if i % 1000 == 0 and i> 0:
+				checkpoint_name = CHECKPOINT_DIR + sys.argv[3] + '_' + str(i) + '.pth'
+				f_w = open(checkpoint_name, 'wb')
+				torch.save(policy,f_w)
+
+			optimizer.zero_grad()
+			learn(policy, target_net, M, policy_type, batch_size)
+			optimizer.step()
+
+			# the target copy and the actors' epsilon decay count finished episodes, as in the loop below, not updates
+			if i % publish_after == 0:
+				learner.publish(policy, len(list_of_total_rewards))
+			if len(list_of_total_rewards) - last_copy >= n_copy_after:
+				target_net = copy.deepcopy(policy)
+				last_copy = len(list_of_total_rewards)
+				if M.target_cache is not None:
+					M.target_cache.invalidate()
+
+		learner.stop()
+		greedy_test(policy, policy_type, T, R, obstacles)
+		f.close()
+		return
+
 	s_2 = State(start_loc,obstacles)
 	s_1 = State(start_loc,obstacles)
 	#Burn in with random policy
 	for i in range(burn_in):
 		#episode_experience = []
+		M.start_episode(s.state)
 		for j in range(max_episode_length):
 			phase = R.phase()
 			#x = Variable(torch.from_numpy(s.state).float(), requires_grad=False).unsqueeze(0)
@@ -314,12 +426,12 @@ def main():
 			s_prime = T(s,a,t)
 			reward = R(s,a,s_prime)
 			phase_prime = R.phase()
-			M.add(((s_2, s_1, s), a.delta, reward, s_prime, phase, phase_prime))
+			M.add(a.delta, reward, s_prime.state, phase, phase_prime, R.terminal)
 			if R.terminal == True:
 				#print 'Reached goal state!'
 				break
-			s_2 = copy.deepcopy(s_1)
-			s_1 = copy.deepcopy(s)
+			s_2 = s_1 # states are never modified in place, no need to copy
+			s_1 = s
 			s = s_prime
 
 		#M.add(episode_experience)
@@ -329,48 +441,49 @@ def main():
 
 	print 'Burn in completed'
 
-	filename = 'plotfiles/' + sys.argv[2]
+	filename = PLOT_DIR + sys.argv[2]
 	print 'Writing to ' + filename
 	f = open(filename,'w')
 
 	for i in range(n_episodes):
+		if prioritized_flag:
+			M.anneal_beta(i/float(n_episodes))
 		total_reward = 0
 		episode_experience = []
 		# zero gradients
 		optimizer.zero_grad()
+		policy.inference(True) # acting only, switched back before the update
 
 		#initialize previous two time steps to be the same as t=1
 		s_1 = State(start_loc,obstacles)
 		s_2 = State(start_loc,obstacles)
 
+		M.start_episode(s.state)
 		for j in range(max_episode_length):
 			phase = R.phase()
 			if policy_type == 0:
 				inp = np.concatenate((s_2.state, s_1.state, s.state))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
+				q = policy.act(inp)
 			elif policy_type == 1:
 				inp = np.concatenate((s_2.state, s_1.state, s.state, np.asarray([phase])))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x)
+				q = policy.act(inp)
 			elif policy_type == 2:
 				inp = np.concatenate((s_2.state, s_1.state, s.state))
-				x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-				q = policy.forward(x,phase)
-			a = Action(epsilon_greedy_linear_decay(q.data.numpy(), 25000, i))
+				q = policy.act(inp, phase)
+			a = Action(epsilon_greedy_linear_decay(q, 25000, i))
 			#a = Action(epsilon_greedy(q.data.numpy(), 0.1))
 			t = R.t
 			s_prime = T(s,a,t)
 			reward = R(s,a,s_prime)
 			total_reward += reward
 			phase_prime = R.phase()
-			M.add(((s_2, s_1, s), a.delta, reward, s_prime, phase, phase_prime))
+			M.add(a.delta, reward, s_prime.state, phase, phase_prime, R.terminal)
 			if R.terminal == True:
 				#print 'Reached goal state!'
 				break
 			#q_vals.append(q)
-			s_2 = copy.deepcopy(s_1)
-			s_1 = copy.deepcopy(s)
+			s_2 = s_1 # states are never modified in place, no need to copy
+			s_1 = s
 			s = s_prime # don't need to copy here, right?
 
 		#M.add(episode_experience)
@@ -380,51 +493,24 @@ def main():
 		list_of_n_episodes.append(j+1)
 		if i % 500 == 0 and i > 0:
 			print str(i) + ': Avg. Reward: ' + str(sum(list_of_total_rewards[i-500:i])/500.0) + ' Avg. Episode length: ' + str(sum(list_of_n_episodes[i-500:i])/500.0)
+			if M.target_cache is not None:
+				print 'Target cache hit rate: ' + str(M.target_cache.info()['hit_rate'])
+				M.target_cache.reset_stats()
 
 		# write to file for plotting
 		f.write(str(total_reward) + ' ' + str(j+1) + '\n')
 
+		policy.inference(False)
 		policy.reset()
 
 		# save policy
 		if i % 1000 == 0 and i> 0:
-			checkpoint_name = 'checkpoints/' + sys.argv[3] + '_' + str(i) + '.pth'
+			checkpoint_name = CHECKPOINT_DIR + sys.argv[3] + '_' + str(i) + '.pth'
 			f_w = open(checkpoint_name, 'wb')
 			torch.save(policy,f_w)
 
 		# forward pass through memory sample
-		memory = M.sample(batch_size)
-		inp = M.inp_arr_from_samples(memory, policy_type)
-		tar = M.tar_arr_from_samples(memory, policy_type)
-		if policy_type == 0 or policy_type == 1:
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False)
-			outputs = policy.forward(x)
-
-			# backward pass
-			targets = Variable(create_targets(tar, memory, outputs, target_net, policy_type, gamma=1), requires_grad=False)
-			#outputs = torch.stack(q_vals,0).squeeze(1)
-			loss = criterion(outputs, targets)
-			loss.backward(retain_variables=False)
-
-		elif policy_type == 2:
-			for batch_i in range(batch_size):
-				x = Variable(torch.from_numpy(inp[batch_i,:-1]).float(), requires_grad=False).unsqueeze(0)
-				phase = inp[batch_i,-1]
-				output = policy.forward(x,phase)
-
-				# backward pass
-				target = Variable(create_targets(tar[batch_i,:], [memory[batch_i]], output, target_net, policy_type, gamma=1), requires_grad=False)
-				#outputs = torch.stack(q_vals,0).squeeze(1)
-				loss = criterion(output, target)
-				loss.backward(retain_variables=False)
-
-				# phase lstm step
-				policy.update_control_gradients()
-
-			# divide gradients by batch size
-			for p in policy.parameters():
-				p.grad.data /= batch_size
-
+		learn(policy, target_net, M, policy_type, batch_size)
 
 		# clip gradients here ...
 		#nn.utils.clip_grad_norm(policy.parameters(), 5.0)
@@ -443,47 +529,12 @@ def main():
 		# copy into target network
 		if i % n_copy_after == 0 and i > 0:
 			target_net = copy.deepcopy(policy)
+			if M.target_cache is not None:
+				M.target_cache.invalidate()
 
 
 	# testing with greedy policy
-	print 'Using greedy policy ...'
-	start_loc = (0,5)
-	s_2 = State(start_loc, obstacles)
-	s_1 = State(start_loc, obstacles)
-	s = State(start_loc, obstacles)
-	R.reset()
-	total_reward = 0
-	step_count = 0
-	while R.terminal == False:
-		phase = R.phase()
-		if policy_type == 0:
-			inp = np.concatenate((s_2.state, s_1.state, s.state))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-		elif policy_type == 1:
-			inp = np.concatenate((s_2.state, s_1.state, s.state, np.asarray([phase])))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x)
-		elif policy_type == 2:
-			inp = np.concatenate((s_2.state, s_1.state, s.state))
-			x = Variable(torch.from_numpy(inp).float(), requires_grad=False).unsqueeze(0)
-			q = policy.forward(x,phase)
-
-		a = Action(np.argmax(q.data.numpy()))
-		t = R.t
-		s_prime = T(s,a,t)
-		reward = R(s,a,s_prime)
-		total_reward += reward
-		step_count += 1
-		if step_count >= 1000:
-			print 'Episode length limit exceeded in greedy!'
-			break
-		s_2 = copy.deepcopy(s_1)
-		s_1 = copy.deepcopy(s)
-		s = s_prime
-
-	print 'Total reward', total_reward
-	print 'Number of steps', step_count
+	greedy_test(policy, policy_type, T, R, obstacles)
 
 	f.close()
 
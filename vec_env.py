@@ -0,0 +1,239 @@
+import os
+import sys
+import math
+import hashlib
+import numpy as np
+from itertools import product
+
+# action index -> (dx, dy), same order as Action.oned_to_twod: none, up, down, left, right
+ACTION_DELTAS = np.array([(0,0), (0,1), (0,-1), (-1,0), (1,0)])
+# wind phase index k (phase = k*pi/2) -> (dx, dy): up, right, down, left
+WIND_DELTAS = np.array([(0,1), (1,0), (0,-1), (-1,0)])
+# obstacle fallback order of TransitionFunction: stay, right, left, down, up
+FALLBACK_DELTAS = np.array([(0,0), (1,0), (-1,0), (0,-1), (0,1)])
+# where precomputed transition tables are kept
+TABLE_CACHE_DIR = 'transition_tables'
+
+def create_obstacles(width, height):
+	return [(3,3),(6,3),(3,6),(6,6)] # 12 x 12
+
+def obstacle_movement(t):
+	if t % 6 == 0:
+		return (0,1) # move up
+	elif t % 6 == 1:
+		return (1,0) # move right
+	elif t % 6 == 2:
+		return (1,0) # move right
+	elif t % 6 == 3:
+		return (0,-1) # move down
+	elif t % 6 == 4:
+		return (-1,0) # move left
+	elif t % 6 == 5:
+		return (-1, 0) # move left
+
+def constant_reward(value):
+	return lambda w, t, p: value*np.ones(t.shape)
+
+def sinusoidal_reward(w, t, p):
+	return 20*np.sin(w*t + p) + 5
+
+
+class VecGridWorld():
+	# n independent copies of the grid world of the varying_* scripts stepped together with array ops.
+	# t is the reward timer (R.t), obstacles are moved by obs_func(t+1) and goal rewards use the incremented t.
+	# wind_w set gives the varying transition dynamics (phase redrawn from {0, pi/2, pi, 3pi/2} every wind_w steps and the
+	# agent pushed along it with probability wind_prob), otherwise the phase is the varying reward one, (min(w1,w2)*t + p) % 2pi
+	def __init__(self, n_envs, width=12, height=12, obstacles=None, obs_func=obstacle_movement, obs_period=6, penalty=-1, goal_1_coordinates=(11,0), goal_1_func=None, goal_2_coordinates=(11,11), goal_2_func=None, w1=math.pi/8, w2=math.pi/8, p=0, wind_w=None, wind_prob=0.1, max_episode_length=None, auto_reset=True, tables=False, table_cache_dir=TABLE_CACHE_DIR):
+		self.n_envs = n_envs
+		self.width = width
+		self.height = height
+		self.obstacles = np.array(obstacles if obstacles is not None else create_obstacles(width, height))
+		self.n_obs = self.obstacles.shape[0]
+		self.obs_period = obs_period
+		self.penalty = penalty
+		self.goal_1_coordinates = np.array(goal_1_coordinates)
+		self.goal_2_coordinates = np.array(goal_2_coordinates)
+		self.goal_1_func = goal_1_func if goal_1_func is not None else constant_reward(-20)
+		self.goal_2_func = goal_2_func if goal_2_func is not None else constant_reward(20)
+		self.w1 = w1
+		self.w2 = w2
+		self.p = p
+		self.wind_w = wind_w
+		self.wind_prob = wind_prob
+		self.max_episode_length = max_episode_length
+		self.auto_reset = auto_reset
+
+		# obstacles at time t are obstacles + offsets[t % obs_period] (obs_func must sum to zero over a period)
+		self.offsets = np.zeros((obs_period, 2), dtype=int)
+		for t in range(1, obs_period):
+			self.offsets[t] = self.offsets[t-1] + np.array(obs_func(t))
+		if np.any(self.offsets[-1] + np.array(obs_func(obs_period)) != 0):
+			print 'Obstacle movement is not periodic!!!'
+			sys.exit()
+		moved = self.obstacles[None,:,:] + self.offsets[:,None,:]
+		if np.any(moved < 0) or np.any(moved[:,:,0] >= width) or np.any(moved[:,:,1] >= height):
+			print 'Obstacle moved outside of the grid!!!'
+			sys.exit()
+
+		# tables - replace the per step collision handling by a lookup into a precomputed next cell table
+		self.table = self.load_table(table_cache_dir) if tables else None
+
+		self.start_cells = np.array(sorted(set(product(tuple(range(width)), tuple(range(height)))) - set(map(tuple, self.obstacles.tolist()))))
+		self.coordinates = np.zeros((n_envs, 2), dtype=int)
+		self.t = np.zeros(n_envs, dtype=int)
+		self.wind_phase = np.zeros(n_envs, dtype=int)
+		self.reset()
+
+	def reset(self, mask=None, start=None):
+		# reset the envs selected by the boolean mask (all if None), at start or at random free cells
+		idx = np.arange(self.n_envs) if mask is None else np.nonzero(mask)[0]
+		if start is not None:
+			self.coordinates[idx] = np.array(start)
+		else:
+			self.coordinates[idx] = self.start_cells[np.random.randint(0, high=len(self.start_cells), size=len(idx))]
+		self.t[idx] = 0
+		self.wind_phase[idx] = np.random.randint(0, high=4, size=len(idx))
+
+	def obstacles_at(self, t):
+		# (n, n_obs, 2) obstacle positions for a time per env
+		return self.obstacles[None,:,:] + self.offsets[t % self.obs_period][:,None,:]
+
+	def states(self):
+		# (n, 2*(n_obs+1)) rows laid out as State.state
+		return np.concatenate((self.coordinates, self.obstacles_at(self.t).reshape(self.n_envs, -1)), axis=1).astype(np.float64)
+
+	def phase(self):
+		# phase at the current timer of every env, T.phase(R.t) or R.phase() in the scripts
+		return self.phase_at(self.t, self.wind_phase)
+
+	def phase_at(self, t, wind_phase):
+		if self.wind_w is not None:
+			return wind_phase*math.pi/2
+		return (min(self.w1, self.w2)*t + self.p) % (2*math.pi)
+
+	def time_period(self, max_period=10000):
+		# smallest L such that obstacles, wind redraws, the phase and the goal rewards are the same at t and t + L, so a
+		# finite state can keep t % L instead of t. None if there is no such L up to max_period
+		base = self.obs_period
+		while self.wind_w is not None and base % self.wind_w != 0:
+			base += self.obs_period
+		for L in range(base, max_period + 1, base):
+			t = np.arange(0, L + 1)
+			d = self.phase_at(t + L, 0) - self.phase_at(t, 0)
+			if not np.allclose(np.sin(d), 0) or not np.allclose(np.cos(d), 1):
+				continue
+			if np.allclose(self.goal_1_func(self.w1, t + L, self.p), self.goal_1_func(self.w1, t, self.p)) and np.allclose(self.goal_2_func(self.w2, t + L, self.p), self.goal_2_func(self.w2, t, self.p)):
+				return L
+		return None
+
+	def blocked(self, coordinates, obstacles):
+		return np.any(np.all(coordinates[:,None,:] == obstacles, axis=2), axis=1)
+
+	def clamp(self, coordinates):
+		return np.stack((np.clip(coordinates[:,0], 0, self.width-1), np.clip(coordinates[:,1], 0, self.height-1)), axis=1)
+
+	def move(self, coordinates, delta, obstacles):
+		# next coordinates for the given deltas and obstacles, and a mask of the rows where every fallback is blocked
+		new_coordinates = self.clamp(coordinates + delta)
+		stuck = np.zeros(len(coordinates), dtype=np.bool_)
+		collide = self.blocked(new_coordinates, obstacles)
+		if np.any(collide):
+			# stay if possible, otherwise the first free cell of right, left, down, up
+			idx = np.nonzero(collide)[0]
+			candidates = np.stack([self.clamp(coordinates[idx] + d) for d in FALLBACK_DELTAS], axis=1)
+			free = np.stack([~self.blocked(candidates[:,k], obstacles[idx]) for k in range(len(FALLBACK_DELTAS))], axis=1)
+			stuck[idx] = ~np.any(free, axis=1)
+			new_coordinates[idx] = candidates[np.arange(len(idx)), np.argmax(free, axis=1)]
+
+		return new_coordinates, stuck
+
+	def transition(self, actions):
+		windy = np.zeros(self.n_envs, dtype=np.bool_)
+		if self.wind_w is not None:
+			windy = np.random.uniform(size=self.n_envs) < self.wind_prob
+
+		if self.table is not None:
+			# wind index 0 - no wind, k+1 - pushed along wind phase k
+			cells = self.table[self.t % self.obs_period, self.coordinates[:,0], self.coordinates[:,1], actions, (self.wind_phase + 1)*windy]
+			if np.any(cells < 0):
+				print 'There is an obstacle for every transition!!!'
+				sys.exit()
+			return np.stack((cells // self.height, cells % self.height), axis=1)
+
+		delta = ACTION_DELTAS[actions] + WIND_DELTAS[self.wind_phase]*windy[:,None]
+		new_coordinates, stuck = self.move(self.coordinates, delta, self.obstacles_at(self.t + 1))
+		if np.any(stuck):
+			print 'There is an obstacle for every transition!!!'
+			sys.exit()
+
+		return new_coordinates
+
+	def compute_table(self):
+		# next cell (x*height + y, -1 where every move is blocked) for every (t % obs_period, x, y, action, wind index),
+		# wind index 0 is no wind and k+1 a push along wind phase k. obstacles move between t and t+1 as in transition
+		cells = np.array(list(product(range(self.width), range(self.height))))
+		table = np.zeros((self.obs_period, self.width, self.height, len(ACTION_DELTAS), len(WIND_DELTAS) + 1), dtype=np.int16)
+		winds = np.concatenate((np.zeros((1, 2), dtype=int), WIND_DELTAS), axis=0)
+		for t in range(self.obs_period):
+			obstacles = self.obstacles_at(np.full(len(cells), t + 1))
+			for a in range(len(ACTION_DELTAS)):
+				for w in range(len(winds)):
+					new_coordinates, stuck = self.move(cells, ACTION_DELTAS[a] + winds[w], obstacles)
+					table[t, cells[:,0], cells[:,1], a, w] = np.where(stuck, -1, new_coordinates[:,0]*self.height + new_coordinates[:,1])
+		return table
+
+	def table_key(self):
+		# grid size, obstacle layout and movement pattern fully determine the table
+		return hashlib.md5(repr((self.width, self.height, self.obstacles.tolist(), self.offsets.tolist(), ACTION_DELTAS.tolist(), WIND_DELTAS.tolist(), FALLBACK_DELTAS.tolist())).encode('ascii')).hexdigest()
+
+	def load_table(self, cache_dir=TABLE_CACHE_DIR):
+		# precomputed transitions, read from cache_dir if present and computed and saved there otherwise (cache_dir None - no disk cache)
+		if cache_dir is None:
+			return self.compute_table()
+
+		path = os.path.join(cache_dir, 'transition_table_' + self.table_key() + '.npy')
+		if os.path.exists(path):
+			return np.load(path)
+
+		table = self.compute_table()
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		np.save(path, table)
+		return table
+
+	def step(self, actions):
+		# returns next states, rewards, terminals, phase at the next time step and done (terminal or episode limit).
+		# with auto_reset the done envs are reset afterwards, the returned next states are still the pre-reset ones
+		actions = np.asarray(actions, dtype=int)
+		self.coordinates = self.transition(actions)
+		self.t = self.t + 1
+
+		goal_1 = np.all(self.coordinates == self.goal_1_coordinates, axis=1)
+		goal_2 = np.all(self.coordinates == self.goal_2_coordinates, axis=1)
+		rewards = self.penalty*np.ones(self.n_envs)
+		rewards[goal_1] = self.goal_1_func(self.w1, self.t[goal_1], self.p)
+		rewards[goal_2] = self.goal_2_func(self.w2, self.t[goal_2], self.p)
+		terminals = goal_1 | goal_2
+
+		if self.wind_w is not None:
+			redraw = self.t % self.wind_w == 0
+			self.wind_phase[redraw] = np.random.randint(0, high=4, size=np.sum(redraw))
+
+		states_prime = self.states()
+		phases_prime = self.phase()
+		dones = terminals.copy()
+		if self.max_episode_length is not None:
+			dones |= self.t >= self.max_episode_length
+		if self.auto_reset and np.any(dones):
+			self.reset(dones)
+
+		return states_prime, rewards, terminals, phases_prime, dones
+
+
+def varying_transition_env(n_envs, prob, **kwargs):
+	# dynamics of varying_transition_*.py
+	return VecGridWorld(n_envs, wind_w=4, wind_prob=prob, goal_1_func=constant_reward(-20), goal_2_func=constant_reward(20), **kwargs)
+
+def varying_reward_env(n_envs, w1=math.pi/8, w2=math.pi/8, **kwargs):
+	# dynamics of varying_reward_*.py
+	return VecGridWorld(n_envs, w1=w1, w2=w2, goal_1_func=sinusoidal_reward, goal_2_func=sinusoidal_reward, **kwargs)